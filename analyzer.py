@@ -0,0 +1,598 @@
+#!/usr/bin/env python2
+import argparse
+import mmap
+import struct
+import sys
+from array import array
+from time import time
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+TYPE_WECMP = 0x1234
+TYPE_IPV4 = 0x0800
+LINKTYPE_ETHERNET = 1
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SECTION = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+PCAPNG_INTERFACE = 1
+PCAPNG_ENHANCED_PACKET = 6
+
+# Packets decoded per pass, bounds the memory of the gathered headers
+DECODE_CHUNK = 1 << 16
+# Bytes of every frame gathered at once: Ethernet, WECMP, IPv4 and TCP
+# headers without options
+HEADER_WINDOW = 14 + 10 + 20 + 20
+
+# Records of the same length in a row after which a pcap walk checks a
+# whole run of them at once, and the longest run checked
+RUN_THRESHOLD = 4
+MAX_RUN = 1 << 16
+
+DEFAULT_WINDOW = 0.1
+
+# Columns decoded from every packet, see decodePackets
+COLUMNS = ('time', 'length', 'ethertype', 'wecmp', 'src_sw_id', 'selected_path_id',
+           'tag_path_id', 'max_utilization', 'wecmp_bytes', 'ipv4', 'src_ip', 'dst_ip',
+           'proto', 'tcp', 'sport', 'dport', 'seq', 'payload')
+
+
+def _gather(data, offsets, width, little_endian=False):
+    """
+    Reads an unsigned integer of width bytes at every offset of the mapped
+    file; reads past the end of the file give 0.
+
+    :return: NumPy uint64 array
+    """
+    value = numpy.zeros(len(offsets), dtype=numpy.uint64)
+    last = len(data) - 1
+    for i in range(width):
+        index = offsets + i
+        byte = data[numpy.minimum(index, last)].astype(numpy.uint64)
+        byte[index > last] = 0
+        shift = 8 * i if little_endian else 8 * (width - 1 - i)
+        value |= byte << numpy.uint64(shift)
+    return value
+
+
+def _rows(data, offsets, width):
+    """
+    Copies width bytes at every offset of the mapped file, one row per
+    offset, out of a strided view of the file: a row is one contiguous copy
+    instead of width gathered bytes. Bytes past the end of the file are 0.
+
+    :return: NumPy uint8 array of shape (len(offsets), width)
+    """
+    limit = len(data) - width
+    if limit < 0:
+        padded = numpy.zeros(width, dtype=numpy.uint8)
+        padded[:len(data)] = data
+        data, limit = padded, 0
+    view = as_strided(data, shape=(limit + 1, width), strides=(1, 1))
+    rows = view[numpy.minimum(offsets, limit)]
+    for row in numpy.nonzero(offsets > limit)[0]:
+        tail = data[offsets[row]:]
+        rows[row, :len(tail)] = tail
+        rows[row, len(tail):] = 0
+    return rows
+
+
+def _pcapRecords(buf, data):
+    """
+    Indexes the records of a classic pcap file.
+
+    Every record header gives the length of the record, so the records have
+    to be walked one after the other. Once a few records in a row have the
+    same length, as with captures truncated to a snap length or full sized
+    segments, a run of records of that length is assumed and checked at
+    once, which is where the walk of a large capture spends its time.
+
+    :return: (frame offsets, captured lengths, wire lengths, times, link type)
+    """
+    magic, = struct.unpack_from('<I', buf, 0)
+    if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+        endian = '<'
+    else:
+        endian = '>'
+        magic, = struct.unpack_from('>I', buf, 0)
+    little = endian == '<'
+    ts_scale = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+    linktype, = struct.unpack_from(endian + 'I', buf, 20)
+
+    # Only the record lengths need walking, the rest is gathered afterwards
+    unpack = struct.Struct(endian + 'I').unpack_from
+    records = array('l')
+    append = records.append
+    runs = []
+    pos = 24
+    end = len(buf) - 16
+    last_length = None
+    same = 0
+    while pos <= end:
+        caplen = unpack(buf, pos + 8)[0]
+        if caplen == last_length:
+            same += 1
+        else:
+            last_length = caplen
+            same = 0
+        if same >= RUN_THRESHOLD:
+            stride = 16 + caplen
+            count = min(MAX_RUN, (end - pos) // stride + 1)
+            run = pos + stride * numpy.arange(count, dtype=numpy.int64)
+            mismatch = numpy.nonzero(_gather(data, run + 8, 4, little) != caplen)[0]
+            if len(mismatch):
+                count = mismatch[0]
+            runs.append((len(records), run[:count]))
+            # placeholder entries keep the order of the records
+            records.extend(array('l', [0]) * count)
+            pos += stride * count
+            same = 0 if len(mismatch) else same
+            continue
+        append(pos)
+        pos += 16 + caplen
+    offsets = numpy.frombuffer(records, dtype=numpy.int64).copy() if records else \
+        numpy.zeros(0, dtype=numpy.int64)
+    for start, run in runs:
+        offsets[start:start + len(run)] = run
+
+    header = _rows(data, offsets, 16).view(endian + 'u4')
+    seconds, fraction = header[:, 0], header[:, 1]
+    caplen = header[:, 2].astype(numpy.int64)
+    length = header[:, 3].astype(numpy.int64)
+    times = seconds.astype(numpy.float64) + fraction.astype(numpy.float64) * ts_scale
+    # a record cut short by the end of the file is dropped
+    whole = offsets + 16 + caplen <= len(buf)
+    return offsets[whole] + 16, caplen[whole], length[whole], times[whole], linktype
+
+
+def _pcapngRecords(buf, data):
+    """
+    Indexes the enhanced packet blocks of a pcapng file, all sections and
+    interfaces included. Packets of non Ethernet interfaces are skipped.
+
+    :return: (frame offsets, captured lengths, wire lengths, times, link type)
+    """
+    blocks = array('l')
+    interfaces = array('l')  # global interface index of every block
+    ethernet = []  # per global interface
+    resolution = []  # seconds per timestamp unit, per global interface
+    little_blocks = array('b')
+    section = []  # global indices of the interfaces of the current section
+    endian = '<'
+    pos = 0
+    size = len(buf)
+    while pos + 12 <= size:
+        block_type, = struct.unpack_from('<I', buf, pos)
+        if block_type == PCAPNG_SECTION:
+            byte_order, = struct.unpack_from('<I', buf, pos + 8)
+            endian = '<' if byte_order == PCAPNG_BYTE_ORDER else '>'
+            section = []
+        block_type, block_length = struct.unpack_from(endian + 'II', buf, pos)
+        if block_length < 12 or pos + block_length > size:
+            break
+        if block_type == PCAPNG_INTERFACE:
+            linktype, = struct.unpack_from(endian + 'H', buf, pos + 8)
+            tsresol = 1e-6
+            option = pos + 16
+            while option + 4 <= pos + block_length - 4:
+                code, option_length = struct.unpack_from(endian + 'HH', buf, option)
+                if code == 0:
+                    break
+                if code == 9 and option_length >= 1:
+                    value = ord(buf[option + 4])
+                    tsresol = 2.0 ** -(value & 0x7f) if value & 0x80 else 10.0 ** -value
+                option += 4 + (option_length + 3) // 4 * 4
+            section.append(len(ethernet))
+            ethernet.append(linktype == LINKTYPE_ETHERNET)
+            resolution.append(tsresol)
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, = struct.unpack_from(endian + 'I', buf, pos + 8)
+            blocks.append(pos)
+            interfaces.append(section[interface] if interface < len(section) else -1)
+            little_blocks.append(endian == '<')
+        pos += block_length
+
+    offsets = numpy.frombuffer(blocks, dtype=numpy.int64) if blocks else \
+        numpy.zeros(0, dtype=numpy.int64)
+    interface = numpy.frombuffer(interfaces, dtype=numpy.int64) if interfaces else \
+        numpy.zeros(0, dtype=numpy.int64)
+    little = numpy.frombuffer(little_blocks, dtype=numpy.int8).astype(bool) if little_blocks \
+        else numpy.zeros(0, dtype=bool)
+
+    def field(offset, width):
+        return numpy.where(little, _gather(data, offsets + offset, width, True),
+                           _gather(data, offsets + offset, width, False))
+
+    timestamp = (field(12, 4) << numpy.uint64(32)) | field(16, 4)
+    caplen = field(20, 4).astype(numpy.int64)
+    length = field(24, 4).astype(numpy.int64)
+    known = interface >= 0
+    keep = known.copy()
+    keep[known] = numpy.array(ethernet, dtype=bool)[interface[known]]
+    scale = numpy.zeros(len(offsets))
+    scale[known] = numpy.array(resolution)[interface[known]]
+    times = timestamp.astype(numpy.float64) * scale
+    return offsets[keep] + 28, caplen[keep], length[keep], times[keep], LINKTYPE_ETHERNET
+
+
+def _bigEndian(columns):
+    # the rows of a uint8 matrix of up to 8 columns as big-endian integers
+    padded = numpy.zeros((len(columns), 8), dtype=numpy.uint8)
+    padded[:, 8 - columns.shape[1]:] = columns
+    return padded.view('>u8').ravel().astype(numpy.uint64)
+
+
+def _read(window, data, offsets, start, width):
+    """
+    Reads a big-endian unsigned integer of width bytes at the given start of
+    every frame, from its header window when it lies within.
+
+    :param start: NumPy array of the start of the field in each frame
+    :return: NumPy uint64 array
+    """
+    inside = start + width <= HEADER_WINDOW
+    # a field sits at a handful of places, each read as a block of columns
+    places = numpy.nonzero(numpy.bincount(start[inside]))[0]
+    if len(places) == 1 and inside.all():
+        return _bigEndian(window[:, places[0]:places[0] + width])
+    value = numpy.zeros(len(offsets), dtype=numpy.uint64)
+    for place in places:
+        rows = start == place
+        value[rows] = _bigEndian(window[rows, place:place + width])
+    outside = ~inside
+    if outside.any():
+        value[outside] = _gather(data, offsets[outside] + start[outside], width)
+    return value
+
+
+def decodePackets(data, offsets, caplen):
+    """
+    Decodes the Ethernet, WECMP, IPv4 and TCP headers of every frame into
+    columns. A field missing from a frame, because the frame does not carry
+    that header or was captured too short, is 0 and its flag column False.
+
+    :param data: the mapped file as a NumPy uint8 array
+    :param offsets: offset of every frame in the file
+    :param caplen: captured length of every frame
+    :return: dict of column name -> NumPy array, see COLUMNS
+    """
+    window = _rows(data, offsets, HEADER_WINDOW)
+
+    def field(start, width):
+        if numpy.isscalar(start):
+            start = numpy.full(len(offsets), start, dtype=numpy.int64)
+        return _read(window, data, offsets, start, width)
+
+    ethertype = field(12, 2).astype(numpy.uint16)
+    ethertype[caplen < 14] = 0
+    wecmp = (ethertype == TYPE_WECMP) & (caplen >= 24)
+
+    columns = {'ethertype': ethertype, 'wecmp': wecmp}
+    for name, offset, width in (('src_sw_id', 14, 1), ('selected_path_id', 15, 1),
+                                ('tag_path_id', 16, 1), ('max_utilization', 17, 1),
+                                ('wecmp_bytes', 18, 6)):
+        value = field(offset, width)
+        value[~wecmp] = 0
+        columns[name] = value.astype(numpy.uint8 if width == 1 else numpy.uint64)
+
+    # the ToRs put the WECMP header between the Ethernet and IPv4 headers
+    ip = 14 + numpy.where(wecmp, 10, 0)
+    version_ihl = field(ip, 1)
+    ipv4 = (((ethertype == TYPE_IPV4) | wecmp) & (version_ihl >> numpy.uint64(4) == 4) &
+            (caplen >= ip + 20))
+    ihl = (version_ihl & numpy.uint64(0xf)).astype(numpy.int64) * 4
+    total_length = field(ip + 2, 2).astype(numpy.int64)
+    proto = field(ip + 9, 1).astype(numpy.uint8)
+    src_ip = field(ip + 12, 4).astype(numpy.uint32)
+    dst_ip = field(ip + 16, 4).astype(numpy.uint32)
+    for value in (proto, src_ip, dst_ip):
+        value[~ipv4] = 0
+    columns.update(ipv4=ipv4, proto=proto, src_ip=src_ip, dst_ip=dst_ip)
+
+    tcp_offset = ip + ihl
+    tcp = ipv4 & (proto == 6) & (caplen >= tcp_offset + 20)
+    sport = field(tcp_offset, 2).astype(numpy.uint16)
+    dport = field(tcp_offset + 2, 2).astype(numpy.uint16)
+    seq = field(tcp_offset + 4, 4).astype(numpy.uint32)
+    data_offset = (field(tcp_offset + 12, 1) >> numpy.uint64(4)).astype(numpy.int64) * 4
+    payload = numpy.maximum(total_length - ihl - data_offset, 0)
+    for value in (sport, dport, seq, payload):
+        value[~tcp] = 0
+    columns.update(tcp=tcp, sport=sport, dport=dport, seq=seq, payload=payload)
+    return columns
+
+
+def loadCapture(path, chunk=DECODE_CHUNK):
+    """
+    Memory-maps a pcap or pcapng capture and decodes all its packets.
+
+    :return: dict of column name -> NumPy array, see COLUMNS
+    """
+    with open(path, 'rb') as capture_file:
+        try:
+            buf = mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError("%s: empty capture" % path)
+    try:
+        if len(buf) < 24:
+            raise ValueError("%s: not a pcap or pcapng capture" % path)
+        data = numpy.frombuffer(buf, dtype=numpy.uint8)
+        magic_le, = struct.unpack_from('<I', buf, 0)
+        magic_be, = struct.unpack_from('>I', buf, 0)
+        if magic_le == PCAPNG_SECTION:
+            offsets, caplen, length, times, linktype = _pcapngRecords(buf, data)
+        elif PCAP_MAGIC in (magic_le, magic_be) or PCAP_MAGIC_NS in (magic_le, magic_be):
+            offsets, caplen, length, times, linktype = _pcapRecords(buf, data)
+        else:
+            raise ValueError("%s: not a pcap or pcapng capture" % path)
+        if linktype != LINKTYPE_ETHERNET:
+            raise ValueError("%s: link type %d is not Ethernet" % (path, linktype))
+
+        parts = [decodePackets(data, offsets[i:i + chunk], caplen[i:i + chunk])
+                 for i in range(0, len(offsets), chunk)]
+        if parts:
+            columns = dict((name, numpy.concatenate([part[name] for part in parts]))
+                           for name in parts[0])
+        else:
+            columns = decodePackets(data, offsets, caplen)
+        # drop the views of the file before it is unmapped
+        del data
+    finally:
+        buf.close()
+    columns['time'] = times
+    columns['length'] = length
+    return columns
+
+
+def _factorize(keys):
+    """
+    Numbers the distinct keys in order of first appearance. numpy.unique
+    falls back to a merge sort to find the first appearances, several times
+    slower than the quicksort used here.
+
+    :return: (number of the key of every element, number of distinct keys)
+    """
+    perm = numpy.argsort(keys)
+    ordered = keys[perm]
+    change = numpy.ones(len(keys), dtype=bool)
+    change[1:] = ordered[1:] != ordered[:-1]
+    group = numpy.cumsum(change) - 1
+    first = numpy.minimum.reduceat(perm, numpy.nonzero(change)[0])
+    rank = numpy.empty(len(first), dtype=numpy.int64)
+    rank[numpy.argsort(first)] = numpy.arange(len(first))
+    ids = numpy.empty(len(keys), dtype=numpy.int64)
+    ids[perm] = rank[group]
+    return ids, len(first)
+
+
+def flowIds(columns):
+    """
+    :return: (flow index of every TCP packet, -1 for the other packets,
+              number of flows); flows are the 5-tuples in order of appearance
+    """
+    tcp = columns['tcp']
+    flow = numpy.full(len(tcp), -1, dtype=numpy.int64)
+    if not tcp.any():
+        return flow, 0
+    # the 96 bit 5-tuples are numbered in two passes over 64 bit keys, far
+    # cheaper than sorting them as records: the address pairs first, then
+    # the pair numbers along with the ports
+    addresses = (columns['src_ip'][tcp].astype(numpy.uint64) << numpy.uint64(32)) | \
+        columns['dst_ip'][tcp]
+    pair, _ = _factorize(addresses)
+    keys = (pair.astype(numpy.uint64) << numpy.uint64(32)) | \
+        (columns['sport'][tcp].astype(numpy.uint64) << numpy.uint64(16)) | columns['dport'][tcp]
+    flow[tcp], flows = _factorize(keys)
+    return flow, flows
+
+
+def pathIds(columns, path_field='tag_path_id'):
+    """
+    :return: path of every WECMP packet as src_sw_id * 256 + path id, -1 for
+             the other packets
+    """
+    path = columns['src_sw_id'].astype(numpy.int64) * 256 + columns[path_field]
+    path[~columns['wecmp']] = -1
+    return path
+
+
+def _groupedRunningMax(values, groups):
+    # running maximum of values in packet order, restarting for every group;
+    # values and groups are non negative and already sorted by group
+    offset = groups * (values.max() + 1 if len(values) else 1)
+    return numpy.maximum.accumulate(values + offset) - offset
+
+
+def flowOrder(flow, times, keep):
+    """
+    :return: indices of the kept packets sorted by flow, then time
+    """
+    index = numpy.nonzero(keep)[0]
+    # captures are written in arrival order, which saves the sort by time
+    if len(index) and (times[index[1:]] < times[index[:-1]]).any():
+        index = index[numpy.argsort(times[index], kind='mergesort')]
+    # flow and position packed in one key: a plain sort, no stable argsort
+    keys = flow[index] * len(index) + numpy.arange(len(index))
+    keys.sort()
+    return index[keys % max(len(index), 1)]
+
+
+def pathSwitches(flow, path, times):
+    """
+    Counts, for every flow, how many times two consecutive packets of the
+    flow took different paths.
+
+    :return: NumPy array of the path switches of every flow
+    """
+    order = flowOrder(flow, times, (flow >= 0) & (path >= 0))
+    flows = flow[order]
+    paths = path[order]
+    switched = (flows[1:] == flows[:-1]) & (paths[1:] != paths[:-1])
+    return numpy.bincount(flows[1:][switched], minlength=flow.max() + 1 if len(flow) else 0)
+
+
+def tcpReordering(flow, path, times, seq, payload):
+    """
+    Finds the data packets that arrive after a packet of their flow holding
+    later data. Such a packet was reordered, or is a retransmission; it is
+    attributed to re-routing when the packet that overtook it came on
+    another path. Only the late packet counts, even when it is the first
+    of its flow (python -m doctest analyzer.py):
+
+    >>> flow = numpy.zeros(4, dtype=numpy.int64)
+    >>> reordered, _ = tcpReordering(flow, flow, numpy.arange(4.0),
+    ...                              numpy.array([1100, 1000, 1200, 1300]),
+    ...                              numpy.full(4, 100))
+    >>> numpy.nonzero(reordered)[0].tolist()
+    [1]
+
+    :return: (reordered mask, re-routed mask), in packet order
+    """
+    order = flowOrder(flow, times, (flow >= 0) & (payload > 0))
+    flows = flow[order]
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = flows[1:] != flows[:-1]
+
+    reordered = numpy.zeros(len(flow), dtype=bool)
+    rerouted = numpy.zeros(len(flow), dtype=bool)
+    if not len(order):
+        return reordered, rerouted
+
+    # sequence numbers unwrapped with serial number arithmetic: every packet
+    # moves the flow by the signed 32-bit difference with the previous one,
+    # so a first packet that came late does not throw off the rest
+    seqs = seq[order].astype(numpy.int64)
+    step = numpy.zeros(len(order), dtype=numpy.int64)
+    step[1:] = (seqs[1:] - seqs[:-1] + (1 << 31)) % (1 << 32) - (1 << 31)
+    step[first] = 0
+    unwrapped = numpy.cumsum(step)
+    starts = numpy.nonzero(first)[0]
+    counts = numpy.diff(numpy.append(starts, len(order)))
+    # then measured from the lowest sequence number of the flow
+    relative = unwrapped - numpy.repeat(numpy.minimum.reduceat(unwrapped, starts), counts)
+    end = relative + payload[order]
+    highest = _groupedRunningMax(end, flows)
+    late = numpy.zeros(len(order), dtype=bool)
+    late[1:] = ~first[1:] & (relative[1:] < highest[:-1])
+
+    # the packet that set the highest end so far
+    new_high = numpy.ones(len(order), dtype=bool)
+    new_high[1:] = first[1:] | (end[1:] > highest[:-1])
+    holder = numpy.maximum.accumulate(numpy.where(new_high, numpy.arange(len(order)), 0))
+    overtaken_by = numpy.zeros(len(order), dtype=numpy.int64)
+    overtaken_by[1:] = holder[:-1]
+    other_path = path[order] != path[order][overtaken_by]
+
+    reordered[order[late]] = True
+    rerouted[order[late & other_path]] = True
+    return reordered, rerouted
+
+
+def windowedPaths(path, times, lengths, utilization, window=DEFAULT_WINDOW):
+    """
+    Bins the WECMP packets into time windows.
+
+    :return: (window start times, path keys, bytes per (window, path),
+              mean max_utilization per (window, path), NaN where no packet)
+    """
+    wecmp = path >= 0
+    if not wecmp.any():
+        return numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, 0)), \
+            numpy.zeros((0, 0))
+    t0 = times[wecmp].min()
+    bins = ((times[wecmp] - t0) // window).astype(numpy.int64)
+    keys, column = numpy.unique(path[wecmp], return_inverse=True)
+    shape = (bins.max() + 1, len(keys))
+    cell = bins * len(keys) + column
+    size = shape[0] * shape[1]
+    volume = numpy.bincount(cell, weights=lengths[wecmp], minlength=size).reshape(shape)
+    packets = numpy.bincount(cell, minlength=size).reshape(shape)
+    levels = numpy.bincount(cell, weights=utilization[wecmp], minlength=size).reshape(shape)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_level = numpy.where(packets > 0, levels / packets, numpy.nan)
+    return t0 + window * numpy.arange(shape[0]), keys, volume, mean_level
+
+
+def _pathName(key):
+    return "%d/%d" % (key // 256, key % 256)
+
+
+def printReport(columns, path_field='tag_path_id', window=DEFAULT_WINDOW, top=10):
+    times = columns['time']
+    packets = len(times)
+    flow, flows = flowIds(columns)
+    path = pathIds(columns, path_field)
+    print "%d packets, %d WECMP, %d TCP flows, %.3f s" % (
+        packets, columns['wecmp'].sum(), flows,
+        times.max() - times.min() if packets else 0.0)
+
+    switches = pathSwitches(flow, path, times)
+    print "\n----- Path switches -----"
+    print "%d switches, %d of %d flows switched path at least once" % (
+        switches.sum(), (switches > 0).sum(), flows)
+    for f in numpy.argsort(-switches, kind='mergesort')[:top]:
+        if not switches[f]:
+            break
+        first = numpy.nonzero(flow == f)[0][0]
+        print "  %s:%d -> %s:%d  %d switches" % (
+            _ip(columns['src_ip'][first]), columns['sport'][first],
+            _ip(columns['dst_ip'][first]), columns['dport'][first], switches[f])
+
+    reordered, rerouted = tcpReordering(flow, path, times, columns['seq'], columns['payload'])
+    data_packets = ((flow >= 0) & (columns['payload'] > 0)).sum()
+    print "\n----- TCP reordering -----"
+    print "%d of %d data packets out of order (%.3f%%), %d of them overtaken on another path" % (
+        reordered.sum(), data_packets, 100.0 * reordered.sum() / max(data_packets, 1),
+        rerouted.sum())
+
+    starts, keys, volume, mean_level = windowedPaths(
+        path, times, columns['length'].astype(numpy.float64),
+        columns['max_utilization'].astype(numpy.float64), window)
+    if len(keys):
+        print "\n----- Byte shares and mean max_utilization per path (src_sw_id/path) -----"
+        print "%-10s %s" % ('time', ' '.join('%14s' % _pathName(k) for k in keys))
+        totals = volume.sum(axis=1)
+        for i, start in enumerate(starts):
+            if not totals[i]:
+                continue
+            print "%-10.3f %s" % (start - starts[0], ' '.join(
+                '%7.1f%% %6s' % (100.0 * volume[i, j] / totals[i],
+                                 '' if numpy.isnan(mean_level[i, j]) else '%.2f' % mean_level[i, j])
+                for j in range(len(keys))))
+    sys.stdout.flush()
+
+
+def _ip(value):
+    value = int(value)
+    return '.'.join(str((value >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+
+def main(captures, path_field, window, top, save):
+    for path in captures:
+        start = time()
+        columns = loadCapture(path)
+        elapsed = time() - start
+        print "\n===== %s: decoded %d packets in %.3f s =====" % (
+            path, len(columns['time']), elapsed)
+        if save:
+            numpy.savez(save if len(captures) == 1 else '%s.npz' % path, **columns)
+        printReport(columns, path_field, window, top)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline analyzer of WECMP pcap/pcapng captures')
+    parser.add_argument('captures', help='pcap or pcapng files', nargs='+')
+    parser.add_argument('--path-field', help='WECMP field identifying the path: tag_path_id, '
+                        'complete at the hosts, or selected_path_id, set by the source ToR',
+                        type=str, action="store", required=False, default='tag_path_id',
+                        choices=['tag_path_id', 'selected_path_id'])
+    parser.add_argument('--window', help='seconds per window of the path byte shares',
+                        type=float, action="store", required=False, default=DEFAULT_WINDOW)
+    parser.add_argument('--top', help='number of flows with the most path switches to list',
+                        type=int, action="store", required=False, default=10)
+    parser.add_argument('--save', help='save the decoded columns to this .npz file '
+                        '(<capture>.npz for each capture if several)',
+                        type=str, action="store", required=False)
+    args = parser.parse_args()
+    main(args.captures, args.path_field, args.window, args.top, args.save)
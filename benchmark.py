@@ -0,0 +1,211 @@
+#!/usr/bin/env python2
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+from google.protobuf import text_format
+from p4.config.v1 import p4info_pb2
+
+import mycontroller
+from fabric import PROGRAMS
+from fakeswitch import DEFAULT_WORKERS, FakeP4RuntimeServer
+from p4build import P4C_FLAGS
+from provision import (DEFAULT_BATCH_SIZE, DEFAULT_ENTRY_CACHE_SIZE, DEFAULT_MAX_IN_FLIGHT,
+                       ENTRY_CACHE)
+from snapshot import DEFAULT_SNAPSHOT, loadSnapshot, snapshotKey
+
+
+def benchmarkP4Info():
+    """
+    A P4Info with the tables, actions and ids the runtime entries of both
+    programs use, so the benchmark needs neither p4c nor a build directory.
+    """
+    p4info = p4info_pb2.P4Info()
+    actions = {}
+    for action_id, (name, params) in enumerate([
+            ('MyIngress.drop', []),
+            ('NoAction', []),
+            ('MyIngress.set_config_parameters', [('id', 8), ('position', 8)]),
+            ('MyIngress.tag_forward', [('port', 9)]),
+            ('MyIngress.ipv4_forward', [('dstAddr', 48), ('port', 9)])]):
+        action = p4info.actions.add()
+        action.preamble.id = 0x01000001 + action_id
+        action.preamble.name = name
+        action.preamble.alias = name.split('.')[-1]
+        for param_id, (param_name, bitwidth) in enumerate(params):
+            param = action.params.add()
+            param.id = param_id + 1
+            param.name = param_name
+            param.bitwidth = bitwidth
+        actions[name] = action.preamble.id
+
+    for table_id, (name, match_fields, action_names) in enumerate([
+            ('MyIngress.switch_config_params', [],
+             ['MyIngress.set_config_parameters']),
+            ('MyIngress.output_tag_id_exact',
+             [('meta.output_tag_id', 8, p4info_pb2.MatchField.EXACT)],
+             ['MyIngress.drop', 'MyIngress.tag_forward']),
+            ('MyIngress.ipv4_lpm',
+             [('hdr.ipv4.dstAddr', 32, p4info_pb2.MatchField.LPM)],
+             ['MyIngress.ipv4_forward', 'MyIngress.drop', 'NoAction'])]):
+        table = p4info.tables.add()
+        table.preamble.id = 0x02000001 + table_id
+        table.preamble.name = name
+        table.preamble.alias = name.split('.')[-1]
+        for field_id, (field_name, bitwidth, match_type) in enumerate(match_fields):
+            match_field = table.match_fields.add()
+            match_field.id = field_id + 1
+            match_field.name = field_name
+            match_field.bitwidth = bitwidth
+            match_field.match_type = match_type
+        for action_name in action_names:
+            table.action_refs.add().id = actions[action_name]
+        table.size = 1 << 20
+    return p4info
+
+
+def benchmarkEntries(index, count):
+    """
+    :return: the runtime entries of the index-th switch: its configuration,
+             the default route and count distinct /32 routes
+    """
+    entries = [{
+        "table": "MyIngress.switch_config_params",
+        "action_name": "MyIngress.set_config_parameters",
+        "action_params": {"id": index % 256},
+    }, {
+        "table": "MyIngress.ipv4_lpm",
+        "default_action": True,
+        "action_name": "MyIngress.drop",
+        "action_params": {},
+    }]
+    for i in range(count):
+        entries.append({
+            "table": "MyIngress.ipv4_lpm",
+            "match": {"hdr.ipv4.dstAddr": ["10.%d.%d.%d" % (i >> 16, (i >> 8) & 0xff, i & 0xff),
+                                           32]},
+            "action_name": "MyIngress.ipv4_forward",
+            "action_params": {"dstAddr": "08:00:00:00:%02x:%02x" % ((i >> 8) & 0xff, i & 0xff),
+                              "port": 1 + i % 4},
+        })
+    return entries
+
+
+def writeBenchmarkFabric(work_dir, switches, entries, port):
+    """
+    Lays out a working directory for mycontroller.main: a topology of the
+    given number of switches all served by the fake server on port, their
+    runtime files, and the P4Info and BMv2 JSON files of both programs.
+    """
+    for path in ('build', 'logs'):
+        os.makedirs(os.path.join(work_dir, path))
+    p4info = text_format.MessageToString(benchmarkP4Info())
+    for program in PROGRAMS.itervalues():
+        with open(os.path.join(work_dir, program['p4info']), 'w') as p4info_file:
+            p4info_file.write(p4info)
+        with open(os.path.join(work_dir, program['bmv2_json']), 'w') as bmv2_file:
+            bmv2_file.write('{}')
+
+    topology = {"hosts": {}, "links": [], "switches": {}}
+    for index in range(switches):
+        name = 'b%04d' % index
+        topology["switches"][name] = {"role": "tor", "grpc_port": port}
+        with open(os.path.join(work_dir, '%s-runtime.json' % name), 'w') as runtime_file:
+            json.dump({"table_entries": benchmarkEntries(index, entries)}, runtime_file)
+    with open(os.path.join(work_dir, 'topology.json'), 'w') as topo_file:
+        json.dump(topology, topo_file)
+
+
+def main(switches, entries, batch_size, reconcile, latency, update_latency, runs, port,
+         entry_cache_size=DEFAULT_ENTRY_CACHE_SIZE, snapshot=False,
+         max_in_flight=DEFAULT_MAX_IN_FLIGHT, busy_rate=0.0):
+    ENTRY_CACHE.resize(entry_cache_size)
+    # One worker per stream of the switch connections, plus the unary RPCs
+    server = FakeP4RuntimeServer(port=port, latency=latency, update_latency=update_latency,
+                                 max_workers=switches + DEFAULT_WORKERS,
+                                 busy_rate=busy_rate).start()
+    work_dir = tempfile.mkdtemp(prefix='wecmp-benchmark-')
+    cwd = os.getcwd()
+    results = []
+    try:
+        writeBenchmarkFabric(work_dir, switches, entries, server.port)
+        os.chdir(work_dir)
+        snapshot_file = DEFAULT_SNAPSHOT if snapshot else None
+        for run in range(runs):
+            start = time()
+            # The first run saves the snapshot, the later ones warm start from it
+            snapshot_key = snapshotKey('topology.json', P4C_FLAGS) if snapshot else None
+            warm = loadSnapshot(snapshot_file, snapshot_key) if snapshot else None
+            mycontroller.main('topology.json', batch_size=batch_size, reconcile=reconcile,
+                              snapshot_file=snapshot_file, snapshot_key=snapshot_key,
+                              snapshot=warm, max_in_flight=max_in_flight)
+            results.append(time() - start)
+        installed = server.entryCount()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+        server.stop()
+
+    expected = switches * (entries + 1)
+    print '\n----- %d switches x %d entries, batch size %d, %d in flight%s%s -----' % (
+        switches, entries, batch_size, max_in_flight, ', reconcile' if reconcile else '',
+        ', snapshot' if snapshot else '')
+    for run, elapsed in enumerate(results):
+        print "run %d: %.3f s, %.0f entries/s" % (run + 1, elapsed, expected / elapsed)
+    print ENTRY_CACHE.stats()
+    if sum(installed.values()) != expected:
+        print "expected %d entries on the fake switches, found %d" % (
+            expected, sum(installed.values()))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Controller provisioning benchmark '
+                                     'against fake P4Runtime switches')
+    parser.add_argument('--switches', help='number of simulated switches',
+                        type=int, action="store", required=False,
+                        default=16)
+    parser.add_argument('--entries', help='table entries per switch',
+                        type=int, action="store", required=False,
+                        default=1000)
+    parser.add_argument('--batch-size', help='table updates per P4Runtime WriteRequest',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--reconcile', help='provision in reconcile mode; later runs then '
+                        'measure the cost of finding nothing to change',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--latency', help='delay the fake switches add to every RPC, in seconds',
+                        type=float, action="store", required=False,
+                        default=0.0)
+    parser.add_argument('--update-latency', help='delay the fake switches add per written '
+                        'update, in seconds',
+                        type=float, action="store", required=False,
+                        default=0.0)
+    parser.add_argument('--runs', help='number of times to provision the fabric',
+                        type=int, action="store", required=False,
+                        default=1)
+    parser.add_argument('--port', help='TCP port of the fake P4Runtime server, 0 for any',
+                        type=int, action="store", required=False,
+                        default=0)
+    parser.add_argument('--entry-cache-size', help='number of compiled table entries kept, '
+                        '0 to build every entry',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_ENTRY_CACHE_SIZE)
+    parser.add_argument('--snapshot', help='save a snapshot on the first run and warm start '
+                        'the later runs from it',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--max-in-flight', help='WriteRequests outstanding per switch',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument('--busy-rate', help='share of the updates the fake switches fail as '
+                        'UNAVAILABLE, to be retried',
+                        type=float, action="store", required=False,
+                        default=0.0)
+    args = parser.parse_args()
+    sys.exit(main(args.switches, args.entries, args.batch_size, args.reconcile,
+                  args.latency, args.update_latency, args.runs, args.port,
+                  args.entry_cache_size, args.snapshot, args.max_in_flight, args.busy_rate))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python2
+import json
+import os
+import re
+import sys
+
+from profiler import PROFILER
+
+# Import P4Runtime lib from parent utils dir
+# Probably there's a better way of doing this.
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../utils/'))
+
+# P4 program installed on the switches of each role
+PROGRAMS = {
+    'spine': {
+        'source': 'load_balance.p4.sw',
+        'p4info': 'build/load_balance_sw.p4.p4info.txt',
+        'bmv2_json': 'build/load_balance_sw.json',
+    },
+    'tor': {
+        'source': 'load_balance.p4',
+        'p4info': 'build/load_balance.p4.p4info.txt',
+        'bmv2_json': 'build/load_balance.json',
+    },
+}
+
+# Mininet gives the switches consecutive gRPC ports in name order
+GRPC_BASE_PORT = 50051
+
+
+def naturalKey(name):
+    """
+    :return: a sort key ordering the numbers in names by value, s2 before s10
+    """
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+# Link speed assumed when a link of topology.json does not give one
+DEFAULT_LINK_MBPS = 1000
+
+
+def _byteify(data, ignore_dicts=False):
+    # if this is a unicode string, return its string representation
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    # if this is a list of values, return list of byteified values
+    if isinstance(data, list):
+        return [_byteify(item, ignore_dicts=True) for item in data]
+    # if this is a dictionary, return dictionary of byteified keys and values
+    # but only if we haven't already byteified it
+    if isinstance(data, dict) and not ignore_dicts:
+        return {
+            _byteify(key, ignore_dicts=True): _byteify(value, ignore_dicts=True)
+            for key, value in data.iteritems()
+        }
+    # if it's anything else, return it in its original form
+    return data
+
+def json_load_byteified(file_handle):
+    return _byteify(json.load(file_handle, object_hook=_byteify), ignore_dicts=True)
+
+
+def validateTableEntry(flow):
+    """
+    Checks that a runtime JSON entry has the fields needed to build it.
+
+    :param flow: one entry of the "table_entries" list
+    :return: an error message, or None if the entry is valid
+    """
+    for key in ('table', 'action_name'):
+        if key not in flow:
+            return "missing '%s'" % key
+    if not isinstance(flow.get('action_params', {}), dict):
+        return "'action_params' is not an object"
+    if not isinstance(flow.get('match', {}), dict):
+        return "'match' is not an object"
+    return None
+
+
+class FabricSwitch(object):
+    """
+    A switch of the fabric as described by topology.json.
+    """
+
+    def __init__(self, name, role, address, device_id, runtime_file):
+        self.name = name
+        self.role = role
+        self.address = address
+        self.device_id = device_id
+        self.runtime_file = runtime_file
+
+    @property
+    def program(self):
+        return PROGRAMS[self.role]
+
+    def __repr__(self):
+        return "FabricSwitch(%s, %s, %s, device_id=%d)" % (
+            self.name, self.role, self.address, self.device_id)
+
+
+class FabricInventory(object):
+    """
+    The switches of the fabric, their gRPC addresses, P4 roles and runtime
+    entries, all derived from a single topology.json.
+
+    Switches connected to a host are ToRs and every other switch is a spine.
+    The runtime entries of switch "sX" are read from "sX-runtime.json". Each
+    switch of the topology may override these defaults with the optional
+    "role", "runtime", "grpc_port" and "device_id" keys.
+    """
+
+    def __init__(self, topology_file='topology.json', grpc_host='127.0.0.1'):
+        with open(topology_file, 'r') as topo_file:
+            topo = json_load_byteified(topo_file)
+        self.base_dir = os.path.dirname(os.path.abspath(topology_file))
+        self.hosts = topo.get('hosts', {})
+        self.links = topo.get('links', [])
+        self._entries = None
+
+        tors = set()
+        for link in self.links:
+            ends = [node.split('-')[0] for node in link[:2]]
+            if ends[0] in self.hosts:
+                tors.add(ends[1])
+            if ends[1] in self.hosts:
+                tors.add(ends[0])
+
+        # ports[switch][port] = (peer node, peer port or None for a host)
+        self.ports = {}
+        self.link_mbps = {}
+        # (switch, port) of the links whose speed topology.json gives
+        self.rated_ports = set()
+        for link in self.links:
+            ends = [self._parseNode(node) for node in link[:2]]
+            rated = len(link) > 3 and link[3] is not None
+            mbps = link[3] if rated else DEFAULT_LINK_MBPS
+            for (node, port), peer in ((ends[0], ends[1]), (ends[1], ends[0])):
+                if port is not None:
+                    self.ports.setdefault(node, {})[port] = peer
+                    self.link_mbps[(node, port)] = mbps
+                    if rated:
+                        self.rated_ports.add((node, port))
+
+        self.switches = []
+        for device_id, name in enumerate(sorted(topo['switches'], key=naturalKey)):
+            params = topo['switches'][name] or {}
+            role = params.get('role', 'tor' if name in tors else 'spine')
+            if role not in PROGRAMS:
+                raise ValueError("%s: unknown switch role '%s'" % (name, role))
+            port = params.get('grpc_port', GRPC_BASE_PORT + device_id)
+            self.switches.append(FabricSwitch(
+                name=name,
+                role=role,
+                address='%s:%d' % (grpc_host, port),
+                device_id=params.get('device_id', device_id),
+                runtime_file=os.path.join(self.base_dir,
+                                          params.get('runtime', '%s-runtime.json' % name))))
+        self._by_name = dict((sw.name, sw) for sw in self.switches)
+
+    def __iter__(self):
+        return iter(self.switches)
+
+    def __len__(self):
+        return len(self.switches)
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    @staticmethod
+    def _parseNode(node):
+        # "s1-p3" is port 3 of switch s1, a bare name is a host
+        if '-p' in node:
+            name, port = node.rsplit('-p', 1)
+            return name, int(port)
+        return node, None
+
+    def tors(self):
+        return [sw for sw in self.switches if sw.role == 'tor']
+
+    def linkCapacity(self, switch, port):
+        """
+        :return: the speed of the link on the given switch port, in bits/s
+        """
+        return self.link_mbps.get((switch, port), DEFAULT_LINK_MBPS) * 1e6
+
+    def _distances(self, dst):
+        # hop count from every switch to dst, going through switches only
+        distances = {dst: 0}
+        frontier = [dst]
+        while frontier:
+            next_frontier = []
+            for node in frontier:
+                for peer, _ in self.ports.get(node, {}).itervalues():
+                    if peer in self._by_name and peer not in distances:
+                        distances[peer] = distances[node] + 1
+                        next_frontier.append(peer)
+            frontier = next_frontier
+        return distances
+
+    def nextHops(self, node, distances):
+        """
+        :param distances: hop counts to the destination, from _distances
+        :return: the ports of node on a shortest path to the destination,
+                 in port order
+        """
+        return sorted(port for port, (peer, _) in self.ports[node].iteritems()
+                      if distances.get(peer) == distances[node] - 1)
+
+    def spinePaths(self, src, dst):
+        """
+        Enumerates the shortest paths between two ToRs.
+
+        At every hop, the candidate next hops are ranked by port number and
+        the rank is the output tag used at that hop. The path id packs the
+        tags of the hops with the ToR's in the lowest digit, which is how the
+        P4 programs read it (selected_path_id & 1 on the ToR, then shifted
+        right by one on every spine of a 2-way fabric).
+
+        :return: list of paths indexed by path id, each a list of
+                 (switch, egress port) hops ending on the dst ToR
+        """
+        distances = self._distances(dst)
+        paths = []
+
+        def walk(node, hops, path_id, radix):
+            if node == dst:
+                paths.append((path_id, hops))
+                return
+            ports = self.nextHops(node, distances)
+            for rank, port in enumerate(ports):
+                walk(self.ports[node][port][0], hops + [(node, port)],
+                     path_id + rank * radix, radix * len(ports))
+
+        if src in distances:
+            walk(src, [], 0, 1)
+        return [hops for _, hops in sorted(paths)]
+
+    def roles(self):
+        return sorted(set(sw.role for sw in self.switches))
+
+    def loadRuntimeEntries(self):
+        """
+        Parses and validates the runtime JSON file of every switch once. The
+        result is cached, so later calls do not touch the files again.
+
+        :return: dict of switch name -> list of table entries
+        """
+        if self._entries is not None:
+            return self._entries
+        entries = {}
+        for sw in self.switches:
+            with PROFILER.stage('load_json', sw.name):
+                with open(sw.runtime_file, 'r') as sw_conf_file:
+                    sw_conf = json_load_byteified(sw_conf_file)
+            table_entries = sw_conf.get('table_entries', [])
+            for i, flow in enumerate(table_entries):
+                error = validateTableEntry(flow)
+                if error is not None:
+                    raise ValueError("%s: table entry %d: %s" % (sw.runtime_file, i, error))
+                flow.setdefault('action_params', {})
+            entries[sw.name] = table_entries
+        self._entries = entries
+        return entries
+
+    def runtimeEntries(self, name):
+        return self.loadRuntimeEntries()[name]
+
+    def connect(self, log_dir='logs'):
+        """
+        Opens a P4Runtime connection to every switch of the fabric and dumps
+        the messages sent to each switch to <log_dir>/<name>-p4runtime-requests.txt.
+
+        :return: dict of switch name -> Bmv2SwitchConnection
+        """
+        # Imported here so the inventory can be used without the P4 tutorial
+        # utils, e.g. by the offline simulator
+        import p4runtime_lib.bmv2
+        connections = {}
+        for sw in self.switches:
+            connections[sw.name] = p4runtime_lib.bmv2.Bmv2SwitchConnection(
+                name=sw.name,
+                address=sw.address,
+                device_id=sw.device_id,
+                proto_dump_file=os.path.join(log_dir, '%s-p4runtime-requests.txt' % sw.name))
+        return connections
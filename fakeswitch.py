@@ -0,0 +1,366 @@
+#!/usr/bin/env python2
+import argparse
+import random
+import sys
+import threading
+from Queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+import grpc
+from google.rpc import code_pb2, status_pb2
+from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+
+from reconcile import entryKey
+
+DEFAULT_PORT = 50051
+DEFAULT_WORKERS = 16
+
+
+class WriteError(Exception):
+    """
+    Failure of one update of a WriteRequest, reported as a p4.v1.Error.
+    """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+class FakeDevice(object):
+    """
+    In-memory state of one P4Runtime device: its pipeline, the entries of
+    its tables and the values of its registers.
+    """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.config = None
+        self.tables = {}  # table id -> dict of entryKey -> TableEntry
+        self.defaults = {}  # table id -> default TableEntry
+        self.registers = {}  # register id -> list of values
+        self.register_bits = {}  # register id -> bitwidth
+        self.digests = {}  # digest id -> DigestEntry
+        self.primary = None  # (election id high, low) of the primary client
+        self.clients = {}  # election id -> response queue of each arbitrated stream
+        self.lock = threading.Lock()
+
+    def setPipeline(self, config):
+        self.config = p4runtime_pb2.ForwardingPipelineConfig()
+        self.config.CopyFrom(config)
+        self.tables = dict((table.preamble.id, {}) for table in config.p4info.tables)
+        self.defaults = {}
+        self.registers = {}
+        self.register_bits = {}
+        for register in config.p4info.registers:
+            self.registers[register.preamble.id] = [0] * register.size
+            self.register_bits[register.preamble.id] = register.type_spec.bitstring.bit.bitwidth
+        self.digests = {}
+
+    def writeTableEntry(self, update_type, table_entry):
+        table = self.tables.get(table_entry.table_id)
+        if table is None:
+            raise WriteError(code_pb2.NOT_FOUND, "unknown table %d" % table_entry.table_id)
+        if table_entry.is_default_action:
+            if update_type != p4runtime_pb2.Update.MODIFY:
+                raise WriteError(code_pb2.INVALID_ARGUMENT, "default entries can only be modified")
+            self.defaults[table_entry.table_id] = table_entry
+            return
+        key = entryKey(table_entry)
+        if update_type == p4runtime_pb2.Update.INSERT:
+            if key in table:
+                raise WriteError(code_pb2.ALREADY_EXISTS, "entry already exists")
+            table[key] = table_entry
+        elif update_type == p4runtime_pb2.Update.MODIFY:
+            if key not in table:
+                raise WriteError(code_pb2.NOT_FOUND, "entry does not exist")
+            table[key] = table_entry
+        elif update_type == p4runtime_pb2.Update.DELETE:
+            if table.pop(key, None) is None:
+                raise WriteError(code_pb2.NOT_FOUND, "entry does not exist")
+        else:
+            raise WriteError(code_pb2.INVALID_ARGUMENT, "unknown update type")
+
+    def writeRegisterEntry(self, register_entry):
+        values = self.registers.get(register_entry.register_id)
+        if values is None:
+            raise WriteError(code_pb2.NOT_FOUND, "unknown register %d" % register_entry.register_id)
+        index = register_entry.index.index
+        if index >= len(values):
+            raise WriteError(code_pb2.OUT_OF_RANGE, "register index %d out of range" % index)
+        bitstring = register_entry.data.bitstring
+        values[index] = int(bitstring.encode('hex'), 16) if bitstring else 0
+
+    def write(self, update):
+        which = update.entity.WhichOneof('entity')
+        if which == 'table_entry':
+            self.writeTableEntry(update.type, update.entity.table_entry)
+        elif which == 'register_entry':
+            self.writeRegisterEntry(update.entity.register_entry)
+        elif which == 'digest_entry':
+            digest_entry = update.entity.digest_entry
+            if update.type == p4runtime_pb2.Update.DELETE:
+                self.digests.pop(digest_entry.digest_id, None)
+            else:
+                self.digests[digest_entry.digest_id] = digest_entry
+        else:
+            raise WriteError(code_pb2.UNIMPLEMENTED, "%s is not supported" % which)
+
+    def readTableEntries(self, table_entry):
+        if table_entry.is_default_action:
+            default = self.defaults.get(table_entry.table_id)
+            return [default] if default is not None else []
+        if table_entry.table_id == 0:
+            tables = self.tables.values()
+        else:
+            tables = [self.tables.get(table_entry.table_id, {})]
+        return [entry for table in tables for entry in table.itervalues()]
+
+    def readRegisterEntries(self, register_entry):
+        register_ids = [register_entry.register_id] if register_entry.register_id \
+            else sorted(self.registers)
+        entries = []
+        for register_id in register_ids:
+            values = self.registers.get(register_id, [])
+            indices = [register_entry.index.index] if register_entry.HasField('index') \
+                else range(len(values))
+            nbytes = (self.register_bits.get(register_id, 32) + 7) // 8
+            for index in indices:
+                entry = p4runtime_pb2.RegisterEntry()
+                entry.register_id = register_id
+                entry.index.index = index
+                entry.data.bitstring = ('%0*x' % (nbytes * 2, values[index])).decode('hex')
+                entries.append(entry)
+        return entries
+
+
+class FakeP4RuntimeServicer(p4runtime_pb2_grpc.P4RuntimeServicer):
+    """
+    Serves any number of devices, told apart by their device id, with the
+    RPCs the controller uses. Every RPC waits for the injected latency first,
+    plus update_latency per update of a WriteRequest. A share busy_rate of
+    the updates fail as UNAVAILABLE without being applied, as a busy switch
+    would, to exercise the retries of the controller.
+    """
+
+    def __init__(self, latency=0.0, update_latency=0.0, busy_rate=0.0):
+        self.latency = latency
+        self.update_latency = update_latency
+        self.busy_rate = busy_rate
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def device(self, device_id):
+        with self.lock:
+            device = self.devices.get(device_id)
+            if device is None:
+                device = self.devices[device_id] = FakeDevice(device_id)
+            return device
+
+    def _wait(self, updates=0):
+        delay = self.latency + self.update_latency * updates
+        if delay > 0:
+            sleep(delay)
+
+    def _isPrimary(self, device, election_id):
+        return device.primary == (election_id.high, election_id.low)
+
+    def SetForwardingPipelineConfig(self, request, context):
+        self._wait()
+        device = self.device(request.device_id)
+        with device.lock:
+            if not self._isPrimary(device, request.election_id):
+                context.abort(grpc.StatusCode.PERMISSION_DENIED, "not the primary client")
+            device.setPipeline(request.config)
+        return p4runtime_pb2.SetForwardingPipelineConfigResponse()
+
+    def GetForwardingPipelineConfig(self, request, context):
+        self._wait()
+        device = self.device(request.device_id)
+        response = p4runtime_pb2.GetForwardingPipelineConfigResponse()
+        with device.lock:
+            if device.config is None:
+                context.abort(grpc.StatusCode.FAILED_PRECONDITION, "no pipeline installed")
+            if request.response_type == \
+                    p4runtime_pb2.GetForwardingPipelineConfigRequest.COOKIE_ONLY:
+                response.config.cookie.CopyFrom(device.config.cookie)
+            else:
+                response.config.CopyFrom(device.config)
+        return response
+
+    def Write(self, request, context):
+        self._wait(len(request.updates))
+        device = self.device(request.device_id)
+        errors = []
+        with device.lock:
+            if device.config is None:
+                context.abort(grpc.StatusCode.FAILED_PRECONDITION, "no pipeline installed")
+            if not self._isPrimary(device, request.election_id):
+                context.abort(grpc.StatusCode.PERMISSION_DENIED, "not the primary client")
+            for update in request.updates:
+                error = p4runtime_pb2.Error()
+                try:
+                    if self.busy_rate and random.random() < self.busy_rate:
+                        raise WriteError(code_pb2.UNAVAILABLE, "device busy")
+                    device.write(update)
+                    error.canonical_code = code_pb2.OK
+                except WriteError as e:
+                    error.canonical_code = e.code
+                    error.message = e.message
+                errors.append(error)
+
+        # Like BMv2, report a batch with failures as UNKNOWN and give the
+        # outcome of every update in the status details
+        if any(error.canonical_code != code_pb2.OK for error in errors):
+            status = status_pb2.Status(code=code_pb2.UNKNOWN, message="Write failure.")
+            for error in errors:
+                status.details.add().Pack(error)
+            context.set_trailing_metadata(
+                (('grpc-status-details-bin', status.SerializeToString()),))
+            context.set_code(grpc.StatusCode.UNKNOWN)
+            context.set_details("Write failure.")
+        return p4runtime_pb2.WriteResponse()
+
+    def Read(self, request, context):
+        self._wait()
+        device = self.device(request.device_id)
+        response = p4runtime_pb2.ReadResponse()
+        with device.lock:
+            for entity in request.entities:
+                which = entity.WhichOneof('entity')
+                if which == 'table_entry':
+                    for table_entry in device.readTableEntries(entity.table_entry):
+                        response.entities.add().table_entry.CopyFrom(table_entry)
+                elif which == 'register_entry':
+                    for register_entry in device.readRegisterEntries(entity.register_entry):
+                        response.entities.add().register_entry.CopyFrom(register_entry)
+                else:
+                    context.abort(grpc.StatusCode.UNIMPLEMENTED, "%s is not supported" % which)
+        yield response
+
+    def _arbitrationResponse(self, device, election_id):
+        response = p4runtime_pb2.StreamMessageResponse()
+        response.arbitration.device_id = device.device_id
+        response.arbitration.election_id.high = device.primary[0]
+        response.arbitration.election_id.low = device.primary[1]
+        response.arbitration.status.code = \
+            code_pb2.OK if election_id == device.primary else code_pb2.ALREADY_EXISTS
+        return response
+
+    def _elect(self, device):
+        # The connected client with the highest election id is the primary,
+        # every client hears about a change of primary
+        primary = max(device.clients) if device.clients else None
+        if primary == device.primary:
+            return False
+        device.primary = primary
+        for election_id, responses in device.clients.iteritems():
+            responses.put(self._arbitrationResponse(device, election_id))
+        return True
+
+    def StreamChannel(self, request_iterator, context):
+        responses = Queue()
+        client = {}  # device and election id of this stream once arbitrated
+
+        def consume():
+            try:
+                for request in request_iterator:
+                    if request.WhichOneof('update') != 'arbitration':
+                        continue
+                    arbitration = request.arbitration
+                    device = self.device(arbitration.device_id)
+                    election_id = (arbitration.election_id.high, arbitration.election_id.low)
+                    with device.lock:
+                        if client:
+                            client['device'].clients.pop(client['election_id'], None)
+                        client.update(device=device, election_id=election_id)
+                        device.clients[election_id] = responses
+                        if not self._elect(device):
+                            responses.put(self._arbitrationResponse(device, election_id))
+            except grpc.RpcError:
+                pass
+            finally:
+                if client:
+                    with client['device'].lock:
+                        client['device'].clients.pop(client['election_id'], None)
+                        self._elect(client['device'])
+                responses.put(None)
+
+        reader = threading.Thread(target=consume, name='fake-stream')
+        reader.daemon = True
+        reader.start()
+        while True:
+            response = responses.get()
+            if response is None:
+                return
+            yield response
+
+    def Capabilities(self, request, context):
+        response = p4runtime_pb2.CapabilitiesResponse()
+        response.p4runtime_api_version = '1.3.0'
+        return response
+
+
+class FakeP4RuntimeServer(object):
+    """
+    A loopback P4Runtime server standing in for simple_switch_grpc.
+
+    Every open StreamChannel holds one worker of the pool for its whole life,
+    so max_workers must exceed the number of clients for the other RPCs to
+    be served.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, latency=0.0, update_latency=0.0,
+                 max_workers=DEFAULT_WORKERS, address='127.0.0.1', busy_rate=0.0):
+        self.servicer = FakeP4RuntimeServicer(latency, update_latency, busy_rate)
+        self.server = grpc.server(ThreadPoolExecutor(max_workers=max_workers))
+        p4runtime_pb2_grpc.add_P4RuntimeServicer_to_server(self.servicer, self.server)
+        self.port = self.server.add_insecure_port('%s:%d' % (address, port))
+        self.address = '%s:%d' % (address, self.port)
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop(None)
+
+    def entryCount(self):
+        """
+        :return: dict of device id -> number of table entries installed
+        """
+        return dict((device_id, sum(len(table) for table in device.tables.itervalues()))
+                    for device_id, device in self.servicer.devices.items())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake P4Runtime server')
+    parser.add_argument('--port', help='TCP port to listen on',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_PORT)
+    parser.add_argument('--latency', help='delay added to every RPC, in seconds',
+                        type=float, action="store", required=False,
+                        default=0.0)
+    parser.add_argument('--update-latency', help='delay added per update of a WriteRequest, '
+                        'in seconds',
+                        type=float, action="store", required=False,
+                        default=0.0)
+    parser.add_argument('--workers', help='size of the server thread pool, at least one more '
+                        'than the number of connected clients',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_WORKERS)
+    parser.add_argument('--busy-rate', help='share of the updates failing as UNAVAILABLE',
+                        type=float, action="store", required=False,
+                        default=0.0)
+    args = parser.parse_args()
+
+    server = FakeP4RuntimeServer(args.port, args.latency, args.update_latency,
+                                 args.workers, busy_rate=args.busy_rate).start()
+    print "Fake P4Runtime server listening on %s" % server.address
+    sys.stdout.flush()
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
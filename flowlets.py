@@ -0,0 +1,139 @@
+#!/usr/bin/env python2
+import argparse
+import math
+import sys
+
+import grpc
+
+from fabric import FabricInventory, PROGRAMS
+from p4build import loadP4InfoHelper
+from p4runtime_lib.error_utils import printGrpcError
+from p4runtime_lib.switch import ShutdownAllSwitchConnections
+from telemetry import registerIds, readRegisters
+
+# Defaults of FLOWLET_NUM and INTERPACKET_GAP in load_balance.p4
+DEFAULT_FLOWLET_SLOTS = 16
+DEFAULT_FLOWLET_GAP = 20000
+
+# Indices of flowlet_stats_reg
+FLOWLET_STAT_LOOKUPS = 0
+FLOWLET_STAT_NEW = 1
+FLOWLET_STAT_COLLISIONS = 2
+
+
+def flowletFlags(slots=DEFAULT_FLOWLET_SLOTS, gap=DEFAULT_FLOWLET_GAP):
+    """
+    :param slots: number of flowlet table slots
+    :param gap: flowlet inter-packet gap, in micro seconds
+    :return: the p4c defines that size the flowlet table of load_balance.p4
+    """
+    if not 1 <= slots <= 65536:
+        raise ValueError("the flowlet table holds 1 to 65536 slots, not %d" % slots)
+    return ['-DFLOWLET_NUM=%d' % slots, '-DINTERPACKET_GAP=%d' % gap]
+
+
+def collisionRate(flows, slots):
+    """
+    Probability that a flow shares its slot with at least one other flow,
+    when the flows hash uniformly into the slots.
+    """
+    if flows <= 1:
+        return 0.0
+    return 1 - (1 - 1.0 / slots) ** (flows - 1)
+
+def requiredSlots(flows, target):
+    """
+    Smallest table keeping the collision rate of the flows under the target.
+    """
+    if flows <= 1:
+        return 1
+    return int(math.ceil(1 / (1 - (1 - target) ** (1.0 / (flows - 1)))))
+
+def flowsFromOccupancy(occupied, slots):
+    """
+    Estimates the number of flows that leave the given number of slots in use.
+    """
+    if occupied >= slots:
+        return float('inf')
+    if slots == 1:
+        return float(occupied)
+    return math.log(1 - float(occupied) / slots) / math.log(1 - 1.0 / slots)
+
+
+def readFlowletState(sw, p4info_helper, gap=DEFAULT_FLOWLET_GAP):
+    """
+    Reads the flowlet counters and table of a ToR.
+
+    A slot counts as occupied if it saw a packet within one gap of the most
+    recent packet of the whole table.
+
+    :return: dict with 'slots', 'occupied', 'lookups', 'new' and 'collisions'
+    """
+    register_ids = registerIds(p4info_helper, ['flowlet_stats_reg', 'last_time_reg'])
+    values = readRegisters(sw, register_ids)
+    last_times = [value for (name, _), value in values.iteritems() if name == 'last_time_reg']
+    latest = max(last_times) if last_times else 0
+    return {
+        'slots': len(last_times),
+        'occupied': sum(1 for t in last_times if t and latest - t <= gap),
+        'lookups': values.get(('flowlet_stats_reg', FLOWLET_STAT_LOOKUPS), 0),
+        'new': values.get(('flowlet_stats_reg', FLOWLET_STAT_NEW), 0),
+        'collisions': values.get(('flowlet_stats_reg', FLOWLET_STAT_COLLISIONS), 0),
+    }
+
+
+def printSizing(flows, slots, target):
+    print "%d flows in %d slots: %.2f%% of flows collide, %d slots keep it under %.2f%%" % (
+        flows, slots, 100 * collisionRate(flows, slots),
+        requiredSlots(flows, target), 100 * target)
+
+def main(topology_file, gap, target):
+    fabric = FabricInventory(topology_file)
+    p4info_helper = loadP4InfoHelper(PROGRAMS['tor']['p4info'])
+
+    try:
+        connections = fabric.connect()
+        for tor in fabric.tors():
+            state = readFlowletState(connections[tor.name], p4info_helper, gap)
+            print '\n----- Flowlet table of %s -----' % tor.name
+            print "%d of %d slots occupied, %d lookups, %d new flowlets, %d collisions" % (
+                state['occupied'], state['slots'], state['lookups'], state['new'],
+                state['collisions'])
+            if state['lookups']:
+                print "measured collision rate: %.2f%% of lookups" % (
+                    100.0 * state['collisions'] / state['lookups'])
+            flows = flowsFromOccupancy(state['occupied'], state['slots'])
+            if math.isinf(flows):
+                print "every slot is occupied, the table is too small to estimate the flow count"
+            else:
+                printSizing(int(round(flows)), state['slots'], target)
+    except KeyboardInterrupt:
+        print " Shutting down."
+    except grpc.RpcError as e:
+        printGrpcError(e)
+
+    ShutdownAllSwitchConnections()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Flowlet table collision report')
+    parser.add_argument('--topology', help='topology file describing the fabric',
+                        type=str, action="store", required=False,
+                        default='topology.json')
+    parser.add_argument('--gap', help='flowlet gap the ToRs were built with, in micro seconds',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_FLOWLET_GAP)
+    parser.add_argument('--target', help='acceptable fraction of colliding flows',
+                        type=float, action="store", required=False,
+                        default=0.01)
+    parser.add_argument('--flows', help='size the table for this many concurrent flows '
+                        'instead of reading the switches',
+                        type=int, action="store", required=False)
+    parser.add_argument('--slots', help='flowlet table size to evaluate with --flows',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_FLOWLET_SLOTS)
+    args = parser.parse_args()
+
+    if args.flows is not None:
+        printSizing(args.flows, args.slots, args.target)
+        sys.exit(0)
+    main(args.topology, args.gap, args.target)
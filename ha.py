@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import grpc
+from google.rpc import code_pb2
+from p4.v1 import p4runtime_pb2
+
+from metrics import TAKEOVER_TIME
+from p4runtime_lib.error_utils import printGrpcError
+from profiler import PROFILER
+from provision import DEFAULT_BATCH_SIZE, buildTableEntries, pipelineCookie
+from reconcile import syncSwitch
+
+
+def sendArbitration(sw, election_id):
+    """
+    Sends a MasterArbitrationUpdate with the given election id on the stream
+    of the switch, without waiting for the answer: the switch answers on the
+    stream, and again whenever its primary changes.
+    """
+    sw.election_id = election_id
+    request = p4runtime_pb2.StreamMessageRequest()
+    request.arbitration.device_id = sw.device_id
+    request.arbitration.election_id.high = election_id >> 64
+    request.arbitration.election_id.low = election_id & ((1 << 64) - 1)
+    sw.requests_stream.put(request)
+
+
+class HaController(object):
+    """
+    Keeps the fabric provisioned as one of several controller instances,
+    each arbitrating with its own election id. Every switch makes the
+    connected controller with the highest election id its primary and tells
+    all the controllers whenever that changes, so a standby learns that the
+    primary is gone from the switches themselves.
+
+    A standby keeps a warm mirror of every switch: the TableEntry protobufs
+    of its desired state and the cookie of its pipeline. Once a switch
+    promotes it, the takeover is a cookie check, one Read and the writes of
+    whatever differs; the pipeline the previous primary installed is kept.
+    The switches are taken over concurrently, and the time from promotion to
+    a switch in sync is reported and exported as TAKEOVER_TIME.
+
+    The arbitration answers come in on the switch streams, which must be
+    read by a StreamDispatcher calling onArbitration.
+
+    The controllers writing at run time, such as the WeightController, only
+    write to the switches isPrimary is True for, and are told of every
+    switch taken over through on_primary. The tables they fill, other than
+    those of the runtime entries, are not in the takeover diff; keep_tables
+    leaves the entries of runtime tables they change as they are.
+    """
+
+    def __init__(self, jobs, election_id, batch_size=DEFAULT_BATCH_SIZE, keep_tables=()):
+        """
+        :param jobs: list of (sw, p4info_helper, bmv2_file_path, table_entries)
+        :param election_id: election id of this controller instance
+        :param batch_size: maximum number of updates per WriteRequest
+        :param keep_tables: names of the tables whose entries on the switches
+                            are kept on a takeover, only the missing ones
+                            being inserted, e.g. the output tags the
+                            HealthMonitor moved
+        """
+        self.jobs = jobs
+        self.election_id = election_id
+        self.batch_size = batch_size
+        self.keep_tables = keep_tables
+        self.mirror = {}  # switch name -> (sw, p4info_helper, bmv2 file, entries, cookie, kept)
+        self.primary = {}  # switch name -> True if this instance is its primary
+        self.ready = set()  # switch names this instance is the primary of and synced
+        self.takeovers = []  # (switch name, seconds)
+        self.on_primary = []  # called with the connection of every switch once in sync
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(len(jobs), 1))
+
+    def warm(self):
+        """
+        Builds the desired state of every switch ahead of any takeover.
+        """
+        for sw, p4info_helper, bmv2_file_path, table_entries in self.jobs:
+            desired = buildTableEntries(p4info_helper, table_entries, sw.name)
+            cookie = pipelineCookie(p4info_helper.p4info, bmv2_file_path)
+            kept = set(p4info_helper.get_tables_id(name) for name in self.keep_tables)
+            self.mirror[sw.name] = (sw, p4info_helper, bmv2_file_path, desired, cookie, kept)
+
+    def start(self):
+        self.warm()
+        for sw, _, _, _ in self.jobs:
+            sendArbitration(sw, self.election_id)
+        print "Arbitrating for %d switches with election id %d" % (
+            len(self.jobs), self.election_id)
+
+    def onArbitration(self, name, arbitration):
+        """
+        Handler of the arbitration updates of the switch streams.
+        """
+        is_primary = arbitration.status.code == code_pb2.OK
+        primary_id = (arbitration.election_id.high << 64) | arbitration.election_id.low
+        with self.lock:
+            was_primary = self.primary.get(name)
+            self.primary[name] = is_primary
+            if not is_primary:
+                self.ready.discard(name)
+        if is_primary and not was_primary:
+            # A switch that had another primary is a takeover
+            self.executor.submit(self._sync, name, time(), was_primary is False)
+        elif not is_primary and was_primary is not False:
+            print "%s: standing by, controller %d is primary" % (name, primary_id)
+
+    def _sync(self, name, promoted, takeover):
+        sw, p4info_helper, bmv2_file_path, desired, cookie, kept = self.mirror[name]
+        try:
+            updates, pushed = syncSwitch(sw, p4info_helper, bmv2_file_path, desired,
+                                         self.batch_size, cookie, keep_table_ids=kept)
+            for hook in self.on_primary:
+                hook(sw)
+        except grpc.RpcError as e:
+            # e.g. a controller with a higher election id came back meanwhile
+            printGrpcError(e)
+            return
+        with self.lock:
+            if self.primary.get(name):
+                self.ready.add(name)
+        elapsed = time() - promoted
+        PROFILER.record('takeover' if takeover else 'switch', name, elapsed)
+        if takeover:
+            TAKEOVER_TIME.observe(elapsed, name)
+            with self.lock:
+                self.takeovers.append((name, elapsed))
+        print "%s: %s as primary, %d of %d entries changed, pipeline %s, %.3f s" % (
+            name, 'took over' if takeover else 'provisioned', len(updates), len(desired),
+            'pushed' if pushed else 'kept', elapsed)
+        sys.stdout.flush()
+
+    def isPrimary(self, name):
+        """
+        :return: True once this instance is the primary of the switch and
+                 brought it in sync
+        """
+        with self.lock:
+            return name in self.ready
+
+    def report(self):
+        """
+        Prints the number of switches taken over and the slowest takeover.
+        """
+        with self.lock:
+            takeovers = list(self.takeovers)
+        if takeovers:
+            print "Took over %d switches, %.3f s at most" % (
+                len(takeovers), max(seconds for _, seconds in takeovers))
+
+    def stop(self):
+        self.executor.shutdown(wait=True)
+        self.report()
@@ -0,0 +1,412 @@
+#!/usr/bin/env python2
+import math
+import sys
+import threading
+from time import time
+
+import grpc
+import numpy
+from p4.v1 import p4runtime_pb2
+
+from metrics import REROUTE_TIME
+from p4runtime_lib.error_utils import printGrpcError
+from provision import buildTableEntry, writeUpdates
+from telemetry import readRegisters, registerIds
+from weights import PathWeights
+
+# Table and action mapping an output tag to a port, in both programs
+TAG_TABLE = 'MyIngress.output_tag_id_exact'
+TAG_ACTION = 'MyIngress.tag_forward'
+
+# Weight levels of utilization_reg, MAX_UTILIZATION in load_balance.p4
+MAX_UTILIZATION = 8
+
+DEFAULT_INTERVAL = 0.01
+DEFAULT_RECOVERY = 2.0
+# Probe rounds without news of a path after which it is taken as dead
+STALE_ROUNDS = 3
+# A recovering path gets its weight back in this many steps
+RECOVERY_STEPS = MAX_UTILIZATION
+
+
+def interfaceState(switch, port):
+    """
+    Reads the operational state of the Mininet interface of a switch port.
+
+    :return: True if the port is up, False if down, None if unknown
+    """
+    try:
+        with open('/sys/class/net/%s-eth%d/operstate' % (switch, port), 'r') as state_file:
+            state = state_file.read().strip()
+    except IOError:
+        return None
+    if state == 'up':
+        return True
+    if state in ('down', 'lowerlayerdown', 'notpresent'):
+        return False
+    return None
+
+
+def _value(data):
+    # a P4Runtime bytestring as an integer
+    return int(data.encode('hex'), 16) if data else 0
+
+
+def tagPorts(table_entries):
+    """
+    :param table_entries: dict of switch name -> runtime entries
+    :return: dict of switch name -> output tag -> (port, runtime entry)
+    """
+    tags = {}
+    for name, entries in table_entries.iteritems():
+        for flow in entries:
+            if flow['table'] != TAG_TABLE or flow['action_name'] != TAG_ACTION:
+                continue
+            tag = flow['match']['meta.output_tag_id']
+            tag = tag[0] if isinstance(tag, list) else tag
+            tags.setdefault(name, {})[tag] = (flow['action_params']['port'], flow)
+    return tags
+
+
+class HealthMonitor(object):
+    """
+    Takes the dead paths out of the WECMP selection of the ToRs.
+
+    A path is dead when a port on it is down, as told by port_state, or, with
+    a ProbeScheduler, when its probes stopped coming back for STALE_ROUNDS
+    rounds. On every change the monitor rewrites, in one batch per switch:
+
+    - the weight of the dead paths on their ToR, utilization_reg set to 0,
+      or the weights of the WeightController in controller weights mode;
+    - output_tag_id_exact wherever a tag leads to a dead port, pointing the
+      tag at a live port of the same switch, so the flowlets already on the
+      dead path are moved without waiting for their flowlet to end.
+
+    A path whose ports are up again gets its tags back at once and its
+    weight back in RECOVERY_STEPS steps over the recovery time, so it is not
+    flooded with new flowlets. With utilization_reg, the steps only cap the
+    value the data plane measured, and once they end the register is left
+    to the data plane. The time from detection to rewritten
+    switches is printed and exported as REROUTE_TIME.
+    """
+
+    def __init__(self, fabric, connections, p4info_helpers, table_entries,
+                 interval=DEFAULT_INTERVAL, recovery=DEFAULT_RECOVERY, probes=None,
+                 weight_controller=None, port_state=interfaceState, is_primary=None):
+        """
+        :param fabric: the FabricInventory
+        :param connections: dict of switch name -> switch connection
+        :param p4info_helpers: dict of role -> P4Info helper
+        :param table_entries: dict of switch name -> runtime entries installed
+        :param interval: seconds between two checks of the ports
+        :param recovery: seconds for a recovered path to get its full weight
+        :param probes: a running ProbeScheduler, to also find the paths whose
+                       probes are lost
+        :param weight_controller: the WeightController in controller weights
+                                  mode, None if the ToRs use utilization_reg
+        :param port_state: function of (switch name, port) returning True if
+                           the port is up, False if down, None if unknown
+        :param is_primary: function of a switch name returning True if the
+                           monitor may write to it, e.g. HaController.isPrimary;
+                           None to write to every switch
+        """
+        self.fabric = fabric
+        self.connections = connections
+        self.p4info_helpers = p4info_helpers
+        self.interval = interval
+        self.recovery = recovery
+        self.probes = probes
+        self.weight_controller = weight_controller
+        self.port_state = port_state
+        self.is_primary = is_primary
+
+        path_weights = PathWeights(fabric)
+        self.paths = path_weights.rows
+        self.path_index = dict((path, i) for i, path in enumerate(self.paths))
+        self.links = path_weights.links
+        self.link_index = dict((link, i) for i, link in enumerate(self.links))
+        self.incidence = path_weights.incidence.astype(bool)
+        self.ports = [(sw.name, port) for sw in fabric
+                      for port in sorted(fabric.ports.get(sw.name, {}))]
+        self.tags = tagPorts(table_entries)
+        self.utilization_id = registerIds(p4info_helpers['tor'], ['utilization_reg']).get(
+            'utilization_reg')
+
+        self.down = set()  # (switch, port) of the ports down
+        self.stale = set()  # (tor, path id) whose probes are lost
+        self.seen = set()  # (tor, path id) a probe came back on once
+        self.remapped = {}  # (switch, tag) -> port it was pointed at instead
+        self.dead_since = {}  # (tor, path id) -> time it died
+        self.recovering = {}  # (tor, path id) -> time it came back
+        self.steps = {}  # (tor, path id) -> weight share last given while recovering
+        self.zeroed = set()  # (tor, path id) dead with utilization_reg written to 0
+        self.levels = {}  # (tor, path id) -> recovery step last applied to utilization_reg
+        self.failed = False  # a write of the last check failed
+        self.next_staleness = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def deadHops(self):
+        # both directions of every link with a port down
+        hops = set(self.down)
+        for switch, port in self.down:
+            peer, peer_port = self.fabric.ports[switch][port]
+            if peer_port is not None:
+                hops.add((peer, peer_port))
+        return hops
+
+    def deadPaths(self):
+        """
+        :return: set of (tor, path id) that cross a dead link or lost their probes
+        """
+        dead = set(self.stale)
+        columns = [self.link_index[hop] for hop in self.deadHops() if hop in self.link_index]
+        if columns:
+            for row in numpy.nonzero(self.incidence[:, columns].any(axis=1))[0]:
+                dead.add(self.paths[row])
+        return dead
+
+    def factor(self, path, now=None):
+        """
+        :return: share of its weight the path is given, 0 if dead, growing
+                 by steps while it recovers
+        """
+        if path in self.dead_since:
+            return 0.0
+        since = self.recovering.get(path)
+        if since is None:
+            return 1.0
+        now = time() if now is None else now
+        step = int(math.floor(RECOVERY_STEPS * (now - since) / self.recovery)) if self.recovery \
+            else RECOVERY_STEPS
+        return min(step, RECOVERY_STEPS) / float(RECOVERY_STEPS)
+
+    def scale(self, tor, weights):
+        """
+        Applies the health of the paths to the weights of a ToR, called by
+        the WeightController before it pushes them.
+        """
+        factors = numpy.array([self.factor((tor, path_id)) for path_id in range(len(weights))])
+        return weights * factors
+
+    def _tagUpdates(self, dead_hops, pending):
+        # tags to point elsewhere, or back to their port, per switch; the
+        # new targets go to pending, to be kept once the write went through
+        updates = {}
+        for switch, tags in self.tags.iteritems():
+            sw = self.fabric[switch]
+            live = sorted(set(port for port, _ in tags.itervalues()
+                              if (switch, port) not in dead_hops))
+            for tag, (port, flow) in sorted(tags.iteritems()):
+                current = self.remapped.get((switch, tag), port)
+                if (switch, port) in dead_hops and live:
+                    target = live[tag % len(live)]
+                else:
+                    target = port
+                if target == current:
+                    continue
+                pending.setdefault(switch, []).append(
+                    (self.remapped, (switch, tag), None if target == port else target))
+                entry = dict(flow, action_params=dict(flow['action_params'], port=target))
+                updates.setdefault(switch, []).append(
+                    (p4runtime_pb2.Update.MODIFY,
+                     buildTableEntry(self.p4info_helpers[sw.role], entry)))
+        return updates
+
+    def _registerEntry(self, path_id, value):
+        entry = p4runtime_pb2.RegisterEntry()
+        entry.register_id = self.utilization_id
+        entry.index.index = path_id
+        entry.data.bitstring = chr(value)
+        return (p4runtime_pb2.Update.MODIFY, entry)
+
+    def _weightUpdates(self, now, pending):
+        # utilization_reg of the dead paths not yet set to 0, and of the
+        # recovering paths a step is due for, per ToR. A recovering path is
+        # only ever lowered to its step, never raised above what the data
+        # plane measured, which may be a congested path; once the steps end
+        # the data plane owns the register again. What was applied goes to
+        # pending, to be kept once the write went through.
+        updates = {}
+        if self.utilization_id is None:
+            return updates
+        for path in sorted(set(self.dead_since) - self.zeroed):
+            updates.setdefault(path[0], []).append(self._registerEntry(path[1], 0))
+            pending.setdefault(path[0], []).append((self.zeroed, path, True))
+
+        due = {}
+        for path in self.recovering:
+            level = min(int(round(self.factor(path, now) * RECOVERY_STEPS)), RECOVERY_STEPS)
+            if level != self.levels.get(path):
+                due[path] = level
+        for tor in sorted(set(tor for tor, _ in due if self._writable(tor))):
+            measured = readRegisters(self.connections[tor],
+                                     {'utilization_reg': self.utilization_id})
+            for path, level in sorted(due.iteritems()):
+                if path[0] != tor:
+                    continue
+                value = level * MAX_UTILIZATION // RECOVERY_STEPS
+                if level >= RECOVERY_STEPS:
+                    pending.setdefault(tor, []).append((self.recovering, path, None))
+                    pending[tor].append((self.levels, path, None))
+                    continue
+                if measured.get(('utilization_reg', path[1]), 0) > value:
+                    updates.setdefault(tor, []).append(self._registerEntry(path[1], value))
+                pending.setdefault(tor, []).append((self.levels, path, level))
+        return updates
+
+    def _writable(self, switch):
+        return self.is_primary is None or self.is_primary(switch)
+
+    def resync(self, sw):
+        """
+        Reads back the output tags of a switch another controller may have
+        written, and has the dead paths of a ToR set to 0 again, e.g. once
+        this instance took over the switch. Called with the connection.
+        """
+        tags = self.tags.get(sw.name, {})
+        role = self.fabric[sw.name].role
+        helper = self.p4info_helpers[role]
+        request = p4runtime_pb2.ReadRequest()
+        request.device_id = sw.device_id
+        request.entities.add().table_entry.table_id = helper.get_tables_id(TAG_TABLE)
+        ports = {}
+        for response in sw.client_stub.Read(request):
+            for entity in response.entities:
+                table_entry = entity.table_entry
+                params = table_entry.action.action.params
+                if len(table_entry.match) != 1 or not params:
+                    continue
+                ports[_value(table_entry.match[0].exact.value)] = _value(params[0].value)
+        with self.lock:
+            for tag, (port, _) in tags.iteritems():
+                if ports.get(tag, port) != port:
+                    self.remapped[(sw.name, tag)] = ports[tag]
+                else:
+                    self.remapped.pop((sw.name, tag), None)
+            self.zeroed.difference_update([path for path in self.zeroed if path[0] == sw.name])
+            for path in [path for path in self.levels if path[0] == sw.name]:
+                del self.levels[path]
+            # compare the tags at the next check
+            self.failed = True
+
+    def _apply(self, changes):
+        # keeps the state written to a switch: (dict, key, value), None
+        # removing the key, or (set, key, True)
+        for state, key, value in changes:
+            if isinstance(state, set):
+                state.add(key)
+            elif value is None:
+                state.pop(key, None)
+            else:
+                state[key] = value
+
+    def _checkStaleness(self, now):
+        if self.probes is None or now < self.next_staleness:
+            return
+        self.next_staleness = now + self.probes.interval
+        stale = set()
+        for path, age in self.probes.staleness().iteritems():
+            if path not in self.path_index:
+                continue
+            if age <= STALE_ROUNDS * self.probes.interval:
+                self.seen.add(path)
+            elif path in self.seen:
+                stale.add(path)
+        self.stale = stale
+
+    def check(self):
+        """
+        Reads the ports, and the probes when due, and rewrites the switches
+        if a path died or came back.
+
+        :return: list of the events handled, as strings
+        """
+        with self.lock:
+            now = time()
+            down = set(port for port in self.ports if self.port_state(*port) is False)
+            self._checkStaleness(now)
+            events = ['%s port %d down' % port for port in sorted(down - self.down)]
+            events += ['%s port %d up' % port for port in sorted(self.down - down)]
+            self.down = down
+
+            dead = self.deadPaths()
+            died = dead - set(self.dead_since)
+            revived = set(self.dead_since) - dead
+            for path in died:
+                self.dead_since[path] = now
+                self.recovering.pop(path, None)
+                self.levels.pop(path, None)
+            for path in revived:
+                del self.dead_since[path]
+                self.zeroed.discard(path)
+                self.recovering[path] = now
+            events += ['path %d of %s dead' % (path_id, tor) for tor, path_id in sorted(died)]
+            events += ['path %d of %s recovering' % (path_id, tor)
+                       for tor, path_id in sorted(revived)]
+
+            # the tags are compared with what was written again after a write
+            # failed, so the rewrite is sent again
+            pending = {}
+            updates = self._tagUpdates(self.deadHops(), pending) \
+                if (died or revived or self.failed) else {}
+            if self.weight_controller is None:
+                for switch, weight_updates in self._weightUpdates(now, pending).iteritems():
+                    # the weights first, so no new flowlet picks a dead path
+                    updates[switch] = weight_updates + updates.get(switch, [])
+            written = 0
+            self.failed = False
+            for switch in sorted(set(updates) | set(pending)):
+                if not self._writable(switch):
+                    # written once this instance becomes its primary
+                    continue
+                switch_updates = updates.get(switch)
+                if switch_updates:
+                    try:
+                        writeUpdates(self.connections[switch], switch_updates,
+                                     batch_size=len(switch_updates))
+                    except grpc.RpcError as e:
+                        # the state is left as it was, the next check retries
+                        printGrpcError(e)
+                        self.failed = True
+                        continue
+                    written += 1
+                self._apply(pending.get(switch, []))
+            if self.weight_controller is not None:
+                # the weights are pushed again only when a recovery step is due
+                steps = dict((path, self.factor(path, now)) for path in self.recovering)
+                if died or revived or steps != self.steps:
+                    self.weight_controller.update()
+                for path in [p for p, factor in steps.iteritems() if factor >= 1]:
+                    del self.recovering[path]
+                    del steps[path]
+                self.steps = steps
+
+            if died or revived:
+                elapsed = time() - now
+                REROUTE_TIME.observe(elapsed, 'failure' if died else 'recovery')
+                print "%s: %d switches rewritten in %.1f ms" % (
+                    ', '.join(events), written, elapsed * 1000)
+            return events
+
+    def _run(self):
+        next_check = time()
+        while not self.stopped.is_set():
+            try:
+                self.check()
+            except grpc.RpcError as e:
+                printGrpcError(e)
+            sys.stdout.flush()
+            next_check = max(next_check + self.interval, time())
+            self.stopped.wait(next_check - time())
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='health')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -7,6 +7,18 @@ const bit<16> TYPE_WECMP = 0x1234;
 const bit<16> TYPE_IPV4 = 0x800;
 
 #define MAX_PORTS 3
+
+// Rate thresholds of the 8 weight levels, in bytes per micro second <<
+// QUANTIZER_SHIFT, set per ingress port in port_quantizer by the controller
+// from the link speeds (see quantizer.py); the default levels split 8 Mbps
+#define QUANTIZER_SHIFT 16
+#define QUANTIZER_STEP 8192
+
+// bits of the path id consumed by every hop, see routes.py
+#ifndef TAG_BITS
+#define TAG_BITS 1
+#endif
+#define TAG_MASK ((1 << TAG_BITS) - 1)
 /*************************************************************************
 *********************** H E A D E R S  ***********************************
 *************************************************************************/
@@ -58,10 +70,22 @@ header wecmp_t{
     bit<48> bytes;
 }
 
+struct quantizer_t {
+    bit<32> level_1;
+    bit<32> level_2;
+    bit<32> level_3;
+    bit<32> level_4;
+    bit<32> level_5;
+    bit<32> level_6;
+    bit<32> level_7;
+    bit<32> level_8;
+}
+
 struct metadata {
     bit<8> tag_id;
     bit<8> position;
     bit<8> output_tag_id;
+    quantizer_t quantizer;
 }
 
 struct headers {
@@ -177,11 +201,11 @@ control MyIngress(inout headers hdr,
 
     action header_process(){
         // get path id
-        hdr.wecmp.selected_path_id = hdr.wecmp.selected_path_id >> 1;
-        meta.output_tag_id = hdr.wecmp.selected_path_id & 1;
+        hdr.wecmp.selected_path_id = hdr.wecmp.selected_path_id >> TAG_BITS;
+        meta.output_tag_id = hdr.wecmp.selected_path_id & TAG_MASK;
 
         // record tag path id
-        hdr.wecmp.tag_path_id = hdr.wecmp.tag_path_id << 1;
+        hdr.wecmp.tag_path_id = hdr.wecmp.tag_path_id << TAG_BITS;
         hdr.wecmp.tag_path_id = hdr.wecmp.tag_path_id | meta.tag_id;
 
         // set utlization
@@ -261,6 +285,31 @@ control MyEgress(inout headers hdr,
     register<bit<48>>(MAX_PORTS) byte_cnt_reg;
     register<time_t>(MAX_PORTS) last_time_reg;
 
+    // rate thresholds of the weight levels of every ingress port
+    action set_quantizer(bit<32> level_1, bit<32> level_2, bit<32> level_3, bit<32> level_4,
+                          bit<32> level_5, bit<32> level_6, bit<32> level_7, bit<32> level_8){
+        meta.quantizer.level_1 = level_1;
+        meta.quantizer.level_2 = level_2;
+        meta.quantizer.level_3 = level_3;
+        meta.quantizer.level_4 = level_4;
+        meta.quantizer.level_5 = level_5;
+        meta.quantizer.level_6 = level_6;
+        meta.quantizer.level_7 = level_7;
+        meta.quantizer.level_8 = level_8;
+    }
+    table port_quantizer {
+        key = {
+            standard_metadata.ingress_port: exact;
+        }
+        actions = {
+            set_quantizer;
+        }
+        size = 512;
+        default_action = set_quantizer(1 * QUANTIZER_STEP, 2 * QUANTIZER_STEP, 3 * QUANTIZER_STEP,
+                                        4 * QUANTIZER_STEP, 5 * QUANTIZER_STEP, 6 * QUANTIZER_STEP,
+                                        7 * QUANTIZER_STEP, 8 * QUANTIZER_STEP);
+    }
+
     apply {
         bit<48> byte_cnt;
         bit<48> ingress_byte;
@@ -275,6 +324,8 @@ control MyEgress(inout headers hdr,
 
         // if there is wecmp header, get utilization info
         if(hdr.wecmp.isValid()){
+            port_quantizer.apply();
+
             // read byte count of input port, get reset to 0
 	        byte_cnt_reg.read(ingress_byte, (bit<32>)standard_metadata.ingress_port);
 	        byte_cnt_reg.write((bit<32>)standard_metadata.ingress_port, 0);
@@ -285,66 +336,38 @@ control MyEgress(inout headers hdr,
 	        last_time_reg.write((bit<32>)standard_metadata.ingress_port, cur_time);
             duration = cur_time - last_time; // in micro second
             
-            // bandwidth = 1Mbps, that is 1bit / 1ms will be the top rank(weight = 0)
-            // ingress_byte is in byte unit, so << 3
-            // we need 8 rank, so << more 3 bit, or we can >> duration 3 bit
-            ingress_byte = ingress_byte << 3;
-
-            if(duration > ingress_byte){
-                weight = 8;
-                duration = 0; // let it not to grater than ingress_byte afterward
-            }
-            else{
-                ingress_byte = ingress_byte - duration;
+            // one weight level lost for every rate threshold of the ingress
+            // port reached: 8 on an idle link, 0 past the last threshold
+            bit<64> scaled_bytes = ((bit<64>)ingress_byte) << QUANTIZER_SHIFT;
+            // the products stay within 64 bits for durations of up to 71 minutes
+            bit<64> elapsed = (bit<64>)duration;
+            if(duration > 0xFFFFFFFF){
+                elapsed = 0xFFFFFFFF;
             }
-            if(duration > ingress_byte){
+            weight = 8;
+            if(scaled_bytes >= (bit<64>)meta.quantizer.level_1 * elapsed){
                 weight = 7;
-                duration = 0; // let it not to grater than ingress_byte afterward
             }
-            else{
-                ingress_byte = ingress_byte - duration;
-            }
-            if(duration > ingress_byte){
+            if(scaled_bytes >= (bit<64>)meta.quantizer.level_2 * elapsed){
                 weight = 6;
-                duration = 0; // let it not to grater than ingress_byte afterward
-            }
-            else{
-                ingress_byte = ingress_byte - duration;
             }
-            if(duration > ingress_byte){
+            if(scaled_bytes >= (bit<64>)meta.quantizer.level_3 * elapsed){
                 weight = 5;
-                duration = 0; // let it not to grater than ingress_byte afterward
             }
-            else{
-                ingress_byte = ingress_byte - duration;
-            }
-            if(duration > ingress_byte){
+            if(scaled_bytes >= (bit<64>)meta.quantizer.level_4 * elapsed){
                 weight = 4;
-                duration = 0; // let it not to grater than ingress_byte afterward
-            }
-            else{
-                ingress_byte = ingress_byte - duration;
             }
-            if(duration > ingress_byte){
+            if(scaled_bytes >= (bit<64>)meta.quantizer.level_5 * elapsed){
                 weight = 3;
-                duration = 0; // let it not to grater than ingress_byte afterward
             }
-            else{
-                ingress_byte = ingress_byte - duration;
-            }
-            if(duration > ingress_byte){
+            if(scaled_bytes >= (bit<64>)meta.quantizer.level_6 * elapsed){
                 weight = 2;
-                duration = 0; // let it not to grater than ingress_byte afterward
-            }
-            else{
-                ingress_byte = ingress_byte - duration;
             }
-            if(duration > ingress_byte){
+            if(scaled_bytes >= (bit<64>)meta.quantizer.level_7 * elapsed){
                 weight = 1;
-                duration = 0; // let it not to grater than ingress_byte afterward
             }
-            else{
-                ingress_byte = ingress_byte - duration;
+            if(scaled_bytes >= (bit<64>)meta.quantizer.level_8 * elapsed){
+                weight = 0;
             }
 
             // more larger the weight is, the utilization will be more less. 
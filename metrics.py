@@ -0,0 +1,196 @@
+#!/usr/bin/env python2
+import sys
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from time import time
+
+DEFAULT_PORT = 9180
+DEFAULT_INTERVAL = 1.0
+
+# Registers the exporter needs sampled, see MetricsExporter
+EXPORTED_REGISTERS = ['utilization_reg', 'byte_cnt_reg', 'path_id_reg', 'last_time_reg']
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in zip(names, values))
+
+
+class Histogram(object):
+    """
+    A Prometheus histogram, cheap enough to observe on every RPC: observing
+    only bumps counters under a lock, rendering is left to the exporter.
+    """
+
+    def __init__(self, name, description, buckets, label_names=()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        """
+        :return: the lines of the histogram in the Prometheus text format
+        """
+        with self.lock:
+            series = [(labels, list(values)) for labels, values in self.series.iteritems()]
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % self.name]
+        names = self.label_names + ('le',)
+        for labels, values in sorted(series):
+            for bound, count in zip(self.buckets, values):
+                lines.append('%s_bucket%s %d' % (self.name, _labels(names, labels + (bound,)),
+                                                 count))
+            lines.append('%s_bucket%s %d' % (self.name, _labels(names, labels + ('+Inf',)),
+                                             values[-1]))
+            lines.append('%s_sum%s %f' % (self.name, _labels(self.label_names, labels),
+                                          values[-2]))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.label_names, labels),
+                                            values[-1]))
+        return lines
+
+
+# Observed by the code issuing the RPCs
+RPC_LATENCY = Histogram('wecmp_p4runtime_rpc_duration_seconds',
+                        'Duration of the P4Runtime RPCs sent by the controller',
+                        LATENCY_BUCKETS, ('switch', 'rpc'))
+WRITE_BATCH_SIZE = Histogram('wecmp_p4runtime_write_updates',
+                             'Updates packed into each P4Runtime WriteRequest',
+                             BATCH_BUCKETS, ('switch',))
+# Observed by the standby controllers taking a switch over, see ha.py
+TAKEOVER_TIME = Histogram('wecmp_controller_takeover_seconds',
+                          'Time from the promotion of a standby controller by a switch to '
+                          'the switch being in sync',
+                          LATENCY_BUCKETS, ('switch',))
+# Observed by the health monitor reacting to a port going down or up, see health.py
+REROUTE_TIME = Histogram('wecmp_reroute_seconds',
+                         'Time from the detection of a path failure or recovery to the '
+                         'switches being rewritten',
+                         LATENCY_BUCKETS, ('event',))
+
+
+def renderGauge(name, description, label_names, samples):
+    """
+    :param samples: list of (label values, value)
+    :return: the lines of the gauge in the Prometheus text format
+    """
+    lines = ['# HELP %s %s' % (name, description),
+             '# TYPE %s gauge' % name]
+    for labels, value in sorted(samples):
+        lines.append('%s%s %s' % (name, _labels(label_names, labels), value))
+    return lines
+
+
+class MetricsExporter(object):
+    """
+    Serves the state of the fabric on http://<address>:<port>/metrics.
+
+    The page is rebuilt at a fixed interval from the samples already held by
+    a TelemetryPoller and swapped in whole, so a scrape only sends a cached
+    string and never reaches the switches.
+    """
+
+    def __init__(self, poller, port=DEFAULT_PORT, interval=DEFAULT_INTERVAL, address=''):
+        """
+        :param poller: a TelemetryPoller sampling EXPORTED_REGISTERS
+        :param port: TCP port of the HTTP server
+        :param interval: seconds between two snapshots of the metrics
+        """
+        self.poller = poller
+        self.interval = interval
+        self.snapshot = ''
+        self.stopped = threading.Event()
+        self.thread = None
+
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.snapshot
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+
+    def collect(self):
+        """
+        :return: the metrics page, built from the last polled samples
+        """
+        lines = renderGauge('wecmp_path_utilization',
+                            'Last max_utilization seen on each path (utilization_reg)',
+                            ('switch', 'path'), self.poller.latest('utilization_reg').items())
+        lines += renderGauge('wecmp_port_bytes',
+                             'Bytes counted on each port since its last reset (byte_cnt_reg)',
+                             ('switch', 'port'), self.poller.latest('byte_cnt_reg').items())
+
+        # Flowlet slots per path, counting only the slots that saw a packet
+        last_times = self.poller.latest('last_time_reg')
+        flowlets = {}
+        for (switch_name, index), path_id in self.poller.latest('path_id_reg').iteritems():
+            if last_times.get((switch_name, index)):
+                key = (switch_name, int(path_id))
+                flowlets[key] = flowlets.get(key, 0) + 1
+        lines += renderGauge('wecmp_flowlet_slots',
+                             'Used flowlet table slots pinned to each path',
+                             ('switch', 'path'), flowlets.items())
+
+        lines += RPC_LATENCY.render()
+        lines += WRITE_BATCH_SIZE.render()
+        lines += TAKEOVER_TIME.render()
+        lines += REROUTE_TIME.render()
+        lines += renderGauge('wecmp_metrics_snapshot_timestamp_seconds',
+                             'When this page was built', (), [((), '%f' % time())])
+        return '\n'.join(lines) + '\n'
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.snapshot = self.collect()
+            except Exception as e:
+                print >> sys.stderr, "metrics: %s" % e
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+        server_thread = threading.Thread(target=self.server.serve_forever, name='metrics-http')
+        server_thread.daemon = True
+        server_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
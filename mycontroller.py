@@ -3,7 +3,6 @@ import argparse
 import grpc
 import os
 import sys
-import json
 from time import sleep
 
 # Import P4Runtime lib from parent utils dir
@@ -15,65 +14,28 @@ import p4runtime_lib.bmv2
 from p4runtime_lib.error_utils import printGrpcError
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
 import p4runtime_lib.helper
-
-def writeTunnelRules(p4info_helper, switch, id, tunnel_id,
-                     dst_eth_addr, dst_ip_addr):
-    # configure
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.switch_config_params",
-        action_name="MyIngress.set_config_parameters",
-        action_params={
-            "id": 1,
-        })
-    ingress_sw.WriteTableEntry(table_entry)
-    print "Installed ingress tunnel rule on %s" % switch.name
-
-    # tag forward
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.output_tag_id_exact",
-        match_fields={
-            "meta.output_tag_id": 0
-        },
-        action_name="MyIngress.tag_forward",
-        action_params={
-            "port": 1
-        })
-    egress_sw.WriteTableEntry(table_entry)
-    print "Installed egress tunnel rule on %s" % switch.name
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.output_tag_id_exact",
-        match_fields={
-            "meta.output_tag_id": 1
-        },
-        action_name="MyIngress.tag_forward",
-        action_params={
-            "port": 2
-        })
-    egress_sw.WriteTableEntry(table_entry)
-    print "Installed egress tunnel rule on %s" % switch.name
-
-    # ipv4 lpm
-
-def _byteify(data, ignore_dicts=False):
-    # if this is a unicode string, return its string representation
-    if isinstance(data, unicode):
-        return data.encode('utf-8')
-    # if this is a list of values, return list of byteified values
-    if isinstance(data, list):
-        return [_byteify(item, ignore_dicts=True) for item in data]
-    # if this is a dictionary, return dictionary of byteified keys and values
-    # but only if we haven't already byteified it
-    if isinstance(data, dict) and not ignore_dicts:
-        return {
-            _byteify(key, ignore_dicts=True): _byteify(value, ignore_dicts=True)
-            for key, value in data.iteritems()
-        }
-    # if it's anything else, return it in its original form
-    return data
-
-def json_load_byteified(file_handle):
-    return _byteify(json.load(file_handle, object_hook=_byteify), ignore_dicts=True)
+from p4.v1 import p4runtime_pb2
+from fabric import FabricInventory, PROGRAMS
+from ha import HaController
+from health import (HealthMonitor, TAG_TABLE, DEFAULT_INTERVAL as DEFAULT_HEALTH_INTERVAL,
+                    DEFAULT_RECOVERY as DEFAULT_RECOVERY_TIME)
+from p4build import compilePrograms, loadP4InfoHelper, P4C_FLAGS
+from probes import (ProbeScheduler, probeFlags, switchIds,
+                    DEFAULT_INTERVAL as DEFAULT_PROBE_INTERVAL, DEFAULT_BUDGET as DEFAULT_PROBE_BUDGET)
+from profiler import PROFILER
+from provision import (provisionFabric, provisionSwitch, DEFAULT_BATCH_SIZE,
+                       DEFAULT_ENTRY_CACHE_SIZE, DEFAULT_MAX_IN_FLIGHT, DEFAULT_WRITE_RETRIES,
+                       ENTRY_CACHE)
+from quantizer import loadCalibration, quantizerEntries
+from reconcile import reconcileSwitch
+from routes import RouteCompiler, tagFlags
+from snapshot import loadSnapshot, saveSnapshot, snapshotKey, DEFAULT_SNAPSHOT
+from stream import (StreamDispatcher, PathChangeLog, digestId, enableDigest,
+                    PATH_CHANGE_DIGEST, PATH_CHANGE_DIGEST_FLAGS)
+from telemetry import TelemetryPoller
+from metrics import MetricsExporter, EXPORTED_REGISTERS, DEFAULT_PORT as DEFAULT_METRICS_PORT
+from flowlets import flowletFlags, DEFAULT_FLOWLET_SLOTS, DEFAULT_FLOWLET_GAP
+from weights import WeightController, CONTROLLER_WEIGHTS_FLAGS, ROUND_ROBIN_WEIGHTS_FLAGS
 
 def info(msg):
     print >> sys.stdout, ' - ' + msg
@@ -110,150 +72,193 @@ def insertTableEntry(sw, flow, p4info_helper):
 
     sw.WriteTableEntry(table_entry)
 
-def printCounter(p4info_helper, sw, counter_name, index):
-    """
-    Reads the specified counter at the specified index from the switch. In our
-    program, the index is the tunnel ID. If the index is 0, it will return all
-    values from the counter.
+def main(topology_file='topology.json', batch_size=DEFAULT_BATCH_SIZE, reconcile=False,
+         controller_weights=False, generate_routes=False, path_changes=False,
+         metrics_port=None, election_id=None, round_robin=False, probes=False,
+         probe_interval=DEFAULT_PROBE_INTERVAL, probe_budget=DEFAULT_PROBE_BUDGET,
+         quantizer_file=None, health=False, health_interval=DEFAULT_HEALTH_INTERVAL,
+         recovery_time=DEFAULT_RECOVERY_TIME, snapshot_file=None, snapshot_key=None,
+         snapshot=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+         write_retries=DEFAULT_WRITE_RETRIES):
+    # Derive the switches, their programs and runtime entries from the topology
+    fabric = FabricInventory(topology_file)
+    if snapshot is not None:
+        # Warm start: the P4Info, entries and compiled entries of the last run
+        with PROFILER.stage('snapshot'):
+            p4info_helpers = snapshot.p4InfoHelpers()
+            table_entries = snapshot.tableEntries(fabric, p4info_helpers)
+        print "Restored %d switches from %s" % (len(table_entries), snapshot_file)
+    else:
+        if generate_routes:
+            table_entries = RouteCompiler(fabric).compile()
+        else:
+            table_entries = fabric.loadRuntimeEntries()
 
-    :param p4info_helper: the P4Info helper
-    :param sw:  the switch connection
-    :param counter_name: the name of the counter from the P4 program
-    :param index: the counter index (in our case, the tunnel ID)
-    """
-    for response in sw.ReadCounters(p4info_helper.get_counters_id(counter_name), index):
-        for entity in response.entities:
-            counter = entity.counter_entry
-            print "%s %s %d: %d packets (%d bytes)" % (
-                sw.name, counter_name, index,
-                counter.data.packet_count, counter.data.byte_count
-            )
+        # Set the rate thresholds of the utilization weights from the link
+        # speeds, or from a calibration of quantizer.py
+        calibration = loadCalibration(quantizer_file) if quantizer_file else None
+        table_entries = dict(table_entries)
+        for name, entries in quantizerEntries(fabric, calibration).iteritems():
+            table_entries[name] = table_entries[name] + entries
 
-def main(p4info_file_path_sw, bmv2_file_path_sw, p4info_file_path_tor, bmv2_file_path_tor):
-    # Instantiate a P4Runtime helper from the p4info file
-    p4info_helper_sw = p4runtime_lib.helper.P4InfoHelper(p4info_file_path_sw)
-    p4info_helper_tor = p4runtime_lib.helper.P4InfoHelper(p4info_file_path_tor)
+        # Instantiate a P4Runtime helper from the p4info file of each role
+        p4info_helpers = {}
+        for role in fabric.roles():
+            p4info_helpers[role] = loadP4InfoHelper(PROGRAMS[role]['p4info'])
 
     try:
-        # Create a switch connection object for s1 and s2;
+        # Create a switch connection object for every switch;
         # this is backed by a P4Runtime gRPC connection.
         # Also, dump all P4Runtime messages sent to switch to given txt files.
-        s1 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s1',
-            address='127.0.0.1:50051',
-            device_id=0,
-            proto_dump_file='logs/s1-p4runtime-requests.txt')
-        s2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s2',
-            address='127.0.0.1:50052',
-            device_id=1,
-            proto_dump_file='logs/s2-p4runtime-requests.txt')
-        s3 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s3',
-            address='127.0.0.1:50053',
-            device_id=2,
-            proto_dump_file='logs/s3-p4runtime-requests.txt')
-        s4 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s4',
-            address='127.0.0.1:50054',
-            device_id=3,
-            proto_dump_file='logs/s4-p4runtime-requests.txt')
-        stor1 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='stor1',
-            address='127.0.0.1:50055',
-            device_id=4,
-            proto_dump_file='logs/stor1-p4runtime-requests.txt')
-        stor2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='stor2',
-            address='127.0.0.1:50056',
-            device_id=5,
-            proto_dump_file='logs/stor2-p4runtime-requests.txt')
+        connections = fabric.connect()
+
+        # Provision the switches concurrently with batched writes; in
+        # reconcile mode only the difference with the switch state is written
+        jobs = []
+        for sw in fabric:
+            info("Inserting %d table entries on %s..." % (len(table_entries[sw.name]), sw.name))
+            # Listing every entry costs more than building it, only do it
+            # when profiling
+            if PROFILER.enabled:
+                for entry in table_entries[sw.name]:
+                    with PROFILER.stage('format', sw.name):
+                        line = tableEntryToString(entry)
+                    info(line)
+            jobs.append((connections[sw.name], p4info_helpers[sw.role],
+                         sw.program['bmv2_json'], table_entries[sw.name]))
+
+        background = []
+        pollers = []
+        dispatcher = StreamDispatcher(connections)
+        # The run-time writers only write to the switches this instance is
+        # the primary of
+        is_primary = None
+        if election_id is None:
+            provisionFabric(jobs, batch_size=batch_size,
+                            switch_fn=reconcileSwitch if reconcile else provisionSwitch,
+                            max_in_flight=max_in_flight, retries=write_retries)
+            if PROFILER.enabled:
+                PROFILER.report()
+                print ENTRY_CACHE.stats()
+        else:
+            # Keep running as one of several controllers, provisioning the
+            # switches this instance becomes the primary of
+            ha = HaController(jobs, election_id, batch_size=batch_size,
+                              keep_tables=[TAG_TABLE] if health else ())
+            dispatcher.on('arbitration', ha.onArbitration)
+            background.append(ha)
+            is_primary = ha.isPrimary
+        if snapshot_file is not None and snapshot is None:
+            saveSnapshot(snapshot_file, snapshot_key, fabric, p4info_helpers, table_entries)
+
+        # Keep running and steer new flowlets from the controller
+        weight_controller = None
+        if controller_weights:
+            poller = TelemetryPoller([(connections[sw.name], p4info_helpers[sw.role])
+                                      for sw in fabric],
+                                     registers=['byte_cnt_reg', 'last_time_cnt_reg'])
+            weight_controller = WeightController(fabric, poller, connections, p4info_helpers,
+                                                 round_robin=round_robin, is_primary=is_primary)
+            if election_id is not None:
+                # the weights another primary wrote are read again
+                ha.on_primary.append(lambda sw: weight_controller.forget(sw.name))
+            pollers.append(poller)
+            if snapshot is not None:
+                poller.seed(snapshot.samples())
+            poller.start()
+            weight_controller.start()
+            background += [weight_controller, poller]
+            print "Updating path weights every %.1f s" % weight_controller.interval
+
+        # Keep running and probe every path so its utilization_reg stays fresh
+        scheduler = None
+        if probes:
+            scheduler = ProbeScheduler(fabric, connections, p4info_helpers,
+                                       switchIds(table_entries), interval=probe_interval,
+                                       budget=probe_budget, is_primary=is_primary)
+            scheduler.start()
+            background.append(scheduler)
+            print "Probing %d paths every %.1f ms" % (len(scheduler.paths),
+                                                      scheduler.interval * 1000)
 
-        # Send master arbitration update message to establish this controller as
-        # master (required by P4Runtime before performing any other write operation)
-        s1.MasterArbitrationUpdate()
-        s2.MasterArbitrationUpdate()
-        s3.MasterArbitrationUpdate()
-        s4.MasterArbitrationUpdate()
-        stor1.MasterArbitrationUpdate()
-        stor2.MasterArbitrationUpdate()
+        # Keep running and take the paths crossing a dead link out of the
+        # selection of the ToRs
+        if health:
+            monitor = HealthMonitor(fabric, connections, p4info_helpers, table_entries,
+                                    interval=health_interval, recovery=recovery_time,
+                                    probes=scheduler, weight_controller=weight_controller,
+                                    is_primary=is_primary)
+            if election_id is not None:
+                ha.on_primary.append(monitor.resync)
+            if weight_controller is not None:
+                weight_controller.health = monitor
+            monitor.start()
+            background.append(monitor)
+            print "Checking %d ports every %.1f ms" % (len(monitor.ports), monitor.interval * 1000)
 
-        # Install the P4 program on the switches
-        s1.SetForwardingPipelineConfig(p4info=p4info_helper_sw.p4info,
-                                       bmv2_json_file_path=bmv2_file_path_sw)
-        print "Installed P4 Program using SetForwardingPipelineConfig on s1"
-        s2.SetForwardingPipelineConfig(p4info=p4info_helper_sw.p4info,
-                                       bmv2_json_file_path=bmv2_file_path_sw)
-        print "Installed P4 Program using SetForwardingPipelineConfig on s2"
-        s3.SetForwardingPipelineConfig(p4info=p4info_helper_sw.p4info,
-                                       bmv2_json_file_path=bmv2_file_path_sw)
-        print "Installed P4 Program using SetForwardingPipelineConfig on s3"
-        s4.SetForwardingPipelineConfig(p4info=p4info_helper_sw.p4info,
-                                       bmv2_json_file_path=bmv2_file_path_sw)
-        print "Installed P4 Program using SetForwardingPipelineConfig on s4"
-        stor1.SetForwardingPipelineConfig(p4info=p4info_helper_tor.p4info,
-                                       bmv2_json_file_path=bmv2_file_path_tor)
-        print "Installed P4 Program using SetForwardingPipelineConfig on stor1"
-        stor2.SetForwardingPipelineConfig(p4info=p4info_helper_tor.p4info,
-                                       bmv2_json_file_path=bmv2_file_path_tor)
-        print "Installed P4 Program using SetForwardingPipelineConfig on stor2"
+        # Keep running and report the flowlets the ToRs move between paths
+        if path_changes:
+            dispatcher.on('digest', PathChangeLog())
+            digest_id = digestId(p4info_helpers['tor'], PATH_CHANGE_DIGEST)
+            tors = set(tor.name for tor in fabric.tors())
 
-        # Write the rules that tunnel traffic from h1 to h2
-        '''writeTunnelRules(p4info_helper, ingress_sw=s1, egress_sw=s2, tunnel_id=100,
-                         dst_eth_addr="08:00:00:00:02:22", dst_ip_addr="10.0.2.2")
+            def enablePathChanges(sw):
+                if sw.name not in tors:
+                    return
+                try:
+                    enableDigest(sw, digest_id)
+                except grpc.RpcError:
+                    # Already enabled by a previous primary
+                    enableDigest(sw, digest_id, update_type=p4runtime_pb2.Update.MODIFY)
 
-        # Write the rules that tunnel traffic from h2 to h1
-        writeTunnelRules(p4info_helper, ingress_sw=s2, egress_sw=s1, tunnel_id=200,
-                         dst_eth_addr="08:00:00:00:01:11", dst_ip_addr="10.0.1.1")'''
-        
-        with open("tor1-runtime.json", 'r') as sw_conf_file:
-            sw_conf = json_load_byteified(sw_conf_file)
-            if 'table_entries' in sw_conf:
-                table_entries = sw_conf['table_entries']
-                info("Inserting %d table entries..." % len(table_entries))
-                for entry in table_entries:
-                    info(tableEntryToString(entry))
-                    insertTableEntry(stor1, entry, p4info_helper_tor)
-        with open("tor2-runtime.json", 'r') as sw_conf_file:
-            sw_conf = json_load_byteified(sw_conf_file)
-            if 'table_entries' in sw_conf:
-                table_entries = sw_conf['table_entries']
-                info("Inserting %d table entries..." % len(table_entries))
-                for entry in table_entries:
-                    info(tableEntryToString(entry))
-                    insertTableEntry(stor2, entry, p4info_helper_tor)
-        with open("s1-runtime.json", 'r') as sw_conf_file:
-            sw_conf = json_load_byteified(sw_conf_file)
-            if 'table_entries' in sw_conf:
-                table_entries = sw_conf['table_entries']
-                info("Inserting %d table entries..." % len(table_entries))
-                for entry in table_entries:
-                    info(tableEntryToString(entry))
-                    insertTableEntry(s1, entry, p4info_helper_sw)
-        with open("s2-runtime.json", 'r') as sw_conf_file:
-            sw_conf = json_load_byteified(sw_conf_file)
-            if 'table_entries' in sw_conf:
-                table_entries = sw_conf['table_entries']
-                info("Inserting %d table entries..." % len(table_entries))
-                for entry in table_entries:
-                    info(tableEntryToString(entry))
-                    insertTableEntry(s2, entry, p4info_helper_sw)
-        with open("s3-runtime.json", 'r') as sw_conf_file:
-            sw_conf = json_load_byteified(sw_conf_file)
-            if 'table_entries' in sw_conf:
-                table_entries = sw_conf['table_entries']
-                info("Inserting %d table entries..." % len(table_entries))
-                for entry in table_entries:
-                    info(tableEntryToString(entry))
-                    insertTableEntry(s3, entry, p4info_helper_sw)
-        with open("s4-runtime.json", 'r') as sw_conf_file:
-            sw_conf = json_load_byteified(sw_conf_file)
-            if 'table_entries' in sw_conf:
-                table_entries = sw_conf['table_entries']
-                info("Inserting %d table entries..." % len(table_entries))
-                for entry in table_entries:
-                    info(tableEntryToString(entry))
-                    insertTableEntry(s4, entry, p4info_helper_sw)
+            if election_id is None:
+                for tor in fabric.tors():
+                    enableDigest(connections[tor.name], digest_id)
+            else:
+                ha.on_primary.append(enablePathChanges)
+            print "Reporting the path changes of the ToR flowlets"
+
+        # The switch streams carry the digests and the arbitration updates
+        if path_changes or election_id is not None:
+            dispatcher.start()
+            background.append(dispatcher)
+            if election_id is not None:
+                ha.start()
+
+        # Keep running and serve the state of the fabric to Prometheus
+        if metrics_port is not None:
+            # A poller of its own keeps only the last samples, the flowlet
+            # table can be large
+            metrics_poller = TelemetryPoller([(connections[sw.name], p4info_helpers[sw.role])
+                                              for sw in fabric],
+                                             registers=EXPORTED_REGISTERS, capacity=2)
+            exporter = MetricsExporter(metrics_poller, port=metrics_port)
+            pollers.append(metrics_poller)
+            if snapshot is not None:
+                metrics_poller.seed(snapshot.samples())
+            metrics_poller.start()
+            exporter.start()
+            background += [exporter, metrics_poller]
+            print "Serving metrics on port %d" % metrics_port
+
+        if background:
+            print "Press Ctrl-C to stop"
+            try:
+                while True:
+                    sleep(1)
+            finally:
+                for task in background:
+                    task.stop()
+                # Keep the last samples of the pollers for the next start
+                if snapshot_file is not None and pollers:
+                    samples = {}
+                    for task in pollers:
+                        for sample in task.lastSamples():
+                            key = sample[:3]
+                            if key not in samples or sample[3] > samples[key][3]:
+                                samples[key] = sample
+                    saveSnapshot(snapshot_file, snapshot_key, fabric, p4info_helpers,
+                                 table_entries, samples.values())
 
     except KeyboardInterrupt:
         print " Shutting down."
@@ -263,7 +268,133 @@ def main(p4info_file_path_sw, bmv2_file_path_sw, p4info_file_path_tor, bmv2_file
     ShutdownAllSwitchConnections()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='P4Runtime Controller')
+    parser.add_argument('--topology', help='topology file describing the fabric',
+                        type=str, action="store", required=False,
+                        default='topology.json')
+    parser.add_argument('--batch-size', help='table updates per P4Runtime WriteRequest',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--max-in-flight', help='WriteRequests outstanding per switch while '
+                        'provisioning',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument('--write-retries', help='times a write failing for a transient '
+                        'reason is retried, with exponential backoff',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_WRITE_RETRIES)
+    parser.add_argument('--reconcile', help='only write the difference with the entries already '
+                        'on the switches, keeping their pipeline if it is unchanged',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--controller-weights', help='compute the path weights in the controller '
+                        'and push them to the ToRs instead of using utilization_reg',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--round-robin', help='with --controller-weights, give the weight '
+                        'buckets to new flowlets in turn instead of at random, and switch the '
+                        'ToRs to new weights atomically',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--probes', help='keep running and send probes on every path of the '
+                        'ToRs through packet-out, so idle paths keep fresh utilization_reg '
+                        'weights', action="store_true", required=False, default=False)
+    parser.add_argument('--probe-interval', help='seconds between two probes of the same path',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_PROBE_INTERVAL)
+    parser.add_argument('--probe-budget', help='largest share of the capacity of a link the '
+                        'probes may take; the probe interval is stretched to fit',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_PROBE_BUDGET)
+    parser.add_argument('--quantizer', help='rate thresholds of the utilization weights saved '
+                        'by quantizer.py, instead of the ones derived from the link speeds',
+                        type=str, action="store", required=False)
+    parser.add_argument('--health', help='keep running and take the paths with a port down, '
+                        'or whose probes are lost, out of the WECMP selection',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--health-interval', help='seconds between two checks of the ports',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_HEALTH_INTERVAL)
+    parser.add_argument('--recovery-time', help='seconds for a path that came back to get its '
+                        'full weight again',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_RECOVERY_TIME)
+    parser.add_argument('--flowlet-slots', help='size of the flowlet table of the ToRs',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_FLOWLET_SLOTS)
+    parser.add_argument('--flowlet-gap', help='inter-packet gap starting a new flowlet, '
+                        'in micro seconds',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_FLOWLET_GAP)
+    parser.add_argument('--routes', help='compute the table entries from the topology instead '
+                        'of reading the runtime files of the switches',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--path-changes', help='keep running and print the flowlets the ToRs '
+                        'move to another path, as they report them',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--metrics-port', help='keep running and serve Prometheus metrics '
+                        'on this port',
+                        type=int, action="store", required=False,
+                        nargs='?', const=DEFAULT_METRICS_PORT)
+    parser.add_argument('--profile', help='time every provisioning stage and entry, print '
+                        'the percentiles and list the entries as they are installed',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--profile-output', help='with --profile, also run under cProfile and '
+                        'write the statistics of all the threads to this file',
+                        type=str, action="store", required=False)
+    parser.add_argument('--election-id', help='keep running as one of several controllers, '
+                        'the one with the highest election id being the primary and the '
+                        'others taking over when it is gone',
+                        type=int, action="store", required=False)
+    parser.add_argument('--entry-cache-size', help='number of compiled table entries kept '
+                        'for the switches sharing them, 0 to build every entry',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_ENTRY_CACHE_SIZE)
+    parser.add_argument('--snapshot', help='warm start from the state saved by the previous '
+                        'run in this file, unless the topology, runtime or P4 files changed, '
+                        'and save it there',
+                        type=str, action="store", required=False,
+                        nargs='?', const=DEFAULT_SNAPSHOT)
+    args = parser.parse_args()
+    if args.round_robin and not args.controller_weights:
+        parser.error('--round-robin requires --controller-weights')
+    if args.max_in_flight < 1:
+        parser.error('--max-in-flight must be at least 1')
+    if args.probe_budget <= 0:
+        parser.error('--probe-budget must be positive')
+
+    ENTRY_CACHE.resize(args.entry_cache_size)
+    if args.profile:
+        PROFILER.enable(cprofile=args.profile_output is not None)
     os.system("sudo chown p4.p4 logs/*");
-    os.system("p4c-bm2-ss --p4v 16 --p4runtime-files build/load_balance_sw.p4.p4info.txt -o build/load_balance_sw.json load_balance.p4.sw");
-    os.system("p4c-bm2-ss --p4v 16 --p4runtime-files build/load_balance.p4.p4info.txt -o build/load_balance.json load_balance.p4");
-    main("build/load_balance_sw.p4.p4info.txt", "build/load_balance_sw.json", "build/load_balance.p4.p4info.txt", "build/load_balance.json")
+    flags = P4C_FLAGS + flowletFlags(args.flowlet_slots, args.flowlet_gap)
+    if args.round_robin:
+        flags += ROUND_ROBIN_WEIGHTS_FLAGS
+    elif args.controller_weights:
+        flags += CONTROLLER_WEIGHTS_FLAGS
+    if args.path_changes:
+        flags += PATH_CHANGE_DIGEST_FLAGS
+    if args.probes:
+        flags += probeFlags()
+    if args.routes:
+        flags += tagFlags(RouteCompiler(FabricInventory(args.topology)).tagBits())
+    snapshot = None
+    snapshot_key = None
+    if args.snapshot is not None:
+        snapshot_key = snapshotKey(args.topology, flags, args.routes, args.quantizer)
+        snapshot = loadSnapshot(args.snapshot, snapshot_key)
+    if snapshot is None:
+        with PROFILER.stage('compile'):
+            compilePrograms(PROGRAMS.values(), flags)
+        if args.snapshot is not None:
+            # The build outputs were written again
+            snapshot_key = snapshotKey(args.topology, flags, args.routes, args.quantizer)
+    PROFILER.run(main, args.topology, batch_size=args.batch_size, reconcile=args.reconcile,
+                 controller_weights=args.controller_weights, generate_routes=args.routes,
+                 path_changes=args.path_changes, metrics_port=args.metrics_port,
+                 election_id=args.election_id, round_robin=args.round_robin,
+                 probes=args.probes, probe_interval=args.probe_interval,
+                 probe_budget=args.probe_budget, quantizer_file=args.quantizer,
+                 health=args.health, health_interval=args.health_interval,
+                 recovery_time=args.recovery_time, snapshot_file=args.snapshot,
+                 snapshot_key=snapshot_key, snapshot=snapshot,
+                 max_in_flight=args.max_in_flight, write_retries=args.write_retries)
+    if args.profile_output is not None:
+        PROFILER.dump(args.profile_output)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python2
+import errno
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Import P4Runtime lib from parent utils dir
+# Probably there's a better way of doing this.
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../utils/'))
+import p4runtime_lib.helper
+from p4.config.v1 import p4info_pb2
+
+P4C = 'p4c-bm2-ss'
+P4C_FLAGS = ['--p4v', '16']
+
+# Compiled artifacts are stored under a directory named after the build key
+CACHE_DIR = 'build/.cache'
+
+_compiler_version = None
+
+
+def compilerVersion():
+    global _compiler_version
+    if _compiler_version is None:
+        _compiler_version = subprocess.check_output([P4C, '--version'],
+                                                    stderr=subprocess.STDOUT)
+    return _compiler_version
+
+
+def buildKey(source, flags):
+    """
+    Hashes everything the compiler output depends on: the P4 source, the
+    compiler version and the compiler flags.
+    """
+    digest = hashlib.sha256()
+    with open(source, 'rb') as source_file:
+        digest.update(source_file.read())
+    digest.update(compilerVersion())
+    digest.update('\0'.join(flags))
+    return digest.hexdigest()
+
+
+def _makedirs(path):
+    # programs are compiled in parallel threads, which may race to create
+    # the same directory
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _copy(src, dst):
+    dst_dir = os.path.dirname(dst)
+    if dst_dir and not os.path.isdir(dst_dir):
+        _makedirs(dst_dir)
+    shutil.copyfile(src, dst)
+
+
+def compileProgram(source, p4info_path, bmv2_json_path, flags=None):
+    """
+    Compiles a P4 program into its p4info and BMv2 JSON files, unless the
+    cache already holds the artifacts for the same source, compiler and flags.
+
+    :param source: the P4 source file
+    :param p4info_path: where to put the p4info text file
+    :param bmv2_json_path: where to put the BMv2 JSON file
+    :param flags: compiler flags (default: P4C_FLAGS)
+    :return: True on a cache hit, False if the program was compiled
+    """
+    flags = list(P4C_FLAGS if flags is None else flags)
+    cache_dir = os.path.join(CACHE_DIR, buildKey(source, flags))
+    cached_p4info = os.path.join(cache_dir, 'p4info.txt')
+    cached_bmv2_json = os.path.join(cache_dir, 'bmv2.json')
+
+    hit = os.path.isfile(cached_p4info) and os.path.isfile(cached_bmv2_json)
+    if not hit:
+        if not os.path.isdir(CACHE_DIR):
+            _makedirs(CACHE_DIR)
+        # Compile into a scratch directory and rename it into place, so an
+        # interrupted build never leaves a half-written cache entry behind
+        work_dir = tempfile.mkdtemp(dir=CACHE_DIR)
+        try:
+            cmd = [P4C] + flags + ['--p4runtime-files', os.path.join(work_dir, 'p4info.txt'),
+                                   '-o', os.path.join(work_dir, 'bmv2.json'), source]
+            if subprocess.call(cmd) != 0:
+                raise RuntimeError("%s failed to compile %s" % (P4C, source))
+            try:
+                os.rename(work_dir, cache_dir)
+            except OSError as e:
+                # another thread compiled the same program first
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            if os.path.isdir(work_dir):
+                shutil.rmtree(work_dir)
+
+    _copy(cached_p4info, p4info_path)
+    _copy(cached_bmv2_json, bmv2_json_path)
+    print "%s %s" % ("Using cached build of" if hit else "Compiled", source)
+    return hit
+
+
+def compilePrograms(programs, flags=None):
+    """
+    Compiles the programs in parallel, skipping those found in the cache.
+
+    :param programs: list of dicts with 'source', 'p4info' and 'bmv2_json'
+    :param flags: compiler flags (default: P4C_FLAGS)
+    :return: list of cache hit flags, in the order of programs
+    """
+    executor = ThreadPoolExecutor(max_workers=max(len(programs), 1))
+    try:
+        futures = [executor.submit(compileProgram, program['source'], program['p4info'],
+                                   program['bmv2_json'], flags)
+                   for program in programs]
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=True)
+
+
+def p4InfoHelperFromString(data):
+    """
+    :param data: a P4Info in binary protobuf form
+    :return: the P4Info helper
+    """
+    helper = p4runtime_lib.helper.P4InfoHelper.__new__(p4runtime_lib.helper.P4InfoHelper)
+    helper.p4info = p4info_pb2.P4Info.FromString(data)
+    return helper
+
+
+def loadP4InfoHelper(p4info_path):
+    """
+    Builds a P4InfoHelper, parsing the p4info text file only the first time.
+    The parsed P4Info is kept in binary protobuf form in the cache, which is
+    much faster to load than the text format.
+
+    :param p4info_path: the p4info text file
+    :return: the P4Info helper
+    """
+    with open(p4info_path, 'rb') as p4info_file:
+        text = p4info_file.read()
+    cached = os.path.join(CACHE_DIR, 'p4info-%s.bin' % hashlib.sha256(text).hexdigest())
+
+    if os.path.isfile(cached):
+        with open(cached, 'rb') as cached_file:
+            return p4InfoHelperFromString(cached_file.read())
+
+    helper = p4runtime_lib.helper.P4InfoHelper(p4info_path)
+    if not os.path.isdir(CACHE_DIR):
+        _makedirs(CACHE_DIR)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR)
+    with os.fdopen(fd, 'wb') as tmp_file:
+        tmp_file.write(helper.p4info.SerializeToString())
+    os.rename(tmp_path, cached)
+    return helper
@@ -0,0 +1,208 @@
+#!/usr/bin/env python2
+import struct
+import sys
+import threading
+from time import time
+
+import grpc
+import numpy
+from p4.v1 import p4runtime_pb2
+
+from p4runtime_lib.error_utils import printGrpcError
+from telemetry import registerIds, readRegisters
+from weights import PathWeights
+
+# Port of the ToRs to and from the controller, CPU_PORT in load_balance.p4;
+# simple_switch_grpc must be started with the same --cpu-port
+DEFAULT_CPU_PORT = 255
+
+TYPE_WECMP = 0x1234
+# PROBE_PROTOCOL and MAX_UTILIZATION in load_balance.p4
+PROBE_PROTOCOL = 0xfd
+MAX_UTILIZATION = 8
+
+# Probes are padded to the smallest Ethernet frame
+PROBE_FRAME_SIZE = 64
+
+DEFAULT_INTERVAL = 0.1
+# Largest share of the capacity of any link the probes may take
+DEFAULT_BUDGET = 0.01
+DEFAULT_REPORT_INTERVAL = 5.0
+
+# Send times kept to date the rounds read back from probe_round_reg
+ROUNDS_KEPT = 4096
+
+
+def probeFlags(cpu_port=DEFAULT_CPU_PORT):
+    """
+    :return: the p4c defines that make the ToRs of load_balance.p4 take the
+             probes of a ProbeScheduler
+    """
+    return ['-DPATH_PROBES', '-DCPU_PORT=%d' % cpu_port]
+
+
+def _ipChecksum(header):
+    total = sum(struct.unpack('!%dH' % (len(header) // 2), header))
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def probeFrame(sw_id, path_id, round_id):
+    """
+    Builds a probe as the source ToR would tag a packet of a host for the
+    given path: WECMP header with the ToR's id, the path and the highest
+    max_utilization, then an IPv4 header of protocol PROBE_PROTOCOL. The
+    round is carried in the byte field of the WECMP header.
+    """
+    ethernet = '\xff' * 6 + '\x00' * 6 + struct.pack('!H', TYPE_WECMP)
+    wecmp = struct.pack('!BBBBHI', sw_id, path_id, 0, MAX_UTILIZATION,
+                        (round_id >> 32) & 0xffff, round_id & 0xffffffff)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20, 0, 0, 64, PROBE_PROTOCOL, 0,
+                     '\x00' * 4, '\x00' * 4)
+    ip = ip[:10] + struct.pack('!H', _ipChecksum(ip)) + ip[12:]
+    frame = ethernet + wecmp + ip
+    return frame + '\x00' * (PROBE_FRAME_SIZE - len(frame))
+
+
+def switchIds(table_entries):
+    """
+    :param table_entries: dict of switch name -> runtime entries
+    :return: dict of switch name -> id set by switch_config_params
+    """
+    ids = {}
+    for name, entries in table_entries.iteritems():
+        for flow in entries:
+            if flow['table'] == 'MyIngress.switch_config_params':
+                ids[name] = flow['action_params']['id']
+    return ids
+
+
+def minimumInterval(path_weights, budget, frame_size=PROBE_FRAME_SIZE):
+    """
+    :param path_weights: a PathWeights, whose rows are the probed paths
+    :param budget: largest share of the capacity of a link given to probes
+    :return: the shortest round of probes that keeps every link within the
+             budget, in seconds
+    """
+    if budget <= 0:
+        raise ValueError("the probe budget must be positive, not %s" % budget)
+    # every round sends one probe per path, over every link of the path
+    bits = path_weights.incidence.sum(axis=0) * frame_size * 8
+    if not len(bits):
+        return 0.0
+    return float((bits / (budget * path_weights.capacity)).max())
+
+
+class ProbeScheduler(object):
+    """
+    Sends a probe on every path of every ToR in rounds, so utilization_reg
+    is refreshed on the paths no data packet comes back on. A probe leaves
+    its ToR through packet-out, follows its path like the data packets, and
+    updates utilization_reg on the ToR at the other end before it is
+    dropped there. The ToRs must be built with probeFlags().
+
+    The probes of a round are spread evenly over the round, which is
+    stretched as needed to keep the probes within their share of the
+    capacity of every link. probe_round_reg records the round of the last
+    probe that refreshed each index of utilization_reg, which bounds how old
+    the weights of every path can be.
+    """
+
+    def __init__(self, fabric, connections, p4info_helpers, sw_ids, interval=DEFAULT_INTERVAL,
+                 budget=DEFAULT_BUDGET, report_interval=DEFAULT_REPORT_INTERVAL, is_primary=None):
+        """
+        :param fabric: the FabricInventory
+        :param connections: dict of switch name -> switch connection, after
+                            the master arbitration
+        :param p4info_helpers: dict of role -> P4Info helper
+        :param sw_ids: dict of ToR name -> id of switch_config_params
+        :param interval: seconds between two probes of the same path
+        :param budget: largest share of the capacity of a link given to probes
+        :param report_interval: seconds between two printed staleness reports
+        :param is_primary: function of a switch name returning True if the
+                           controller may send packets out of it, e.g.
+                           HaController.isPrimary; None to probe from every ToR
+        """
+        self.fabric = fabric
+        self.connections = connections
+        self.report_interval = report_interval
+        self.is_primary = is_primary
+        path_weights = PathWeights(fabric)
+        self.paths = path_weights.rows
+        for tor, _ in self.paths:
+            if tor not in sw_ids:
+                raise ValueError("%s: no switch_config_params entry to take the id from" % tor)
+        self.sw_ids = sw_ids
+        self.interval = max(interval, minimumInterval(path_weights, budget))
+        self.register_ids = registerIds(p4info_helpers['tor'], ['probe_round_reg'])
+        self.rounds = {}  # round -> time it started
+        self.round_id = 0
+        self.sent = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sendProbe(self, tor, path_id, round_id):
+        if self.is_primary is not None and not self.is_primary(tor):
+            return
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.packet.payload = probeFrame(self.sw_ids[tor], path_id, round_id)
+        self.connections[tor].requests_stream.put(request)
+        self.sent += 1
+
+    def staleness(self):
+        """
+        Reads probe_round_reg on every ToR.
+
+        :return: dict of (ToR name, utilization_reg index) -> seconds since
+                 the round that last refreshed it started, inf if no probe
+                 refreshed it in the last ROUNDS_KEPT rounds
+        """
+        now = time()
+        ages = {}
+        for tor in self.fabric.tors():
+            values = readRegisters(self.connections[tor.name], self.register_ids)
+            for (_, index), round_id in values.iteritems():
+                started = self.rounds.get(round_id)
+                ages[(tor.name, index)] = now - started if started is not None else float('inf')
+        return ages
+
+    def report(self, out=sys.stdout):
+        ages = self.staleness()
+        print >> out, '\n----- Path weight staleness (ms), probe round %.1f ms, %d probes sent -----' % (
+            self.interval * 1000, self.sent)
+        for (tor, index), age in sorted(ages.iteritems()):
+            print >> out, '%s utilization_reg %d: %s' % (
+                tor, index, 'never probed' if numpy.isinf(age) else '%.1f' % (age * 1000))
+        out.flush()
+
+    def _run(self):
+        spacing = self.interval / max(len(self.paths), 1)
+        next_probe = time()
+        next_report = next_probe + self.report_interval
+        while not self.stopped.is_set():
+            self.round_id += 1
+            self.rounds[self.round_id] = time()
+            self.rounds.pop(self.round_id - ROUNDS_KEPT, None)
+            try:
+                for tor, path_id in self.paths:
+                    self.sendProbe(tor, path_id, self.round_id)
+                    # Keep a fixed rate; if a probe is late, send the next now
+                    next_probe = max(next_probe + spacing, time())
+                    if self.stopped.wait(next_probe - time()):
+                        break
+                if self.report_interval and time() >= next_report:
+                    self.report()
+                    next_report = time() + self.report_interval
+            except grpc.RpcError as e:
+                printGrpcError(e)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='probes')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
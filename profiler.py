@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+import cProfile
+import pstats
+import sys
+import threading
+from contextlib import contextmanager
+from time import time
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, p):
+    """
+    :return: the nearest-rank p-th percentile of an ascending list
+    """
+    rank = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+class Profiler(object):
+    """
+    Collects the duration of every provisioning stage, per switch, and
+    optionally runs the work under cProfile. Disabled, it records nothing and
+    the callers skip their per-entry bookkeeping.
+
+    Stages are recorded by the code doing the work: "compile", "snapshot",
+    "load_json", "format", "build_entry", "parse_entries", "arbitration",
+    "pipeline", "write" and "switch".
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cprofile = False
+        self.samples = {}  # stage -> list of (switch name, seconds)
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def enable(self, cprofile=False):
+        self.enabled = True
+        self.cprofile = cprofile
+
+    def record(self, stage, switch_name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.samples.setdefault(stage, []).append((switch_name, seconds))
+
+    @contextmanager
+    def stage(self, name, switch_name=None):
+        if not self.enabled:
+            yield
+            return
+        start = time()
+        try:
+            yield
+        finally:
+            self.record(name, switch_name, time() - start)
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Calls fn, under cProfile if enabled. Each thread needs its own
+        profile, so the workers provisioning the switches go through here too.
+        """
+        if not self.cprofile:
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            with self.lock:
+                self.profiles.append(profile)
+
+    def report(self, out=sys.stdout):
+        """
+        Prints the count, total and percentiles of every stage, then the
+        total time of every stage on every switch.
+        """
+        with self.lock:
+            samples = dict((stage, list(values)) for stage, values in self.samples.iteritems())
+        print >> out, '\n----- Provisioning profile (ms) -----'
+        print >> out, '%-12s %8s %10s %s %9s' % (
+            'stage', 'count', 'total', ' '.join('%9s' % ('p%d' % p) for p in PERCENTILES), 'max')
+        for stage, values in sorted(samples.iteritems()):
+            durations = sorted(seconds * 1000 for _, seconds in values)
+            print >> out, '%-12s %8d %10.3f %s %9.3f' % (
+                stage, len(durations), sum(durations),
+                ' '.join('%9.3f' % percentile(durations, p) for p in PERCENTILES),
+                durations[-1])
+
+        per_switch = {}
+        for stage, values in samples.iteritems():
+            for switch_name, seconds in values:
+                if switch_name is not None:
+                    key = (switch_name, stage)
+                    per_switch[key] = per_switch.get(key, 0) + seconds * 1000
+        switch_names = sorted(set(switch_name for switch_name, _ in per_switch))
+        stages = sorted(set(stage for _, stage in per_switch))
+        if switch_names:
+            print >> out, '\n%-12s %s' % ('switch', ' '.join('%12s' % stage for stage in stages))
+            for switch_name in switch_names:
+                print >> out, '%-12s %s' % (switch_name, ' '.join(
+                    '%12.3f' % per_switch.get((switch_name, stage), 0) for stage in stages))
+        out.flush()
+
+    def dump(self, path):
+        """
+        Merges the cProfile profiles of all the threads into one pstats file,
+        which snakeviz, gprof2dot or flameprof can turn into a flame graph.
+        """
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        print "Wrote the cProfile statistics of %d threads to %s" % (len(profiles), path)
+
+
+# Shared by the modules doing the provisioning, enabled by mycontroller --profile
+PROFILER = Profiler()
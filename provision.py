@@ -0,0 +1,530 @@
+#!/usr/bin/env python2
+import hashlib
+import random
+import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+
+import grpc
+from google.protobuf import text_format
+from google.rpc import code_pb2, status_pb2
+from p4.v1 import p4runtime_pb2
+
+from metrics import RPC_LATENCY, WRITE_BATCH_SIZE
+from profiler import PROFILER
+
+# Number of table updates packed into a single P4Runtime WriteRequest
+DEFAULT_BATCH_SIZE = 128
+
+# Number of compiled table entries kept by the entry cache
+DEFAULT_ENTRY_CACHE_SIZE = 1 << 16
+
+# WriteRequests kept outstanding on a switch while it is provisioned
+DEFAULT_MAX_IN_FLIGHT = 4
+
+# Times a transient write failure is retried, after a backoff doubling from
+# RETRY_BASE_DELAY up to RETRY_MAX_DELAY seconds, with full jitter
+DEFAULT_WRITE_RETRIES = 4
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 2.0
+
+# Failures of a whole WriteRequest, or of one of its updates, caused by the
+# state of the switch rather than by the request, worth retrying
+TRANSIENT_STATUS = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                    grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.ABORTED)
+TRANSIENT_CODES = (code_pb2.UNAVAILABLE, code_pb2.DEADLINE_EXCEEDED, code_pb2.ABORTED)
+
+# Election id of a controller running alone, the one the P4 tutorial utils
+# arbitrate with
+DEFAULT_ELECTION_ID = 1
+
+
+def setElectionId(election_id, sw):
+    """
+    Fills the Uint128 election_id of a request with the election id the
+    controller arbitrated with on the switch, see ha.py.
+    """
+    value = getattr(sw, 'election_id', DEFAULT_ELECTION_ID)
+    election_id.high = value >> 64
+    election_id.low = value & ((1 << 64) - 1)
+
+
+def buildTableEntry(p4info_helper, flow):
+    return p4info_helper.buildTableEntry(
+        table_name=flow['table'],
+        match_fields=flow.get('match'), # None if not found
+        default_action=flow.get('default_action'), # None if not found
+        action_name=flow['action_name'],
+        action_params=flow['action_params'],
+        priority=flow.get('priority')) # None if not found
+
+
+def _freeze(value):
+    """
+    :return: the JSON value as nested tuples, with the dict items sorted, so
+             equal entries make equal dictionary keys
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((name, _freeze(item)) for name, item in value.iteritems()))
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class EntryCache(object):
+    """
+    LRU cache of the serialized TableEntry protobufs compiled from runtime
+    JSON entries, keyed on the program and the contents of the entry.
+
+    Building an entry looks up the names of its table, match fields, action
+    and parameters in the P4Info and encodes every value; parsing the cached
+    bytes skips all of it. Switches of the same role share most of their
+    entries, so every switch after the first, and every reconcile pass, gets
+    them from the cache.
+    """
+
+    def __init__(self, max_size=DEFAULT_ENTRY_CACHE_SIZE):
+        """
+        :param max_size: number of entries kept, 0 disables the cache
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> serialized TableEntry
+        self.programs = {}  # id(p4info) -> (p4info, digest of the p4info)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def programKey(self, p4info):
+        """
+        :return: a digest of the P4Info, so entries compiled for a program
+                 are reused by any helper loaded from the same p4info file
+        """
+        with self.lock:
+            program = self.programs.get(id(p4info))
+        if program is None:
+            # The P4Info is kept referenced so its id is not reused
+            program = (p4info, hashlib.sha1(p4info.SerializeToString()).digest())
+            with self.lock:
+                self.programs[id(p4info)] = program
+        return program[1]
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    def get(self, p4info_helper, flow, program=None):
+        """
+        :param p4info_helper: the P4Info helper
+        :param flow: an entry of the "table_entries" list of a runtime JSON file
+        :param program: programKey of the helper's P4Info, when already known
+        :return: a TableEntry protobuf of the caller's own
+        """
+        if self.max_size <= 0:
+            return buildTableEntry(p4info_helper, flow)
+        if program is None:
+            program = self.programKey(p4info_helper.p4info)
+        key = (program, flow['table'], _freeze(flow.get('match')), flow.get('default_action'),
+               flow['action_name'], _freeze(flow['action_params']), flow.get('priority'))
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                # Reinserted as the most recently used
+                self.entries[key] = data
+                self.hits += 1
+        if data is not None:
+            return p4runtime_pb2.TableEntry.FromString(data)
+
+        table_entry = buildTableEntry(p4info_helper, flow)
+        data = table_entry.SerializeToString()
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = data
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return table_entry
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return "Entry cache: %d entries, %d hits, %d misses (%.1f%% hits)" % (
+                len(self.entries), self.hits, self.misses,
+                100.0 * self.hits / lookups if lookups else 0)
+
+
+# Shared by all the switches and provisioning passes, sized by mycontroller
+ENTRY_CACHE = EntryCache()
+
+
+class CompiledEntries(list):
+    """
+    Runtime JSON entries along with their TableEntry protobufs, already
+    serialized for a program, as restored from a snapshot (see snapshot.py).
+    buildTableEntries parses the serialized entries instead of building them.
+    """
+
+    def __init__(self, flows, program, data, offsets):
+        """
+        :param flows: the runtime JSON entries
+        :param program: programKey of the P4Info the entries were built for
+        :param data: the serialized entries, back to back
+        :param offsets: array of len(flows) + 1 offsets of the entries in data
+        """
+        list.__init__(self, flows)
+        self.program = program
+        self.data = data
+        self.offsets = offsets
+
+    def serialized(self):
+        """
+        :return: list of the serialized TableEntry protobufs
+        """
+        data, offsets = self.data, self.offsets
+        return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def buildTableEntries(p4info_helper, table_entries, switch_name=None, cache=ENTRY_CACHE):
+    """
+    Builds the TableEntry protobufs for a list of runtime JSON entries.
+
+    :param p4info_helper: the P4Info helper
+    :param table_entries: the "table_entries" list of a runtime JSON file
+    :param switch_name: the switch the entries are for, to profile them
+    :param cache: the EntryCache of the compiled entries
+    """
+    profile = PROFILER.enabled
+    program = cache.programKey(p4info_helper.p4info)
+    if isinstance(table_entries, CompiledEntries) and table_entries.program == program:
+        with PROFILER.stage('parse_entries', switch_name):
+            return [p4runtime_pb2.TableEntry.FromString(data)
+                    for data in table_entries.serialized()]
+    built = []
+    for flow in table_entries:
+        if profile:
+            start = time()
+        built.append(cache.get(p4info_helper, flow, program))
+        if profile:
+            PROFILER.record('build_entry', switch_name, time() - start)
+    return built
+
+
+def pipelineCookie(p4info, bmv2_file_path):
+    """
+    Identifies a forwarding pipeline by a hash of its p4info and BMv2 JSON.
+
+    :return: a 64-bit cookie for ForwardingPipelineConfig.cookie
+    """
+    digest = hashlib.sha256(p4info.SerializeToString())
+    with open(bmv2_file_path, 'rb') as bmv2_file:
+        digest.update(bmv2_file.read())
+    return int(digest.hexdigest()[:16], 16)
+
+
+def setForwardingPipelineConfig(sw, p4info, bmv2_file_path):
+    """
+    Installs the P4 program on the switch, tagged with its pipeline cookie
+    so later runs can tell whether the switch already runs it.
+    """
+    device_config = sw.buildDeviceConfig(bmv2_json_file_path=bmv2_file_path)
+    request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
+    setElectionId(request.election_id, sw)
+    request.device_id = sw.device_id
+    config = request.config
+    config.p4info.CopyFrom(p4info)
+    config.p4_device_config = device_config.SerializeToString()
+    config.cookie.cookie = pipelineCookie(p4info, bmv2_file_path)
+    request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+    start = time()
+    sw.client_stub.SetForwardingPipelineConfig(request)
+    elapsed = time() - start
+    RPC_LATENCY.observe(elapsed, sw.name, 'SetForwardingPipelineConfig')
+    PROFILER.record('pipeline', sw.name, elapsed)
+
+
+class WriteFailure(object):
+    """
+    An update the switch rejected, after any retries.
+    """
+
+    def __init__(self, switch_name, update_type, entry, code, message):
+        self.switch_name = switch_name
+        self.update_type = update_type
+        self.entry = entry
+        self.code = code  # google.rpc.Code
+        self.message = message
+
+    def __str__(self):
+        return "%s: %s %s: %s (%s)" % (
+            self.switch_name, p4runtime_pb2.Update.Type.Name(self.update_type),
+            text_format.MessageToString(self.entry, as_one_line=True),
+            code_pb2.Code.Name(self.code), self.message)
+
+
+def updateErrors(e, count):
+    """
+    Decodes the outcome of every update of a failed WriteRequest from the
+    p4.v1.Error details of its status, which is how BMv2 reports them.
+
+    :param e: the grpc.RpcError of the Write RPC
+    :param count: number of updates of the WriteRequest
+    :return: list of count p4.v1.Error, or None if the whole request failed
+    """
+    for key, value in (getattr(e, 'trailing_metadata', lambda: None)() or ()):
+        if key != 'grpc-status-details-bin':
+            continue
+        status = status_pb2.Status.FromString(value)
+        errors = []
+        for detail in status.details:
+            error = p4runtime_pb2.Error()
+            if not detail.Unpack(error):
+                return None
+            errors.append(error)
+        return errors if len(errors) == count else None
+    return None
+
+
+def retryDelay(attempt):
+    """
+    :return: seconds to wait before the given retry, 1 for the first
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (1 << (attempt - 1))))
+
+
+def _sendWrite(sw, batch):
+    request = p4runtime_pb2.WriteRequest()
+    request.device_id = sw.device_id
+    setElectionId(request.election_id, sw)
+    for update_type, entry in batch:
+        update = request.updates.add()
+        update.type = update_type
+        if isinstance(entry, p4runtime_pb2.RegisterEntry):
+            update.entity.register_entry.CopyFrom(entry)
+        else:
+            update.entity.table_entry.CopyFrom(entry)
+    start = time()
+
+    def done(future):
+        elapsed = time() - start
+        RPC_LATENCY.observe(elapsed, sw.name, 'Write')
+        PROFILER.record('write', sw.name, elapsed)
+
+    future = sw.client_stub.Write.future(request)
+    future.add_done_callback(done)
+    WRITE_BATCH_SIZE.observe(len(request.updates), sw.name)
+    return future
+
+
+def _writeOutcome(future, batch, attempt, retries):
+    # :return: (updates to retry, list of (update, code, message) failed for
+    #           good, the grpc.RpcError to raise if not collecting the failures)
+    try:
+        future.result()
+        return [], [], None
+    except grpc.RpcError as e:
+        errors = updateErrors(e, len(batch))
+        if errors is None:
+            if e.code() in TRANSIENT_STATUS and attempt < retries:
+                return batch, [], None
+            return [], [], e
+    retry = []
+    failed = []
+    for (update_type, entry), error in zip(batch, errors):
+        code = error.canonical_code
+        if code == code_pb2.OK:
+            continue
+        if code in TRANSIENT_CODES and attempt < retries:
+            retry.append((update_type, entry))
+        elif attempt and ((update_type == p4runtime_pb2.Update.INSERT and
+                           code == code_pb2.ALREADY_EXISTS) or
+                          (update_type == p4runtime_pb2.Update.DELETE and
+                           code == code_pb2.NOT_FOUND)):
+            # An earlier attempt of unknown outcome went through after all
+            continue
+        else:
+            failed.append(((update_type, entry), code, error.message))
+    return retry, failed, e if failed else None
+
+
+def writeUpdates(sw, updates, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=1,
+                 retries=DEFAULT_WRITE_RETRIES, failures=None):
+    """
+    Writes the updates to the switch, packing up to batch_size of them into
+    each WriteRequest instead of issuing one RPC per update. With more than
+    one WriteRequest in flight the switch may apply them in any order, so
+    the default sends one at a time.
+
+    A WriteRequest failing as a whole for a transient reason, or the updates
+    of it the switch reports as such, are written again after a jittered
+    exponential backoff, ahead of the rest, up to retries times. The updates
+    still failing are collected in failures, and the others written; without
+    a failures list, the error of the first such WriteRequest is raised once
+    those in flight are done. A WriteRequest failing as a whole for another
+    reason, e.g. the controller not being the primary, is always raised.
+
+    :param sw: the switch connection
+    :param updates: list of (Update type, TableEntry or RegisterEntry protobuf)
+    :param batch_size: maximum number of updates per WriteRequest
+    :param max_in_flight: maximum number of WriteRequests awaiting their answer
+    :param retries: times a transient failure is retried
+    :param failures: list to add a WriteFailure to for every update rejected
+    :return: the number of WriteRequests sent
+    """
+    queued = deque((0, 0.0, updates[start:start + batch_size])
+                   for start in range(0, len(updates), batch_size))
+    in_flight = deque()
+    error = None
+    batches = 0
+    while in_flight or (queued and error is None):
+        while queued and error is None and len(in_flight) < max(max_in_flight, 1):
+            attempt, not_before, batch = queued[0]
+            delay = not_before - time()
+            if delay > 0 and in_flight:
+                break
+            queued.popleft()
+            if delay > 0:
+                sleep(delay)
+            in_flight.append((_sendWrite(sw, batch), attempt, batch))
+            batches += 1
+
+        future, attempt, batch = in_flight.popleft()
+        retry, failed, rpc_error = _writeOutcome(future, batch, attempt, retries)
+        if retry:
+            queued.appendleft((attempt + 1, time() + retryDelay(attempt + 1), retry))
+        if failed and failures is not None:
+            failures.extend(WriteFailure(sw.name, update_type, entry, code, message)
+                            for (update_type, entry), code, message in failed)
+        elif error is None:
+            error = rpc_error
+    if error is not None:
+        raise error
+    return batches
+
+
+def writeTableEntries(sw, table_entries, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=1,
+                      retries=DEFAULT_WRITE_RETRIES, failures=None):
+    """
+    Inserts the table entries into the switch in batches. Default actions
+    are modified, since a table always has one. The entries must be
+    distinct, as the batches may be applied in any order.
+
+    :param sw: the switch connection
+    :param table_entries: list of TableEntry protobufs
+    :param batch_size: maximum number of updates per WriteRequest
+    :param max_in_flight: maximum number of WriteRequests awaiting their answer
+    :param retries: times a transient failure is retried
+    :param failures: list to add a WriteFailure to for every entry rejected
+    :return: the number of WriteRequests sent
+    """
+    updates = []
+    for table_entry in table_entries:
+        if table_entry.is_default_action:
+            updates.append((p4runtime_pb2.Update.MODIFY, table_entry))
+        else:
+            updates.append((p4runtime_pb2.Update.INSERT, table_entry))
+    return writeUpdates(sw, updates, batch_size, max_in_flight, retries, failures)
+
+
+def provisionSwitch(sw, p4info_helper, bmv2_file_path, table_entries,
+                    batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                    retries=DEFAULT_WRITE_RETRIES, failures=None):
+    """
+    Makes the controller master of the switch, installs the P4 program and
+    writes the table entries in batches.
+
+    :param sw: the switch connection
+    :param p4info_helper: the P4Info helper of the program for this switch
+    :param bmv2_file_path: the BMv2 JSON file of the program for this switch
+    :param table_entries: the "table_entries" list of a runtime JSON file
+    :param batch_size: maximum number of updates per WriteRequest
+    :param max_in_flight: maximum number of WriteRequests awaiting their answer
+    :param retries: times a transient write failure is retried
+    :param failures: list to add a WriteFailure to for every entry rejected,
+                     instead of stopping at the first batch with one
+    :return: the wall-clock time spent on the switch, in seconds
+    """
+    start = time()
+    with PROFILER.stage('arbitration', sw.name):
+        sw.MasterArbitrationUpdate()
+    setForwardingPipelineConfig(sw, p4info_helper.p4info, bmv2_file_path)
+    failed = []
+    batches = writeTableEntries(sw, buildTableEntries(p4info_helper, table_entries, sw.name),
+                                batch_size, max_in_flight, retries,
+                                failed if failures is not None else None)
+    elapsed = time() - start
+    PROFILER.record('switch', sw.name, elapsed)
+    print "Provisioned %s: %d entries in %d writes%s, %.3f s" % (
+        sw.name, len(table_entries) - len(failed), batches,
+        ", %d failed" % len(failed) if failed else '', elapsed)
+    sys.stdout.flush()
+    if failures is not None:
+        failures.extend(failed)
+    return elapsed
+
+
+def printWriteFailures(failures, out=sys.stdout, examples=3):
+    """
+    Prints the updates rejected by the switches, counted per switch and
+    error, with the first few of each.
+    """
+    groups = OrderedDict()
+    for failure in failures:
+        groups.setdefault((failure.switch_name, failure.code), []).append(failure)
+    print >> out, '\n----- %d updates failed on %d switches -----' % (
+        len(failures), len(set(switch_name for switch_name, _ in groups)))
+    for (switch_name, code), group in sorted(groups.iteritems()):
+        print >> out, "%s: %d %s" % (switch_name, len(group), code_pb2.Code.Name(code))
+        for failure in group[:examples]:
+            print >> out, "  %s" % failure
+    out.flush()
+
+
+def provisionFabric(jobs, batch_size=DEFAULT_BATCH_SIZE, max_workers=None,
+                    switch_fn=provisionSwitch, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                    retries=DEFAULT_WRITE_RETRIES):
+    """
+    Provisions all switches concurrently, one worker per switch.
+
+    The entries a switch rejects are collected and summed up at the end,
+    the other entries and switches are provisioned all the same. Any other
+    grpc.RpcError raised while provisioning a switch is re-raised here once
+    all the switches have been handled.
+
+    :param jobs: list of (sw, p4info_helper, bmv2_file_path, table_entries)
+    :param batch_size: maximum number of updates per WriteRequest
+    :param max_workers: size of the thread pool (default: one per switch)
+    :param switch_fn: provisions one switch, provisionSwitch or reconcileSwitch
+    :param max_in_flight: maximum number of WriteRequests awaiting their
+                          answer, per switch
+    :param retries: times a transient write failure is retried
+    :return: (dict of switch name -> seconds, total wall-clock seconds,
+              list of WriteFailure)
+    """
+    start = time()
+    timings = {}
+    failures = []
+    error = None
+    executor = ThreadPoolExecutor(max_workers=max_workers or max(len(jobs), 1))
+    try:
+        futures = [(job[0], executor.submit(PROFILER.run, switch_fn, *job, batch_size=batch_size,
+                                            max_in_flight=max_in_flight, retries=retries,
+                                            failures=failures))
+                   for job in jobs]
+        for sw, future in futures:
+            try:
+                timings[sw.name] = future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+    finally:
+        executor.shutdown(wait=True)
+    if failures:
+        printWriteFailures(failures)
+    if error is not None:
+        raise error
+    total = time() - start
+    print "Provisioned %d switches in %.3f s (sum of per-switch time %.3f s)" % (
+        len(timings), total, sum(timings.values()))
+    return timings, total, failures
@@ -0,0 +1,221 @@
+#!/usr/bin/env python2
+import argparse
+import json
+import sys
+from time import sleep, time
+
+import grpc
+import numpy
+
+from fabric import FabricInventory, PROGRAMS, json_load_byteified
+from p4build import loadP4InfoHelper
+from p4runtime_lib.error_utils import printGrpcError
+from p4runtime_lib.switch import ShutdownAllSwitchConnections
+from telemetry import TelemetryPoller
+from weights import linkRates
+
+# QUANTIZER_SHIFT of the P4 programs: the thresholds are written in bytes
+# per micro second, in fixed point with that many fractional bits
+QUANTIZER_SHIFT = 16
+MAX_THRESHOLD = (1 << 32) - 1
+
+# Weight levels of utilization_reg, MAX_UTILIZATION in load_balance.p4
+WEIGHT_LEVELS = 8
+
+# Table holding the thresholds of every ingress port, per program
+QUANTIZER_TABLES = {
+    'tor': 'MyIngress.port_quantizer',
+    'spine': 'MyEgress.port_quantizer',
+}
+
+# Samples below this share of the link speed count as idle and are left out
+# of the calibration, and the calibrated thresholds never go below the
+# linear thresholds of this share of the link speed
+BUSY_SHARE = 0.01
+MIN_SHARE = 0.1
+
+DEFAULT_DURATION = 30.0
+DEFAULT_INTERVAL = 0.2
+
+
+def thresholdValue(bps):
+    """
+    :return: a rate in bits/s as a port_quantizer threshold
+    """
+    value = int(round(bps / 8e6 * (1 << QUANTIZER_SHIFT)))
+    return min(max(value, 1), MAX_THRESHOLD)
+
+
+def linearThresholds(capacity):
+    """
+    :param capacity: link speed in bits/s
+    :return: the rates in bits/s at which a port loses each weight level,
+             evenly spread up to the link speed as the P4 default is over
+             its fixed speed
+    """
+    return [capacity * level / float(WEIGHT_LEVELS) for level in range(1, WEIGHT_LEVELS + 1)]
+
+
+def calibratedThresholds(rates, capacity):
+    """
+    :param rates: NumPy array of the rates observed on a port, in bits/s
+    :param capacity: link speed in bits/s
+    :return: the rates in bits/s at which the port loses each weight level,
+             at evenly spaced quantiles of the busy samples, so every weight
+             level is about as frequent over the observed load, or None if
+             the port was idle all along
+    """
+    busy = rates[rates > BUSY_SHARE * capacity]
+    if not len(busy):
+        return None
+    quantiles = 100.0 * numpy.arange(1, WEIGHT_LEVELS + 1) / (WEIGHT_LEVELS + 1)
+    lowest = linearThresholds(MIN_SHARE * capacity)
+    return [max(float(rate), floor) for rate, floor in zip(numpy.percentile(busy, quantiles), lowest)]
+
+
+def quantizerEntry(role, port, thresholds):
+    """
+    :param thresholds: the WEIGHT_LEVELS rates in bits/s, ascending
+    :return: the runtime entry setting the thresholds of the ingress port
+    """
+    if len(thresholds) != WEIGHT_LEVELS:
+        raise ValueError("port %d: %d thresholds given, %d weight levels" % (
+            port, len(thresholds), WEIGHT_LEVELS))
+    table = QUANTIZER_TABLES[role]
+    params = {}
+    previous = 0
+    for level, bps in enumerate(thresholds):
+        # a level lost at the same rate as the previous one would never be seen
+        previous = max(thresholdValue(bps), previous + 1)
+        params["level_%d" % (level + 1)] = previous
+    return {
+        "table": table,
+        "match": {"standard_metadata.ingress_port": port},
+        "action_name": "%s.set_quantizer" % table.split('.')[0],
+        "action_params": params,
+    }
+
+
+def quantizerEntries(fabric, calibration=None):
+    """
+    Derives the port_quantizer entries of every switch: the calibrated
+    thresholds of a port if there are some, otherwise thresholds spread over
+    the speed of its link when topology.json gives one. The other ports keep
+    the default of the program.
+
+    :param calibration: dict of switch name -> port -> thresholds, as saved
+                        by this module
+    :return: dict of switch name -> list of runtime entries
+    """
+    calibration = calibration or {}
+    entries = {}
+    for sw in fabric:
+        entries[sw.name] = []
+        for port in sorted(fabric.ports.get(sw.name, {})):
+            thresholds = calibration.get(sw.name, {}).get(port)
+            if thresholds is None and (sw.name, port) in fabric.rated_ports:
+                thresholds = linearThresholds(fabric.linkCapacity(sw.name, port))
+            if thresholds is not None:
+                entries[sw.name].append(quantizerEntry(sw.role, port, thresholds))
+    return entries
+
+
+def loadCalibration(path):
+    """
+    :return: dict of switch name -> port -> thresholds in bits/s
+    """
+    with open(path, 'r') as calibration_file:
+        calibration = json_load_byteified(calibration_file)
+    return dict((name, dict((int(port), thresholds) for port, thresholds in ports.iteritems()))
+                for name, ports in calibration.iteritems())
+
+
+def calibrate(poller, links, capacities, duration, interval):
+    """
+    Samples the rate of every link while the fabric carries its usual load.
+
+    :param poller: a running TelemetryPoller sampling byte_cnt_reg and
+                   last_time_cnt_reg
+    :param links: list of (switch name, port)
+    :param capacities: list of the speeds of the links in bits/s
+    :return: dict of (switch name, port) -> thresholds in bits/s, for the
+             links that carried traffic
+    """
+    samples = []
+    end = time() + duration
+    while time() < end:
+        sleep(interval)
+        samples.append(linkRates(poller, links))
+    # the first samples come before the poller has two values of every port
+    rates = numpy.array(samples[2:] or samples)
+    thresholds = {}
+    for i, link in enumerate(links):
+        levels = calibratedThresholds(rates[:, i], capacities[i]) if len(rates) else None
+        if levels is not None:
+            thresholds[link] = levels
+    return thresholds
+
+
+def main(topology_file, duration, interval, out):
+    fabric = FabricInventory(topology_file)
+    p4info_helpers = {}
+    for role in fabric.roles():
+        p4info_helpers[role] = loadP4InfoHelper(PROGRAMS[role]['p4info'])
+    links = [(sw.name, port) for sw in fabric for port in sorted(fabric.ports.get(sw.name, {}))]
+
+    poller = None
+    try:
+        connections = fabric.connect()
+        poller = TelemetryPoller([(connections[sw.name], p4info_helpers[sw.role]) for sw in fabric],
+                                 registers=['byte_cnt_reg', 'last_time_cnt_reg'],
+                                 interval=interval / 2)
+        poller.start()
+        print "Sampling the rates of %d ports for %.0f s..." % (len(links), duration)
+        sys.stdout.flush()
+        thresholds = calibrate(poller, links, [fabric.linkCapacity(*link) for link in links],
+                               duration, interval)
+    except KeyboardInterrupt:
+        print " Shutting down."
+        thresholds = None
+    except grpc.RpcError as e:
+        printGrpcError(e)
+        thresholds = None
+
+    if poller is not None:
+        poller.stop()
+    ShutdownAllSwitchConnections()
+    if thresholds is None:
+        return 1
+
+    print '\n----- Weight level thresholds (Mbps) -----'
+    calibration = {}
+    for switch, port in links:
+        if (switch, port) not in thresholds:
+            print "%s port %d: no traffic, keeping its thresholds" % (switch, port)
+            continue
+        levels = thresholds[(switch, port)]
+        calibration.setdefault(switch, {})[str(port)] = levels
+        print "%s port %d: %s" % (switch, port, ' '.join('%.2f' % (bps / 1e6) for bps in levels))
+    with open(out, 'w') as out_file:
+        json.dump(calibration, out_file, indent=2, sort_keys=True)
+    print "Wrote the thresholds of %d ports to %s, install them with " \
+        "mycontroller.py --quantizer %s" % (len(thresholds), out, out)
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibrates the weight level thresholds of '
+                                     'the switch ports from the observed link rates')
+    parser.add_argument('--topology', help='topology file describing the fabric',
+                        type=str, action="store", required=False,
+                        default='topology.json')
+    parser.add_argument('--duration', help='seconds of load to sample',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_DURATION)
+    parser.add_argument('--interval', help='seconds between two rate samples',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_INTERVAL)
+    parser.add_argument('--out', help='file to save the thresholds to',
+                        type=str, action="store", required=False,
+                        default='quantizer.json')
+    args = parser.parse_args()
+    sys.exit(main(args.topology, args.duration, args.interval, args.out))
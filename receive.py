@@ -1,7 +1,11 @@
 #!/usr/bin/env python
+import argparse
+import math
+import socket
 import sys
 import struct
 import os
+import time
 
 from scapy.all import sniff, sendp, hexdump, get_if_list, get_if_hwaddr, bind_layers
 from scapy.all import Packet, IPOption
@@ -9,6 +13,10 @@ from scapy.all import ShortField, IntField, LongField, BitField, FieldListField,
 from scapy.all import IP, UDP, Raw, TCP, Ether
 from scapy.layers.inet import _IPOption_HDR
 
+TYPE_WECMP = 0x1234
+# Socket buffer of --fast, deep enough to absorb bursts between two summaries
+RECV_BUFFER_SIZE = 1 << 24
+
 def get_if():
     ifs=get_if_list()
     iface=None
@@ -41,9 +49,104 @@ class WECMP(Packet):
 bind_layers(Ether, WECMP, type=0x1234)
 bind_layers(WECMP, IP)
 
+class PathStats(object):
+    """
+    Packet, byte, max_utilization and interarrival statistics of one path.
+    """
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.utilization = [0] * 256
+        self.last = None
+        self.gaps = 0
+        self.gap_sum = 0.0
+        self.gap_sq_sum = 0.0
+        self.gap_min = None
+        self.gap_max = 0.0
+
+    def summary(self, total_packets, interval):
+        parts = ["%d pkts (%.1f%%)" % (self.packets, 100.0 * self.packets / max(total_packets, 1)),
+                 "%.2f Mbps" % (self.bytes * 8 / interval / 1e6)]
+        histogram = ' '.join('%d:%d' % (level, count)
+                             for level, count in enumerate(self.utilization) if count)
+        parts.append("max_utilization {%s}" % histogram)
+        if self.gaps:
+            mean = self.gap_sum / self.gaps
+            std = math.sqrt(max(self.gap_sq_sum / self.gaps - mean * mean, 0))
+            parts.append("gap mean %.1f std %.1f min %.1f max %.1f us" % (
+                mean * 1e6, std * 1e6, self.gap_min * 1e6, self.gap_max * 1e6))
+        return ', '.join(parts)
+
+def fast_capture(iface, interval):
+    """
+    Counts WECMP packets per path straight from a raw socket. The kernel
+    only hands over frames of the WECMP ethertype; every frame is received
+    into the same buffer and the fixed 10-byte WECMP header is read in
+    place, without building any per-packet object.
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(TYPE_WECMP))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    sock.bind((iface, 0))
+    sock.settimeout(interval)
+    buf = bytearray(65536)
+    view = memoryview(buf)
+    recv_into = sock.recv_into
+    now = time.time
+
+    print "capturing WECMP packets on %s, summary every %.1f s" % (iface, interval)
+    sys.stdout.flush()
+    stats = {}
+    report_at = now() + interval
+    started = now()
+    while True:
+        try:
+            length = recv_into(view)
+        except socket.timeout:
+            length = 0
+        t = now()
+        if length >= 24:
+            path = buf[16] # tag_path_id, recorded hop by hop by the spines
+            path_stats = stats.get(path)
+            if path_stats is None:
+                path_stats = stats[path] = PathStats()
+            path_stats.packets += 1
+            path_stats.bytes += length
+            path_stats.utilization[buf[17]] += 1
+            if path_stats.last is not None:
+                gap = t - path_stats.last
+                path_stats.gaps += 1
+                path_stats.gap_sum += gap
+                path_stats.gap_sq_sum += gap * gap
+                if path_stats.gap_min is None or gap < path_stats.gap_min:
+                    path_stats.gap_min = gap
+                if gap > path_stats.gap_max:
+                    path_stats.gap_max = gap
+            path_stats.last = t
+        if t >= report_at:
+            elapsed = t - started
+            total = sum(path_stats.packets for path_stats in stats.itervalues())
+            print "\n----- %d WECMP packets in %.1f s -----" % (total, elapsed)
+            for path in sorted(stats):
+                print "path %d: %s" % (path, stats[path].summary(total, elapsed))
+            sys.stdout.flush()
+            stats = {}
+            started = t
+            report_at = t + interval
+
 def main():
+    parser = argparse.ArgumentParser(description='Receive WECMP tagged packets')
+    parser.add_argument('--fast', help='count packets per path from a raw socket instead of '
+                        'printing each packet', action="store_true", default=False)
+    parser.add_argument('--interval', help='seconds between two summaries of --fast',
+                        type=float, default=1.0)
+    args = parser.parse_args()
+
     ifaces = filter(lambda i: 'eth' in i, os.listdir('/sys/class/net/'))
     iface = ifaces[0]
+    if args.fast:
+        fast_capture(iface, args.interval)
+        return
     print "sniffing on %s" % iface
     sys.stdout.flush()
     sniff(iface = iface,
@@ -0,0 +1,197 @@
+#!/usr/bin/env python2
+import sys
+from time import time
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from metrics import RPC_LATENCY
+from profiler import PROFILER
+from provision import (DEFAULT_BATCH_SIZE, DEFAULT_MAX_IN_FLIGHT, DEFAULT_WRITE_RETRIES,
+                       buildTableEntries, pipelineCookie, setForwardingPipelineConfig,
+                       writeUpdates)
+
+
+def _strip(value):
+    # P4Runtime servers may return values with or without the leading zero
+    # bytes we sent, so compare them in their shortest form
+    return value.lstrip('\0') or '\0'
+
+def _matchKey(field_match):
+    which = field_match.WhichOneof('field_match_type')
+    match = getattr(field_match, which)
+    if which == 'exact':
+        return (field_match.field_id, which, _strip(match.value))
+    if which == 'lpm':
+        return (field_match.field_id, which, _strip(match.value), match.prefix_len)
+    if which == 'ternary':
+        return (field_match.field_id, which, _strip(match.value), _strip(match.mask))
+    if which == 'range':
+        return (field_match.field_id, which, _strip(match.low), _strip(match.high))
+    return (field_match.field_id, which, match.SerializeToString())
+
+def entryKey(table_entry):
+    """
+    The identity of a table entry: its table, match and priority.
+    """
+    return (table_entry.table_id,
+            table_entry.is_default_action,
+            tuple(sorted(_matchKey(m) for m in table_entry.match)),
+            table_entry.priority)
+
+def actionKey(table_entry):
+    """
+    What a table entry does once matched: its action and parameters.
+    """
+    action = table_entry.action
+    if action.WhichOneof('type') != 'action':
+        return action.SerializeToString()
+    return (action.action.action_id,
+            tuple(sorted((p.param_id, _strip(p.value)) for p in action.action.params)))
+
+
+def installedCookie(sw):
+    """
+    Reads the cookie of the pipeline currently installed on the switch.
+
+    :return: the cookie, or None if the switch has no pipeline or cannot tell
+    """
+    request = p4runtime_pb2.GetForwardingPipelineConfigRequest()
+    request.device_id = sw.device_id
+    request.response_type = p4runtime_pb2.GetForwardingPipelineConfigRequest.COOKIE_ONLY
+    try:
+        response = sw.client_stub.GetForwardingPipelineConfig(request)
+    except grpc.RpcError:
+        return None
+    if not response.config.HasField('cookie'):
+        return None
+    return response.config.cookie.cookie
+
+
+def readInstalledEntries(sw, table_ids, default_table_ids=()):
+    """
+    Reads the entries of the given tables, plus the default entries of
+    others, all in a single ReadRequest. The tables the controller fills at
+    run time, such as path_weight_exact, are left out by not asking for them.
+
+    :param sw: the switch connection
+    :param table_ids: tables whose entries should be read
+    :param default_table_ids: tables whose default entry should be read
+    :return: dict of entryKey -> TableEntry protobuf
+    """
+    request = p4runtime_pb2.ReadRequest()
+    request.device_id = sw.device_id
+    for table_id in sorted(table_ids):
+        request.entities.add().table_entry.table_id = table_id
+    for table_id in sorted(default_table_ids):
+        table_entry = request.entities.add().table_entry
+        table_entry.table_id = table_id
+        table_entry.is_default_action = True
+
+    installed = {}
+    start = time()
+    for response in sw.client_stub.Read(request):
+        for entity in response.entities:
+            installed[entryKey(entity.table_entry)] = entity.table_entry
+    RPC_LATENCY.observe(time() - start, sw.name, 'Read')
+    return installed
+
+
+def diffTableEntries(installed, desired, keep_table_ids=()):
+    """
+    Computes the updates that turn the installed entries into the desired
+    ones. Default entries are never deleted, only modified.
+
+    :param installed: dict of entryKey -> TableEntry, as read from the switch
+                      from the tables of the desired entries only
+    :param desired: list of TableEntry protobufs
+    :param keep_table_ids: tables whose installed entries are left as they
+                           are, only the missing ones being inserted
+    :return: list of (Update type, TableEntry protobuf)
+    """
+    # Deletes go first so they free table space for the inserts
+    wanted = set(entryKey(table_entry) for table_entry in desired)
+    updates = [(p4runtime_pb2.Update.DELETE, table_entry)
+               for key, table_entry in installed.iteritems()
+               if key not in wanted and not table_entry.is_default_action and
+               table_entry.table_id not in keep_table_ids]
+    for table_entry in desired:
+        current = installed.get(entryKey(table_entry))
+        if current is None:
+            if table_entry.is_default_action:
+                updates.append((p4runtime_pb2.Update.MODIFY, table_entry))
+            else:
+                updates.append((p4runtime_pb2.Update.INSERT, table_entry))
+        elif actionKey(current) != actionKey(table_entry) and \
+                table_entry.table_id not in keep_table_ids:
+            updates.append((p4runtime_pb2.Update.MODIFY, table_entry))
+    return updates
+
+
+def syncSwitch(sw, p4info_helper, bmv2_file_path, desired, batch_size=DEFAULT_BATCH_SIZE,
+               cookie=None, max_in_flight=1, retries=DEFAULT_WRITE_RETRIES, failures=None,
+               keep_table_ids=()):
+    """
+    Writes the difference between the desired entries and the ones on the
+    switch, pushing the pipeline first only if the switch runs another one.
+    The controller must already be the primary of the switch.
+
+    :param desired: list of TableEntry protobufs
+    :param cookie: the pipelineCookie of the program, if already computed
+    :param max_in_flight: maximum number of WriteRequests awaiting their
+                          answer; the deletes are done before the rest starts
+    :param retries: times a transient write failure is retried
+    :param failures: list to add a WriteFailure to for every update rejected
+    :param keep_table_ids: tables whose installed entries are left as they
+                           are, see diffTableEntries
+    :return: (list of the updates written, True if the pipeline was pushed)
+    """
+    if cookie is None:
+        cookie = pipelineCookie(p4info_helper.p4info, bmv2_file_path)
+    pushed = installedCookie(sw) != cookie
+    if not pushed:
+        # only the tables of the desired entries: the others are not ours
+        table_ids = set(e.table_id for e in desired if not e.is_default_action)
+        default_table_ids = set(e.table_id for e in desired if e.is_default_action)
+        installed = readInstalledEntries(sw, table_ids, default_table_ids)
+    else:
+        setForwardingPipelineConfig(sw, p4info_helper.p4info, bmv2_file_path)
+        print "Installed P4 Program using SetForwardingPipelineConfig on %s" % sw.name
+        installed = {}
+
+    updates = diffTableEntries(installed, desired, keep_table_ids)
+    deletes = [update for update in updates if update[0] == p4runtime_pb2.Update.DELETE]
+    writeUpdates(sw, deletes, batch_size, max_in_flight, retries, failures)
+    writeUpdates(sw, updates[len(deletes):], batch_size, max_in_flight, retries, failures)
+    return updates, pushed
+
+
+def reconcileSwitch(sw, p4info_helper, bmv2_file_path, table_entries,
+                    batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                    retries=DEFAULT_WRITE_RETRIES, failures=None):
+    """
+    Brings the switch to the desired state without disturbing what is already
+    right: the pipeline is only pushed if the switch runs a different one, and
+    only the entries that differ are inserted, modified or deleted.
+
+    Takes the same arguments as provisionSwitch.
+
+    :return: the wall-clock time spent on the switch, in seconds
+    """
+    start = time()
+    with PROFILER.stage('arbitration', sw.name):
+        sw.MasterArbitrationUpdate()
+    desired = buildTableEntries(p4info_helper, table_entries, sw.name)
+    failed = []
+    updates, _ = syncSwitch(sw, p4info_helper, bmv2_file_path, desired, batch_size,
+                            max_in_flight=max_in_flight, retries=retries,
+                            failures=failed if failures is not None else None)
+    elapsed = time() - start
+    PROFILER.record('switch', sw.name, elapsed)
+    print "Reconciled %s: %d of %d entries changed%s, %.3f s" % (
+        sw.name, len(updates) - len(failed), len(desired),
+        ", %d failed" % len(failed) if failed else '', elapsed)
+    sys.stdout.flush()
+    if failures is not None:
+        failures.extend(failed)
+    return elapsed
@@ -0,0 +1,342 @@
+#!/usr/bin/env python2
+import argparse
+import json
+import os
+import re
+import socket
+import struct
+import sys
+from time import time
+
+import numpy
+
+from fabric import FabricInventory, PROGRAMS
+
+# Room of ipv4_lpm and output_tag_id_exact in both P4 programs
+TABLE_SIZE = 1024
+
+# "arp -i eth0 -s 10.0.1.10 08:00:00:00:01:00" in the commands of a host
+ARP_COMMAND = re.compile(r'arp\s.*-s\s+\S+\s+(\S+)')
+
+
+def ipToInt(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+def intToIp(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def gatewayMac(params):
+    """
+    The MAC address a host sends its packets to, read from the "gateway_mac"
+    key of the host or else from the static ARP entry of its commands.
+
+    :return: the MAC address, or None if the host does not tell
+    """
+    if 'gateway_mac' in params:
+        return params['gateway_mac']
+    for command in params.get('commands', []):
+        match = ARP_COMMAND.search(command)
+        if match:
+            return match.group(1)
+    return None
+
+
+def aggregatePrefixes(routes, subnets=()):
+    """
+    Turns per host routes into the fewest LPM prefixes that forward every
+    host the same way.
+
+    A subnet whose hosts mostly share one action becomes a single prefix,
+    with /32 exceptions for the other hosts; sibling prefixes with the same
+    action are then merged into their parent until nothing merges anymore.
+    The subnets are matched against all the hosts at once with NumPy, which
+    keeps fabrics of many thousand hosts fast.
+
+    :param routes: dict of IPv4 address (int) -> action, any hashable value
+    :param subnets: list of (network int, prefix length) the hosts belong to
+    :return: list of (network int, prefix length, action), longest first
+    """
+    actions = list(set(routes.itervalues()))
+    action_codes = dict((action, code) for code, action in enumerate(actions))
+    ips = numpy.fromiter(routes.iterkeys(), dtype=numpy.int64, count=len(routes))
+    codes = numpy.fromiter((action_codes[action] for action in routes.itervalues()),
+                           dtype=numpy.int64, count=len(routes))
+    alive = numpy.ones(len(routes), dtype=bool)
+    by_length = dict((length, {}) for length in range(33))  # length -> network -> action
+
+    networks = {}  # prefix length -> networks of the subnets of that length
+    for network, length in subnets:
+        networks.setdefault(length, set()).add(network)
+    for length in sorted(networks, reverse=True):
+        mask = (0xffffffff << (32 - length)) & 0xffffffff
+        host_nets = ips & mask
+        inside = numpy.nonzero(alive & numpy.in1d(host_nets, list(networks[length])))[0]
+        if not len(inside):
+            continue
+        # Count the hosts of every (subnet, action) and keep the most common
+        # action of each subnet
+        keys, counts = numpy.unique(host_nets[inside] * len(actions) + codes[inside],
+                                    return_counts=True)
+        key_nets, key_codes = keys // len(actions), keys % len(actions)
+        order = numpy.lexsort((-counts, key_nets))
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = key_nets[order][1:] != key_nets[order][:-1]
+        majority = order[first]
+        # A subnet of hosts that all need their own action gains nothing
+        majority = majority[counts[majority] >= 2]
+        kept_nets, kept_codes = key_nets[majority], key_codes[majority]
+        for network, code in zip(kept_nets, kept_codes):
+            by_length[length][int(network)] = actions[code]
+
+        pos = numpy.minimum(numpy.searchsorted(kept_nets, host_nets[inside]),
+                            max(len(kept_nets) - 1, 0))
+        claimed = inside[kept_nets[pos] == host_nets[inside]] if len(kept_nets) else inside[:0]
+        alive[claimed] = False
+        claimed_pos = numpy.searchsorted(kept_nets, host_nets[claimed])
+        for i in claimed[codes[claimed] != kept_codes[claimed_pos]]:
+            by_length[32][int(ips[i])] = actions[codes[i]]
+    for i in numpy.nonzero(alive)[0]:
+        by_length[32][int(ips[i])] = actions[codes[i]]
+
+    for length in range(32, 0, -1):
+        bit = 1 << (32 - length)
+        level, parents = by_length[length], by_length[length - 1]
+        for network, action in level.items():
+            if network & bit or network not in level:
+                continue
+            if level.get(network | bit) == action and network not in parents:
+                del level[network]
+                del level[network | bit]
+                parents[network] = action
+    return [(network, length, action)
+            for length in range(32, -1, -1)
+            for network, action in sorted(by_length[length].iteritems())]
+
+
+class RouteCompiler(object):
+    """
+    Computes the runtime entries of every switch of the fabric from the
+    topology alone: switch_config_params, ipv4_lpm and output_tag_id_exact.
+
+    Every hop a WECMP packet takes consumes tag_bits of its path id, and the
+    tag of a hop is the rank of the egress port among the shortest path next
+    hops, as in FabricInventory.spinePaths. Since output_tag_id_exact only
+    matches the tag, a switch must rank the same ports for every destination
+    it has several next hops to.
+    """
+
+    def __init__(self, fabric):
+        self.fabric = fabric
+        self.tors = [sw.name for sw in fabric.tors()]
+        self.switch_names = set(sw.name for sw in fabric)
+        self.distances = dict((tor, fabric._distances(tor)) for tor in self.tors)
+
+        # Hosts behind each ToR: (address, MAC, gateway MAC, port on the ToR)
+        self.hosts = {}
+        for tor in self.tors:
+            for port, (peer, _) in sorted(fabric.ports.get(tor, {}).iteritems()):
+                if peer in fabric.hosts:
+                    params = fabric.hosts[peer]
+                    self.hosts.setdefault(tor, []).append((
+                        ipToInt(params['ip'].split('/')[0]), params['mac'],
+                        gatewayMac(params) or params['mac'], port))
+        self._next_hops = {}
+        self._tag_maps = {}
+
+    def nextHops(self, switch, dst):
+        key = (switch, dst)
+        if key not in self._next_hops:
+            self._next_hops[key] = self.fabric.nextHops(switch, self.distances[dst])
+        return self._next_hops[key]
+
+    def tagMap(self, switch):
+        """
+        :return: the next hop ports of the switch indexed by tag, or an empty
+                 list if the switch never has a choice
+        :raises ValueError: if the switch ranks different ports for two
+                            destinations
+        """
+        if switch in self._tag_maps:
+            return self._tag_maps[switch]
+        tag_ports = []
+        for dst in self.tors:
+            if switch == dst or switch not in self.distances[dst]:
+                continue
+            ports = self.nextHops(switch, dst)
+            if len(ports) < 2:
+                continue
+            if tag_ports and ports != tag_ports:
+                raise ValueError("%s: next hops %s towards %s do not match %s, a tag "
+                                 "cannot choose between them" % (switch, ports, dst, tag_ports))
+            tag_ports = ports
+        self._tag_maps[switch] = tag_ports
+        return tag_ports
+
+    def tagBits(self):
+        """
+        :return: the bits of the path id every hop needs to choose its port
+        """
+        widest = max([len(self.tagMap(sw.name)) for sw in self.fabric] + [2])
+        return (widest - 1).bit_length()
+
+    def position(self, switch):
+        # Spines are numbered by their distance from the first ToR
+        return self.distances[self.tors[0]].get(switch, 0)
+
+    def switchId(self, sw):
+        """
+        The id a switch sets with set_config_parameters: a ToR's 1-based rank
+        among the ToRs, which it writes into src_sw_id, and a spine's tag, the
+        rank of the port that reaches it from its first upstream neighbor.
+        """
+        if sw.role == 'tor':
+            return self.tors.index(sw.name) + 1
+        position = self.position(sw.name)
+        upstream = sorted(peer for peer, _ in self.fabric.ports[sw.name].itervalues()
+                          if peer in self.switch_names and self.position(peer) == position - 1)
+        if not upstream:
+            return 0
+        peer_ports = self.fabric.ports[upstream[0]]
+        ports = sorted(port for port, (peer, _) in peer_ports.iteritems()
+                       if peer in self.switch_names and self.position(peer) == position)
+        return [peer_ports[port][0] for port in ports].index(sw.name)
+
+    def hostRoutes(self, switch):
+        """
+        :return: dict of host address (int) -> (next hop MAC, egress port)
+        """
+        routes = {}
+        for tor_index, tor in enumerate(self.tors):
+            if switch == tor:
+                for address, mac, _, host_port in self.hosts.get(tor, []):
+                    routes[address] = (mac, host_port)
+            elif switch in self.distances[tor]:
+                # Plain IPv4 traffic takes one shortest path, spread by
+                # destination ToR so the next hops share the load
+                ports = self.nextHops(switch, tor)
+                port = ports[tor_index % len(ports)]
+                for address, _, gateway_mac, _ in self.hosts.get(tor, []):
+                    routes[address] = (gateway_mac, port)
+        return routes
+
+    def subnets(self):
+        subnets = set()
+        for params in self.fabric.hosts.itervalues():
+            if '/' in params['ip']:
+                address, length = params['ip'].split('/')
+                length = int(length)
+                mask = (0xffffffff << (32 - length)) & 0xffffffff
+                subnets.add((ipToInt(address) & mask, length))
+        return subnets
+
+    def compileSwitch(self, sw, subnets=None):
+        """
+        :return: the "table_entries" list of the switch, in runtime JSON form
+        """
+        action_params = {"id": self.switchId(sw)}
+        if sw.role == 'spine':
+            action_params["position"] = self.position(sw.name)
+        entries = [{
+            "table": "MyIngress.switch_config_params",
+            "action_name": "MyIngress.set_config_parameters",
+            "action_params": action_params,
+        }]
+        for tag, port in enumerate(self.tagMap(sw.name)):
+            entries.append({
+                "table": "MyIngress.output_tag_id_exact",
+                "match": {"meta.output_tag_id": [tag]},
+                "action_name": "MyIngress.tag_forward",
+                "action_params": {"port": port},
+            })
+        entries.append({
+            "table": "MyIngress.ipv4_lpm",
+            "default_action": True,
+            "action_name": "MyIngress.drop",
+            "action_params": {},
+        })
+        if subnets is None:
+            subnets = self.subnets()
+        for network, length, (mac, port) in aggregatePrefixes(self.hostRoutes(sw.name), subnets):
+            entries.append({
+                "table": "MyIngress.ipv4_lpm",
+                "match": {"hdr.ipv4.dstAddr": [intToIp(network), length]},
+                "action_name": "MyIngress.ipv4_forward",
+                "action_params": {"dstAddr": mac, "port": port},
+            })
+        return entries
+
+    def compile(self):
+        """
+        :return: dict of switch name -> list of table entries
+        :raises ValueError: if a switch needs more entries than its tables hold
+        """
+        subnets = self.subnets()
+        entries = {}
+        for sw in self.fabric:
+            entries[sw.name] = self.compileSwitch(sw, subnets)
+            for table in ('MyIngress.ipv4_lpm', 'MyIngress.output_tag_id_exact'):
+                count = sum(1 for entry in entries[sw.name] if entry['table'] == table)
+                if count > TABLE_SIZE:
+                    raise ValueError("%s: %d entries do not fit in %s (%d)" % (
+                        sw.name, count, table, TABLE_SIZE))
+        return entries
+
+
+def tagFlags(tag_bits):
+    """
+    :return: the p4c defines that size the tags consumed by every hop
+    """
+    if not 1 <= tag_bits <= 8:
+        raise ValueError("a path id of 8 bits holds 1 to 8 tag bits, not %d" % tag_bits)
+    return ['-DTAG_BITS=%d' % tag_bits]
+
+
+def writeRuntimeFiles(fabric, entries, out_dir):
+    """
+    Writes one runtime JSON file per switch, named like the hand-written
+    ones, so FabricInventory can read them back.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    for sw in fabric:
+        path = os.path.join(out_dir, os.path.basename(sw.runtime_file))
+        with open(path, 'w') as runtime_file:
+            # dumps goes through the C encoder, dump does not
+            runtime_file.write(json.dumps({
+                "target": "bmv2",
+                "p4info": sw.program['p4info'],
+                "bmv2_json": sw.program['bmv2_json'],
+                "table_entries": entries[sw.name],
+            }))
+
+
+def main(topology_file, out_dir):
+    start = time()
+    fabric = FabricInventory(topology_file)
+    compiler = RouteCompiler(fabric)
+    entries = compiler.compile()
+    writeRuntimeFiles(fabric, entries, out_dir)
+    for sw in fabric:
+        counts = {}
+        for entry in entries[sw.name]:
+            counts[entry['table']] = counts.get(entry['table'], 0) + 1
+        print "%s: %s" % (sw.name, ', '.join('%s=%d' % (table.split('.')[-1], count)
+                                             for table, count in sorted(counts.items())))
+    print "%d switches, %d hosts, %d tag bits per hop, written to %s in %.3f s" % (
+        len(fabric), len(fabric.hosts), compiler.tagBits(), out_dir, time() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WECMP route and path compiler')
+    parser.add_argument('--topology', help='topology file describing the fabric',
+                        type=str, action="store", required=False,
+                        default='topology.json')
+    parser.add_argument('--out-dir', help='directory receiving the runtime JSON files',
+                        type=str, action="store", required=False,
+                        default='build/runtime')
+    args = parser.parse_args()
+    try:
+        main(args.topology, args.out_dir)
+    except ValueError as e:
+        print >> sys.stderr, "Error: %s" % e
+        sys.exit(1)
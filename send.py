@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 import argparse
+import ctypes
+import ctypes.util
+import math
+import os
 import sys
 import socket
 import random
 import struct
+import time
 
 from scapy.all import sendp, send, get_if_list, get_if_hwaddr, bind_layers
 from scapy.all import Packet
@@ -35,18 +40,204 @@ class WECMP(Packet):
 bind_layers(Ether, WECMP, type=0x1234)
 bind_layers(WECMP, IP)
 
-def main():
+def checksum_update(checksum, old_word, new_word):
+    # incremental internet checksum update of one 16-bit word (RFC 1624)
+    total = (~checksum & 0xFFFF) + (~old_word & 0xFFFF) + new_word
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
 
-    if len(sys.argv)<3:
-        print 'pass 2 arguments: <destination> "<message>"'
-        exit(1)
+def build_frames(iface, addr, flows, size, payload=None):
+    """
+    Serializes one WECMP-tagged TCP frame per flow. Scapy builds a single
+    template; the flows only differ in their TCP ports, so each frame is a
+    copy of the template with the ports and TCP checksum patched. Past the
+    16384 ephemeral source ports, the destination port moves on by one.
+    """
+    template = Ether(src=get_if_hwaddr(iface), dst='ff:ff:ff:ff:ff:ff') / \
+        WECMP(src_sw_id=15, selected_path_id=0, tag_path_id=0, max_utilization=0) / \
+        IP(dst=addr) / TCP(dport=1234, sport=49152)
+    if payload is None:
+        payload = 'x' * max(size - len(template), 0)
+    template = str(template / payload)
+    tcp = 14 + 10 + (ord(template[24]) & 0xF) * 4 # Ethernet + WECMP + IP header
+    checksum, = struct.unpack('!H', template[tcp + 16:tcp + 18])
+
+    frames = []
+    for i in range(flows):
+        sport = 49152 + i % 16384
+        dport = 1234 + i // 16384
+        flow_checksum = checksum_update(checksum_update(checksum, 49152, sport), 1234, dport)
+        frames.append(template[:tcp] + struct.pack('!HH', sport, dport) + template[tcp + 4:tcp + 16] +
+                      struct.pack('!H', flow_checksum) + template[tcp + 18:])
+    return frames
+
+def schedule(flows, rate, burst, gap):
+    """
+    The order in which the flows send during one cycle of the gap pattern.
+
+    Flows are served round-robin, one packet per flow per pass. Every flow
+    sends bursts of `burst` packets and then sits out enough passes to stay
+    silent for `gap` micro seconds, so each burst is a separate flowlet at
+    the switches. Flows are staggered so the rate stays constant.
+
+    A cycle sends one burst of every flow, whatever the number of passes, so
+    it lasts flows * burst / rate; a pass is a 1 / (burst + idle) share of
+    it, and a flow is silent for about idle + 1 of them. Passes do not all
+    hold the same number of packets, so idle passes are added until the
+    silence measured on the order covers the gap. When the cycle is not
+    much longer than the gap, no number of idle passes does.
+
+    :return: (order, micro seconds between the packets of a burst,
+        micro seconds the flows are at least silent between their bursts)
+    """
+    cycle = flows * burst * 1e6 / rate
+    most = (flows - 1) * burst
+    if cycle > gap:
+        idle = min(max(int(math.ceil((float(gap) * burst - cycle) / (cycle - gap))), 0), most)
+    else:
+        idle = most
+    while True:
+        period = burst + idle
+        offsets = [f * period // flows for f in range(flows)]
+        order = []
+        for p in range(period):
+            order.extend(f for f in range(flows) if (p + offsets[f]) % period < burst)
+        silence = shortest_silence(order, flows) * 1e6 / rate
+        if silence >= gap or idle >= most:
+            return order, cycle / period, silence
+        idle += 1
+
+def shortest_silence(order, flows):
+    """
+    The longest stretch between two packets of a flow, in packets, of the
+    flow for which it is the shortest, as the order is sent over and over.
+    """
+    first = [None] * flows
+    last = [None] * flows
+    longest = [0] * flows
+    for i, f in enumerate(order):
+        if last[f] is None:
+            first[f] = i
+        else:
+            longest[f] = max(longest[f], i - last[f])
+        last[f] = i
+    return min(max(longest[f], first[f] + len(order) - last[f]) for f in range(flows))
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
 
-    addr = socket.gethostbyname(sys.argv[1])
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+class MmsgSender(object):
+    """
+    Sends frames on a raw AF_PACKET socket, many per system call through
+    sendmmsg(2). The message vectors of every batch of the cycle are built
+    once and replayed, so sending costs no per-packet Python work.
+    """
+
+    def __init__(self, iface, frames, order, batch_size):
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+        self.sock.bind((iface, 0))
+        self.buffers = [ctypes.create_string_buffer(frame, len(frame)) for frame in frames]
+        self.batches = []
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            iovecs = (iovec * len(batch))()
+            msgs = (mmsghdr * len(batch))()
+            for i, f in enumerate(batch):
+                iovecs[i].iov_base = ctypes.cast(self.buffers[f], ctypes.c_void_p)
+                iovecs[i].iov_len = len(frames[f])
+                msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+                msgs[i].msg_hdr.msg_iovlen = 1
+            self.batches.append((msgs, iovecs, len(batch), sum(len(frames[f]) for f in batch)))
+
+    def send(self, batch):
+        msgs, _, count, _ = self.batches[batch]
+        sent = 0
+        while sent < count:
+            ret = self.libc.sendmmsg(self.sock.fileno(), ctypes.byref(msgs, sent * ctypes.sizeof(mmsghdr)),
+                                     count - sent, 0)
+            if ret < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            sent += ret
+        return count, self.batches[batch][3]
+
+def load(iface, addr, flows, rate, duration, burst, gap, size, batch_size):
+    frames = build_frames(iface, addr, flows, size)
+    order, pass_time, silence = schedule(flows, rate, burst, gap)
+    if gap and burst > 1 and pass_time > gap:
+        print "warning: packets of a flow are %.0f us apart, more than the %d us gap; " \
+            "every packet will be a new flowlet" % (pass_time, gap)
+    elif silence < gap:
+        print "warning: flows are only silent for %.0f us between bursts, less than the %d us " \
+            "gap; use more flows, longer bursts or a lower rate" % (silence, gap)
+    sender = MmsgSender(iface, frames, order, batch_size)
+
+    print "sending %d flows at %d pps for %.1f s on interface %s to %s" % (
+        flows, rate, duration, iface, str(addr))
+    sys.stdout.flush()
+    packets = 0
+    sent_bytes = 0
+    batch = 0
+    start = time.time()
+    end = start + duration
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        # pace on the total sent so far, so a late batch is caught up
+        ahead = start + float(packets) / rate - now
+        if ahead > 0:
+            time.sleep(ahead)
+        count, length = sender.send(batch)
+        packets += count
+        sent_bytes += length
+        batch = (batch + 1) % len(sender.batches)
+    elapsed = time.time() - start
+    print "sent %d packets in %.2f s: %.0f pps, %.2f Mbps" % (
+        packets, elapsed, packets / elapsed, sent_bytes * 8 / elapsed / 1e6)
+
+def main():
+    parser = argparse.ArgumentParser(description='Send WECMP tagged packets')
+    parser.add_argument('destination', help='destination host')
+    parser.add_argument('message', help='payload of the single packet to send', nargs='?')
+    parser.add_argument('--flows', help='generate load with this many flows instead of '
+                        'sending a single packet', type=int, default=0)
+    parser.add_argument('--rate', help='packets per second of the load', type=int, default=10000)
+    parser.add_argument('--duration', help='seconds of load', type=float, default=10)
+    parser.add_argument('--burst', help='packets per flowlet burst of each flow', type=int,
+                        default=32)
+    parser.add_argument('--gap', help='silence between the bursts of a flow, in micro seconds',
+                        type=int, default=50000)
+    parser.add_argument('--size', help='frame size of the load, in bytes', type=int, default=1000)
+    parser.add_argument('--batch-size', help='frames per sendmmsg call', type=int, default=64)
+    args = parser.parse_args()
+
+    addr = socket.gethostbyname(args.destination)
     iface = get_if()
 
+    if args.flows:
+        load(iface, addr, args.flows, args.rate, args.duration, args.burst, args.gap,
+             args.size, args.batch_size)
+        return
+    if args.message is None:
+        parser.error('pass a message, or --flows to generate load')
+
     print "sending on interface %s to %s" % (iface, str(addr))
     pkt =  Ether(src=get_if_hwaddr(iface), dst='ff:ff:ff:ff:ff:ff') / WECMP(src_sw_id=15, selected_path_id=0, tag_path_id=0, max_utilization=0)
-    pkt = pkt /IP(dst=addr) / TCP(dport=1234, sport=49152) / sys.argv[2]
+    pkt = pkt /IP(dst=addr) / TCP(dport=1234, sport=49152) / args.message
     pkt.show2()
     sendp(pkt, iface=iface, verbose=False)
 
@@ -0,0 +1,571 @@
+#!/usr/bin/env python2
+import argparse
+import itertools
+import socket
+import struct
+import sys
+from time import time
+
+import numpy
+
+from analyzer import loadCapture
+from fabric import FabricInventory
+from wrr import WEIGHT_BUCKETS, bucketSequence
+
+# Defaults of load_balance.p4
+DEFAULT_FLOWLET_SLOTS = 16
+DEFAULT_FLOWLET_GAP = 20000 # in micro second
+MAX_UTILIZATION = 8
+
+# Seconds between two utilization updates of the simulated ToRs
+DEFAULT_UPDATE_INTERVAL = 0.001
+# Propagation delay of every link, in micro second
+DEFAULT_LINK_DELAY = 10.0
+MTU = 1500
+
+
+def _crc16Table():
+    # CRC-16/ARC, the crc16 of BMv2: reflected polynomial 0x8005, initial 0
+    table = numpy.zeros(256, dtype=numpy.uint32)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table[i] = crc
+    return table
+
+CRC16_TABLE = _crc16Table()
+
+
+def flowletHash(src_ip, dst_ip, proto, sport, dport, slots):
+    """
+    The flowlet slot of each flow, computed like MyIngress does: crc16 over
+    the packed 5-tuple, modulo the table size. Vectorized over flows.
+
+    :param src_ip: NumPy array of IPv4 source addresses, as integers
+    :param dst_ip: NumPy array of IPv4 destination addresses, as integers
+    :param proto: NumPy array of IP protocols
+    :param sport: NumPy array of TCP source ports
+    :param dport: NumPy array of TCP destination ports
+    :param slots: size of the flowlet table
+    :return: NumPy array of slot indices
+    """
+    columns = []
+    for values, width in ((src_ip, 4), (dst_ip, 4), (proto, 1), (sport, 2), (dport, 2)):
+        values = numpy.asarray(values, dtype=numpy.uint64)
+        for shift in range(8 * (width - 1), -1, -8):
+            columns.append(((values >> numpy.uint64(shift)) & numpy.uint64(0xFF)).astype(numpy.uint32))
+    crc = numpy.zeros(len(columns[0]), dtype=numpy.uint32)
+    for column in columns:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ column) & 0xFF]
+    return crc % slots
+
+
+def _ipToInt(address):
+    return struct.unpack('!I', socket.inet_aton(address.split('/')[0]))[0]
+
+def _hostTors(fabric):
+    # (address, ToR index) of every host attached to a ToR
+    tor_index = dict((tor.name, i) for i, tor in enumerate(fabric.tors()))
+    hosts = []
+    for switch, ports in fabric.ports.iteritems():
+        for peer, peer_port in ports.itervalues():
+            if peer_port is None and peer in fabric.hosts and switch in tor_index:
+                hosts.append((_ipToInt(fabric.hosts[peer]['ip']), tor_index[switch]))
+    return hosts
+
+def syntheticTrace(fabric, flows=1000, duration=1.0, flow_packets=200, intra_gap=100.0,
+                   burst_gap=50000.0, burst_len=20, seed=1):
+    """
+    Generates TCP flows between hosts on different ToRs. Each flow sends
+    bursts of packets spaced by intra_gap, separated by longer burst_gap
+    pauses, so it splits into flowlets whenever a pause exceeds the flowlet
+    gap of the switches.
+
+    :param fabric: the FabricInventory
+    :param flows: number of flows
+    :param duration: length of the trace, in seconds
+    :param flow_packets: mean number of packets per flow
+    :param intra_gap: mean gap between packets of a burst, in micro second
+    :param burst_gap: mean gap between bursts, in micro second
+    :param burst_len: mean number of packets per burst
+    :param seed: seed of the random generator
+    :return: trace dict of NumPy arrays, see loadTrace
+    """
+    rng = numpy.random.RandomState(seed)
+    hosts = _hostTors(fabric)
+    if len(set(tor for _, tor in hosts)) < 2:
+        raise ValueError("the topology needs hosts on at least two ToRs")
+
+    src = rng.randint(0, len(hosts), flows)
+    dst = rng.randint(0, len(hosts), flows)
+    host_tor = numpy.array([tor for _, tor in hosts])
+    while True:
+        same = host_tor[src] == host_tor[dst]
+        if not same.any():
+            break
+        dst[same] = rng.randint(0, len(hosts), same.sum())
+    host_ip = numpy.array([ip for ip, _ in hosts], dtype=numpy.uint64)
+
+    counts = rng.geometric(1.0 / flow_packets, flows)
+    total = counts.sum()
+    flow = numpy.repeat(numpy.arange(flows), counts)
+    gaps = numpy.where(rng.random_sample(total) < 1.0 / burst_len,
+                       rng.exponential(burst_gap, total),
+                       rng.exponential(intra_gap, total))
+    first = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    gaps[first] = 0
+    elapsed = numpy.cumsum(gaps)
+    start = rng.uniform(0, duration * 1e6, flows)
+    times = elapsed - numpy.repeat(elapsed[first], counts) + start[flow]
+
+    keep = times < duration * 1e6
+    order = numpy.argsort(times[keep], kind='mergesort')
+    return {
+        'time': times[keep][order],
+        'flow': flow[keep][order],
+        'size': rng.choice([64, MTU], size=keep.sum(), p=[0.2, 0.8])[order],
+        'src_ip': host_ip[src],
+        'dst_ip': host_ip[dst],
+        'proto': numpy.full(flows, 6, dtype=numpy.uint64),
+        'sport': rng.randint(1024, 65536, flows).astype(numpy.uint64),
+        'dport': rng.choice([80, 443, 5001], flows).astype(numpy.uint64),
+        'src_tor': host_tor[src],
+        'dst_tor': host_tor[dst],
+    }
+
+def captureTrace(fabric, columns):
+    """
+    Turns the columns of a capture, as decoded by analyzer.py or saved with
+    its --save option, into a trace. Only the IPv4 packets between hosts of
+    two different ToRs are kept, and every 5-tuple is a flow.
+
+    :param fabric: the FabricInventory the capture was taken on
+    :param columns: dict of column name -> NumPy array, see analyzer.COLUMNS
+    :return: trace dict of NumPy arrays, see loadTrace
+    """
+    hosts = sorted(_hostTors(fabric))
+    host_ip = numpy.array([ip for ip, _ in hosts], dtype=numpy.uint64)
+    host_tor = numpy.array([tor for _, tor in hosts] or [-1])
+
+    def torOf(ips):
+        index = numpy.minimum(numpy.searchsorted(host_ip, ips), max(len(hosts) - 1, 0))
+        return numpy.where(host_ip[index] == ips, host_tor[index], -1) if len(hosts) \
+            else numpy.full(len(ips), -1)
+
+    src_ip = columns['src_ip'].astype(numpy.uint64)
+    dst_ip = columns['dst_ip'].astype(numpy.uint64)
+    src_tor = torOf(src_ip)
+    dst_tor = torOf(dst_ip)
+    index = numpy.nonzero(columns['ipv4'] & (src_tor >= 0) & (dst_tor >= 0) &
+                          (src_tor != dst_tor))[0]
+    if not len(index):
+        raise ValueError("the capture has no packets between hosts of two ToRs")
+    times = columns['time'][index]
+    if (times[1:] < times[:-1]).any():
+        index = index[numpy.argsort(times, kind='mergesort')]
+        times = columns['time'][index]
+
+    _, pair = numpy.unique((src_ip[index] << numpy.uint64(32)) | dst_ip[index],
+                           return_inverse=True)
+    keys = (pair.astype(numpy.uint64) << numpy.uint64(40)) | \
+        (columns['proto'][index].astype(numpy.uint64) << numpy.uint64(32)) | \
+        (columns['sport'][index].astype(numpy.uint64) << numpy.uint64(16)) | \
+        columns['dport'][index].astype(numpy.uint64)
+    _, first, flow = numpy.unique(keys, return_index=True, return_inverse=True)
+    first = index[first]
+    return {
+        'time': (times - times[0]) * 1e6,
+        'flow': flow,
+        'size': columns['length'][index].astype(numpy.int64),
+        'src_ip': src_ip[first],
+        'dst_ip': dst_ip[first],
+        'proto': columns['proto'][first].astype(numpy.uint64),
+        'sport': columns['sport'][first].astype(numpy.uint64),
+        'dport': columns['dport'][first].astype(numpy.uint64),
+        'src_tor': src_tor[first],
+        'dst_tor': dst_tor[first],
+    }
+
+def loadCaptureColumns(path):
+    """
+    :param path: a pcap or pcapng capture, or the .npz file of its columns
+                 saved by analyzer.py --save
+    :return: dict of column name -> NumPy array, see analyzer.COLUMNS
+    """
+    if path.endswith('.npz'):
+        with numpy.load(path) as data:
+            return dict((key, data[key]) for key in data.files)
+    return loadCapture(path)
+
+def saveTrace(trace, path):
+    numpy.savez_compressed(path, **trace)
+
+def loadTrace(path):
+    """
+    Loads a trace saved by saveTrace. A trace holds per-packet arrays 'time'
+    (micro second, sorted), 'flow' and 'size' (bytes), and per-flow arrays
+    'src_ip', 'dst_ip', 'proto', 'sport', 'dport', 'src_tor' and 'dst_tor'
+    (index in FabricInventory.tors()).
+    """
+    with numpy.load(path) as data:
+        return dict((key, data[key]) for key in data.files)
+
+
+def selectRandom(weights, path_count, flowlet_slot, flowlet_tor, state, rng):
+    """
+    The selection of MyIngress: draw in [1, sum of weights] and take the
+    path whose cumulative weight reaches the draw, or any path uniformly if
+    all the weights are 0.
+
+    :param weights: (flowlets, paths) array of the utilization_reg values
+                    seen by each new flowlet
+    :param path_count: number of paths of each flowlet
+    :param flowlet_slot: flowlet table slot of each flowlet
+    :param flowlet_tor: source ToR of each flowlet
+    :param state: dict kept by the selector from one epoch to the next
+    :param rng: the NumPy random generator
+    :return: path id of each flowlet
+    """
+    cumulative = numpy.cumsum(weights, axis=1)
+    count = cumulative[:, -1]
+    draw = numpy.floor(rng.random_sample(len(count)) * count) + 1
+    paths = (cumulative < draw[:, None]).sum(axis=1)
+    uniform = count < 1
+    paths[uniform] = numpy.floor(rng.random_sample(uniform.sum()) * path_count[uniform])
+    return paths
+
+def selectEcmp(weights, path_count, flowlet_slot, flowlet_tor, state, rng):
+    """
+    Plain ECMP for comparison: the path only depends on the flow hash.
+    """
+    return flowlet_slot % path_count
+
+def selectRoundRobin(weights, path_count, flowlet_slot, flowlet_tor, state, rng):
+    """
+    The selection of MyIngress built with -DWEIGHTED_ROUND_ROBIN: every ToR
+    gives the new flowlets the next bucket of the bucketSequence of the
+    weights, refreshed here every epoch.
+    """
+    positions = state.setdefault('positions', {})  # tor -> next bucket
+    sequences = state.setdefault('sequences', {})  # weights -> bucketSequence
+    paths = numpy.empty(len(weights), dtype=int)
+    for tor in numpy.unique(flowlet_tor):
+        mine = numpy.nonzero(flowlet_tor == tor)[0]
+        start = positions.get(tor, 0)
+        buckets = (start + numpy.arange(len(mine))) % WEIGHT_BUCKETS
+        positions[tor] = (start + len(mine)) % WEIGHT_BUCKETS
+        rows, row_of = numpy.unique(weights[mine], axis=0, return_inverse=True)
+        for r, row in enumerate(rows):
+            key = tuple(row)
+            if key not in sequences:
+                sequences[key] = bucketSequence(row.astype(numpy.float64))
+            same = row_of == r
+            paths[mine[same]] = sequences[key][buckets[same]]
+    # the fallback to equal shares also spreads over the missing paths
+    return paths % path_count
+
+# Path selection modes the simulator can compare
+SELECTORS = {
+    'random': selectRandom,
+    'ecmp': selectEcmp,
+    'wrr': selectRoundRobin,
+}
+
+
+def _groupedRunningMax(values, groups, times, span):
+    # running maximum of values in time order, restarting for every group;
+    # span must exceed the range of the values
+    order = numpy.lexsort((times, groups))
+    offset = span * groups[order].astype(numpy.float64)
+    running = numpy.empty(len(values))
+    running[order] = numpy.maximum.accumulate(values[order] + offset) - offset
+    return running
+
+
+class FabricSimulator(object):
+    """
+    Replays a trace through a model of the load_balance.p4 fabric.
+
+    Packets are processed in epochs of update_interval. The flowlet table is
+    modelled exactly: flows hash into slots per source ToR, and a packet
+    arriving more than gap after the previous packet of its slot starts a
+    new flowlet. New flowlets pick a path with the utilization weights of
+    their epoch. At the end of each epoch the link loads give the queueing
+    delay of every path and the next weights, quantized into
+    MAX_UTILIZATION levels from the busiest link of the path like
+    unset_wecmp_header does. With a weight_interval, new flowlets only see
+    the weights of the last multiple of weight_interval, like the ToRs
+    do when the controller refreshes their weight table.
+    """
+
+    def __init__(self, fabric, slots=DEFAULT_FLOWLET_SLOTS, gap=DEFAULT_FLOWLET_GAP,
+                 selector='random', update_interval=DEFAULT_UPDATE_INTERVAL,
+                 link_delay=DEFAULT_LINK_DELAY, seed=1, weight_interval=None):
+        self.slots = slots
+        self.gap = gap
+        self.selector = SELECTORS[selector]
+        self.update_interval = update_interval
+        # epochs between two refreshes of the weights new flowlets see
+        self.refresh_epochs = max(1, int(round((weight_interval or update_interval) /
+                                               update_interval)))
+        self.link_delay = link_delay
+        self.seed = seed
+
+        tors = [tor.name for tor in fabric.tors()]
+        link_index = {}
+        route_links = []
+        self.route_of = {}  # (src tor, dst tor) -> route index of each path id
+        tor_path_links = {}
+        for s, src in enumerate(tors):
+            for d, dst in enumerate(tors):
+                if s == d:
+                    continue
+                routes = []
+                for path_id, hops in enumerate(fabric.spinePaths(src, dst)):
+                    routes.append(len(route_links))
+                    route_links.append([link_index.setdefault(hop, len(link_index))
+                                        for hop in hops])
+                    tor_path_links.setdefault((s, path_id), set()).update(route_links[-1])
+                self.route_of[(s, d)] = routes
+
+        self.tor_count = len(tors)
+        self.path_count = max(path_id for _, path_id in tor_path_links) + 1
+        self.links = sorted(link_index, key=link_index.get)
+        self.capacity = numpy.array([fabric.linkCapacity(*link) for link in self.links])
+        self.route_incidence = numpy.zeros((len(route_links), len(self.links)))
+        for route, links in enumerate(route_links):
+            self.route_incidence[route, links] = 1
+        # rows are (tor, path id) flattened as tor * path_count + path id
+        self.tor_path_incidence = numpy.zeros((self.tor_count * self.path_count, len(self.links)))
+        for (tor, path_id), links in tor_path_links.iteritems():
+            self.tor_path_incidence[tor * self.path_count + path_id, list(links)] = 1
+
+    def _routeTable(self, trace):
+        # route index of (flow, path id), for the path ids each flow can take
+        flows = len(trace['src_tor'])
+        table = numpy.zeros((flows, self.path_count), dtype=int)
+        path_count = numpy.zeros(flows, dtype=int)
+        for f in range(flows):
+            routes = self.route_of[(int(trace['src_tor'][f]), int(trace['dst_tor'][f]))]
+            path_count[f] = len(routes)
+            table[f, :len(routes)] = routes
+            table[f, len(routes):] = routes[0]
+        return table, path_count
+
+    def run(self, trace):
+        """
+        :param trace: the trace dict, see loadTrace
+        :return: report dict
+        """
+        start = time()
+        rng = numpy.random.RandomState(self.seed)
+        times = trace['time']
+        flow = trace['flow']
+        sizes = trace['size'].astype(numpy.float64)
+        packets = len(times)
+
+        # flowlet boundaries depend on packet timing only, so find them all
+        # at once per (source ToR, slot)
+        flow_slot = flowletHash(trace['src_ip'], trace['dst_ip'], trace['proto'],
+                                trace['sport'], trace['dport'], self.slots)
+        flow_key = trace['src_tor'] * self.slots + flow_slot
+        key = flow_key[flow]
+        order = numpy.lexsort((times, key))
+        sorted_key = key[order]
+        sorted_time = times[order]
+        new = numpy.ones(packets, dtype=bool)
+        same_slot = sorted_key[1:] == sorted_key[:-1]
+        new[1:] = ~same_slot | (sorted_time[1:] - sorted_time[:-1] > self.gap)
+        flowlet = numpy.empty(packets, dtype=int)
+        flowlet[order] = numpy.cumsum(new) - 1
+        flowlet_first = order[new]  # first packet of each flowlet
+        flowlets = len(flowlet_first)
+
+        route_table, path_count = self._routeTable(trace)
+        flowlet_flow = flow[flowlet_first]
+        flowlet_tor = trace['src_tor'][flowlet_flow]
+        flowlet_path = numpy.zeros(flowlets, dtype=int)
+        interval = self.update_interval * 1e6
+        flowlet_epoch = (times[flowlet_first] // interval).astype(int)
+        packet_epoch = (times // interval).astype(int)
+        epochs = int(packet_epoch[-1]) + 1 if packets else 0
+        flowlet_bounds = numpy.searchsorted(numpy.sort(flowlet_epoch), numpy.arange(epochs + 1))
+        flowlets_by_epoch = numpy.argsort(flowlet_epoch, kind='mergesort')
+        packet_bounds = numpy.searchsorted(packet_epoch, numpy.arange(epochs + 1))
+
+        weights = numpy.full((self.tor_count, self.path_count), MAX_UTILIZATION)
+        route = numpy.zeros(packets, dtype=int)
+        arrival = numpy.zeros(packets)
+        link_bytes = numpy.zeros(len(self.links))
+        delivered = 0.0
+        service = MTU * 8 / self.capacity * 1e6
+
+        selector_state = {}
+        # new flowlets of each ToR on each path, minus what the weights of
+        # their epoch asked for
+        deviation = numpy.zeros((self.tor_count, self.path_count))
+        for epoch in range(epochs):
+            if epoch % self.refresh_epochs == 0:
+                table_weights = weights.copy()
+            starting = flowlets_by_epoch[flowlet_bounds[epoch]:flowlet_bounds[epoch + 1]]
+            if len(starting):
+                f = flowlet_flow[starting]
+                tors = flowlet_tor[starting]
+                valid = numpy.arange(self.path_count) < path_count[f][:, None]
+                seen = table_weights[tors] * valid
+                flowlet_path[starting] = self.selector(seen, path_count[f], flow_slot[f],
+                                                       tors, selector_state, rng)
+
+                total = seen.sum(axis=1)[:, None].astype(numpy.float64)
+                expected = numpy.where(total > 0, seen / numpy.maximum(total, 1.0),
+                                       valid / path_count[f][:, None].astype(numpy.float64))
+                chosen = numpy.zeros_like(expected)
+                chosen[numpy.arange(len(starting)), flowlet_path[starting]] = 1
+                numpy.add.at(deviation, tors, chosen - expected)
+
+            lo, hi = packet_bounds[epoch], packet_bounds[epoch + 1]
+            if lo == hi:
+                weights[:] = MAX_UTILIZATION
+                continue
+            pkt_flow = flow[lo:hi]
+            route[lo:hi] = route_table[pkt_flow, flowlet_path[flowlet[lo:hi]]]
+            route_bytes = numpy.bincount(route[lo:hi], weights=sizes[lo:hi],
+                                         minlength=len(self.route_incidence))
+            epoch_link_bytes = route_bytes.dot(self.route_incidence)
+            link_bytes += epoch_link_bytes
+            utilization = epoch_link_bytes * 8 / (self.capacity * self.update_interval)
+
+            # overloaded links only carry their capacity
+            scale = numpy.minimum(1, 1 / numpy.maximum(utilization, 1e-12))
+            route_scale = numpy.where(self.route_incidence > 0, scale, 1).min(axis=1)
+            delivered += (route_bytes * route_scale).sum()
+
+            busy = numpy.minimum(utilization, 0.95)
+            link_latency = self.link_delay + service * busy / (1 - busy)
+            route_latency = self.route_incidence.dot(link_latency)
+            arrival[lo:hi] = times[lo:hi] + route_latency[route[lo:hi]]
+
+            path_utilization = (self.tor_path_incidence * utilization).max(axis=1)
+            levels = MAX_UTILIZATION - numpy.floor(MAX_UTILIZATION * path_utilization)
+            weights = numpy.clip(levels, 0, MAX_UTILIZATION).reshape(self.tor_count,
+                                                                      self.path_count)
+
+        # queues are FIFO, so a packet never overtakes an earlier one of its route
+        span = arrival.max() + 1 if packets else 0
+        arrival[:] = _groupedRunningMax(arrival, route, times, span)
+
+        # a packet is reordered if an earlier packet of its flow arrives later
+        by_flow = numpy.lexsort((times, flow))
+        flow_sorted = flow[by_flow]
+        running = _groupedRunningMax(arrival, flow, times, span)[by_flow]
+        reordered = numpy.zeros(packets, dtype=bool)
+        reordered[1:] = (flow_sorted[1:] == flow_sorted[:-1]) & \
+            (arrival[by_flow][1:] < running[:-1] - 1e-3)
+        route_sorted = route[by_flow]
+        path_switches = ((flow_sorted[1:] == flow_sorted[:-1]) &
+                         (route_sorted[1:] != route_sorted[:-1])).sum()
+
+        path_bytes = numpy.zeros((self.tor_count, self.path_count))
+        numpy.add.at(path_bytes, (trace['src_tor'][flow], flowlet_path[flowlet]), sizes)
+        active = path_bytes.sum(axis=1) > 0
+        shares = path_bytes[active] / path_bytes[active].sum(axis=1)[:, None]
+        duration = (times[-1] - times[0]) / 1e6 if packets > 1 else 1.0
+        elapsed = time() - start
+        return {
+            'packets': packets,
+            'flows': len(trace['src_tor']),
+            'flowlets': flowlets,
+            'path_shares': shares,
+            'imbalance': (shares.max(axis=1) * self.path_count).max() if len(shares) else 0.0,
+            'reordered': int(reordered.sum()),
+            'path_switches': int(path_switches),
+            'weight_deviation': numpy.abs(deviation).sum() / 2 / flowlets if flowlets else 0.0,
+            'offered_bps': sizes.sum() * 8 / duration,
+            'delivered_bps': delivered * 8 / duration,
+            'elapsed': elapsed,
+            'packets_per_second': packets / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def printReport(name, report):
+    print "%s: %d packets, %d flows, %d flowlets, simulated at %.0f packets/s" % (
+        name, report['packets'], report['flows'], report['flowlets'],
+        report['packets_per_second'])
+    print "  path byte shares per ToR: %s" % ', '.join(
+        '[' + ' '.join('%.3f' % share for share in shares) + ']'
+        for shares in report['path_shares'])
+    print "  imbalance (max share x paths): %.3f" % report['imbalance']
+    print "  flowlets off the share of their path weights: %.3f%%" % (
+        100.0 * report['weight_deviation'])
+    print "  reordered packets: %d (%.3f%%), path switches: %d" % (
+        report['reordered'], 100.0 * report['reordered'] / max(report['packets'], 1),
+        report['path_switches'])
+    print "  throughput: %.1f of %.1f Mbps offered" % (
+        report['delivered_bps'] / 1e6, report['offered_bps'] / 1e6)
+    sys.stdout.flush()
+
+def _list(cast):
+    return lambda value: [cast(item) for item in value.split(',')]
+
+def main(args):
+    fabric = FabricInventory(args.topology)
+    if args.trace:
+        trace = loadTrace(args.trace)
+    elif args.capture:
+        trace = captureTrace(fabric, loadCaptureColumns(args.capture))
+    else:
+        trace = syntheticTrace(fabric, flows=args.flows, duration=args.duration,
+                               flow_packets=args.flow_packets, seed=args.seed)
+    if args.save_trace:
+        saveTrace(trace, args.save_trace)
+
+    for slots, gap, selector in itertools.product(args.slots, args.gap, args.selector):
+        simulator = FabricSimulator(fabric, slots=slots, gap=gap, selector=selector,
+                                    update_interval=args.update_interval, seed=args.seed,
+                                    weight_interval=args.weight_interval)
+        printReport("slots=%d gap=%dus selector=%s" % (slots, gap, selector),
+                    simulator.run(trace))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline WECMP fabric simulator')
+    parser.add_argument('--topology', help='topology file describing the fabric',
+                        type=str, action="store", required=False,
+                        default='topology.json')
+    parser.add_argument('--trace', help='trace saved with --save-trace to replay',
+                        type=str, action="store", required=False)
+    parser.add_argument('--capture', help='pcap or pcapng capture, or its columns saved with '
+                        'analyzer.py --save, to replay as a trace',
+                        type=str, action="store", required=False)
+    parser.add_argument('--save-trace', help='save the replayed trace to this .npz file',
+                        type=str, action="store", required=False)
+    parser.add_argument('--flows', help='flows of the synthetic trace',
+                        type=int, action="store", required=False, default=1000)
+    parser.add_argument('--flow-packets', help='mean packets per flow of the synthetic trace',
+                        type=int, action="store", required=False, default=1000)
+    parser.add_argument('--duration', help='seconds of synthetic trace',
+                        type=float, action="store", required=False, default=1.0)
+    parser.add_argument('--slots', help='comma separated flowlet table sizes to compare',
+                        type=_list(int), action="store", required=False,
+                        default=[DEFAULT_FLOWLET_SLOTS])
+    parser.add_argument('--gap', help='comma separated flowlet gaps to compare, in micro second',
+                        type=_list(int), action="store", required=False,
+                        default=[DEFAULT_FLOWLET_GAP])
+    parser.add_argument('--selector', help='comma separated path selections to compare '
+                        '(%s)' % ', '.join(sorted(SELECTORS)),
+                        type=_list(str), action="store", required=False,
+                        default=['random'])
+    parser.add_argument('--update-interval', help='seconds between two weight updates',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_UPDATE_INTERVAL)
+    parser.add_argument('--weight-interval', help='seconds between two refreshes of the '
+                        'weights new flowlets see, as with --controller-weights '
+                        '(default: every update)',
+                        type=float, action="store", required=False)
+    parser.add_argument('--seed', help='seed of the random generators',
+                        type=int, action="store", required=False, default=1)
+    args = parser.parse_args()
+    for selector in args.selector:
+        if selector not in SELECTORS:
+            parser.error("unknown selector '%s'" % selector)
+    main(args)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python2
+import cPickle
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from time import time
+
+from fabric import FabricInventory, PROGRAMS
+from p4build import p4InfoHelperFromString
+from profiler import PROFILER
+from provision import CompiledEntries, ENTRY_CACHE, buildTableEntries
+
+SNAPSHOT_MAGIC = 'WECMPSNP'
+# Bumped whenever the layout or the contents of the sections change
+SNAPSHOT_VERSION = 1
+
+DEFAULT_SNAPSHOT = 'build/controller.snapshot'
+
+# magic, version, input key, number of sections
+_HEADER = struct.Struct('<8sI32sI')
+# name, offset and length of a section
+_SECTION = struct.Struct('<64sQQ')
+# Sections start on 8-byte boundaries, so the arrays in them can be mapped
+_ALIGN = 8
+
+# Offsets of the serialized entries in a "compiled/" section
+_OFFSET_TYPE = 'I'
+
+
+def snapshotKey(topology_file, flags, generate_routes=False, quantizer_file=None):
+    """
+    Identifies everything the state of a snapshot is derived from: the size
+    and modification time of the topology, the runtime files, the P4 sources
+    and their build outputs, and the p4c flags. Like make, only the files'
+    metadata is read, not their contents.
+
+    :return: a 32-byte digest
+    """
+    fabric = FabricInventory(topology_file)
+    paths = [topology_file]
+    for role in fabric.roles():
+        program = PROGRAMS[role]
+        paths += [program['source'], program['p4info'], program['bmv2_json']]
+    if not generate_routes:
+        paths += [sw.runtime_file for sw in fabric]
+    if quantizer_file:
+        paths.append(quantizer_file)
+
+    digest = hashlib.sha256()
+    digest.update('%d\0%s\0%d\0' % (SNAPSHOT_VERSION, sys.byteorder, generate_routes))
+    digest.update('\0'.join(flags) + '\0')
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            digest.update('%s\0%d\0%r\0' % (os.path.abspath(path), stat.st_size, stat.st_mtime))
+        except OSError:
+            digest.update('%s\0missing\0' % os.path.abspath(path))
+    return digest.digest()
+
+
+def _compiledSection(p4info_helper, table_entries):
+    # the offsets of the entries, then the entries back to back
+    if isinstance(table_entries, CompiledEntries) and \
+            table_entries.program == ENTRY_CACHE.programKey(p4info_helper.p4info):
+        serialized = table_entries.serialized()
+    else:
+        serialized = [table_entry.SerializeToString()
+                      for table_entry in buildTableEntries(p4info_helper, table_entries)]
+    offsets = array(_OFFSET_TYPE, [0])
+    for data in serialized:
+        offsets.append(offsets[-1] + len(data))
+    return struct.pack('<I', len(serialized)) + offsets.tostring() + ''.join(serialized)
+
+
+def saveSnapshot(path, key, fabric, p4info_helpers, table_entries, samples=()):
+    """
+    Writes the desired state of the fabric to a snapshot file: the P4Info of
+    every role, the runtime entries of every switch along with their
+    TableEntry protobufs, and the last telemetry samples. The file is
+    written aside and renamed into place, so a reader never sees half of it.
+
+    :param key: snapshotKey of the inputs the state was derived from
+    :param table_entries: dict of switch name -> runtime entries
+    :param samples: list of (switch name, register, index, timestamp, value)
+    """
+    start = time()
+    with PROFILER.stage('snapshot'):
+        sections = []
+        for role, p4info_helper in sorted(p4info_helpers.iteritems()):
+            sections.append(('p4info/%s' % role, p4info_helper.p4info.SerializeToString()))
+        for sw in fabric:
+            entries = table_entries[sw.name]
+            sections.append(('entries/%s' % sw.name, cPickle.dumps(list(entries), 2)))
+            sections.append(('compiled/%s' % sw.name,
+                             _compiledSection(p4info_helpers[sw.role], entries)))
+        sections.append(('telemetry', cPickle.dumps(list(samples), 2)))
+
+        index = []
+        offset = _HEADER.size + _SECTION.size * len(sections)
+        for name, data in sections:
+            if len(name) > _SECTION.size - 16:
+                raise ValueError("snapshot section name too long: %s" % name)
+            offset += -offset % _ALIGN
+            index.append(_SECTION.pack(name, offset, len(data)))
+            offset += len(data)
+
+        directory = os.path.dirname(path) or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, key, len(sections)))
+            tmp_file.write(''.join(index))
+            for name, data in sections:
+                tmp_file.write('\0' * (-tmp_file.tell() % _ALIGN))
+                tmp_file.write(data)
+            size = tmp_file.tell()
+        os.rename(tmp_path, path)
+    print "Saved the snapshot of %d switches to %s: %.1f MB in %.3f s" % (
+        len(fabric), path, size / 1e6, time() - start)
+    sys.stdout.flush()
+
+
+class Snapshot(object):
+    """
+    A snapshot file mapped in memory. Its sections are only read when asked
+    for, and the serialized entries of a switch only when the switch is
+    provisioned, so a warm start costs about one read of the file.
+    """
+
+    def __init__(self, path):
+        """
+        :raise ValueError: if the file is not a snapshot of this version
+        """
+        with open(path, 'rb') as snapshot_file:
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < _HEADER.size:
+            raise ValueError("%s: truncated snapshot" % path)
+        magic, version, self.key, count = _HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("%s: not a snapshot" % path)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("%s: snapshot version %d, expected %d" % (
+                path, version, SNAPSHOT_VERSION))
+        if len(self.map) < _HEADER.size + _SECTION.size * count:
+            raise ValueError("%s: truncated snapshot" % path)
+        self.sections = {}  # name -> (offset, length)
+        for i in range(count):
+            name, offset, length = _SECTION.unpack_from(self.map, _HEADER.size + _SECTION.size * i)
+            if offset + length > len(self.map):
+                raise ValueError("%s: truncated snapshot" % path)
+            self.sections[name.rstrip('\0')] = (offset, length)
+
+    def section(self, name):
+        """
+        :return: a buffer over the section, read from the file when sliced
+        """
+        if name not in self.sections:
+            raise ValueError("snapshot has no section %s" % name)
+        offset, length = self.sections[name]
+        return buffer(self.map, offset, length)
+
+    def p4InfoHelpers(self):
+        """
+        :return: dict of role -> P4Info helper
+        """
+        return dict((name.split('/', 1)[1], p4InfoHelperFromString(self.section(name)[:]))
+                    for name in self.sections if name.startswith('p4info/'))
+
+    def tableEntries(self, fabric, p4info_helpers):
+        """
+        :return: dict of switch name -> CompiledEntries
+        """
+        entries = {}
+        for sw in fabric:
+            flows = cPickle.loads(self.section('entries/%s' % sw.name)[:])
+            compiled = self.section('compiled/%s' % sw.name)
+            count, = struct.unpack('<I', compiled[:4])
+            offsets = array(_OFFSET_TYPE)
+            offsets.fromstring(compiled[4:4 + offsets.itemsize * (count + 1)])
+            data = buffer(compiled, 4 + offsets.itemsize * (count + 1))
+            entries[sw.name] = CompiledEntries(
+                flows, ENTRY_CACHE.programKey(p4info_helpers[sw.role].p4info), data, offsets)
+        return entries
+
+    def samples(self):
+        """
+        :return: list of (switch name, register, index, timestamp, value)
+        """
+        return cPickle.loads(self.section('telemetry')[:])
+
+
+def loadSnapshot(path, key):
+    """
+    :param key: snapshotKey of the current inputs
+    :return: the Snapshot, or None if there is none or it is out of date
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with PROFILER.stage('snapshot'):
+            snapshot = Snapshot(path)
+    except (ValueError, EnvironmentError) as e:
+        print "Ignoring the snapshot: %s" % e
+        return None
+    if snapshot.key != key:
+        print "Ignoring the snapshot %s, the topology, runtime or P4 files changed" % path
+        return None
+    return snapshot
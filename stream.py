@@ -0,0 +1,179 @@
+#!/usr/bin/env python2
+import sys
+import threading
+import traceback
+from Queue import Queue
+from time import time
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from p4runtime_lib.error_utils import printGrpcError
+from provision import setElectionId
+from telemetry import decodeP4Data
+
+# Defines passed to p4c to make the ToRs report the path changes of flowlets
+PATH_CHANGE_DIGEST_FLAGS = ['-DPATH_CHANGE_DIGEST']
+
+# Name of the digest in the ToR p4info, after its struct type
+PATH_CHANGE_DIGEST = 'path_change_t'
+
+# Messages received but not yet dispatched; once full, the readers stop
+# pulling from their stream and gRPC flow control pushes back on the switches
+DEFAULT_QUEUE_SIZE = 1024
+
+
+def digestId(p4info_helper, name):
+    """
+    :return: the id of the digest of the given name, or None if the program
+             has no such digest
+    """
+    for digest in p4info_helper.p4info.digests:
+        if digest.preamble.name == name or digest.preamble.name.endswith('.' + name):
+            return digest.preamble.id
+    return None
+
+
+def enableDigest(sw, digest_id, max_timeout_ns=0, max_list_size=1, ack_timeout_ns=1000000000,
+                 update_type=p4runtime_pb2.Update.INSERT):
+    """
+    Asks the switch to stream the digest. With the defaults, every message is
+    sent as soon as it is generated, which keeps the reaction latency low.
+
+    :param update_type: MODIFY to reconfigure a digest already enabled
+    """
+    request = p4runtime_pb2.WriteRequest()
+    request.device_id = sw.device_id
+    setElectionId(request.election_id, sw)
+    update = request.updates.add()
+    update.type = update_type
+    digest_entry = update.entity.digest_entry
+    digest_entry.digest_id = digest_id
+    digest_entry.config.max_timeout_ns = max_timeout_ns
+    digest_entry.config.max_list_size = max_list_size
+    digest_entry.config.ack_timeout_ns = ack_timeout_ns
+    sw.client_stub.Write(request)
+
+
+def decodeDigest(digest_list):
+    """
+    :return: list of the digest messages, each a tuple of the struct members
+    """
+    messages = []
+    for data in digest_list.data:
+        if data.WhichOneof('data') == 'struct':
+            messages.append(tuple(decodeP4Data(member) for member in data.struct.members))
+        else:
+            messages.append((decodeP4Data(data),))
+    return messages
+
+
+class StreamDispatcher(object):
+    """
+    Consumes the StreamChannel of every switch and hands the messages to the
+    handlers registered for their type, e.g. 'digest' or 'packet'.
+
+    Every stream has one reader thread blocked on it, so nothing is polled
+    and a message is dispatched as soon as it arrives. gRPC only gives
+    blocking iterators over a stream on Python 2, so there is one reader
+    thread per switch rather than a single event loop. The readers feed a
+    single bounded queue emptied by one dispatcher thread, which runs the
+    handlers in arrival order and acknowledges the digests they processed.
+
+    The streams are the ones opened by the switch connections, so the
+    readers must start after the master arbitration of every switch.
+    """
+
+    def __init__(self, connections, queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        :param connections: dict of switch name -> switch connection
+        :param queue_size: number of messages waiting for the handlers
+        """
+        self.connections = connections
+        self.queue = Queue(maxsize=queue_size)
+        self.handlers = {}
+        self.readers = []
+        self.thread = None
+        self.dispatched = 0
+        self.max_latency = 0.0
+
+    def on(self, kind, handler):
+        """
+        Registers a handler, called with the switch name and the message of
+        the given StreamMessageResponse type, e.g. a DigestList for 'digest'
+        or a PacketIn for 'packet'.
+        """
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def _read(self, name, sw):
+        try:
+            for message in sw.stream_msg_resp:
+                # Blocks while the dispatcher is behind
+                self.queue.put((name, time(), message))
+        except grpc.RpcError as e:
+            # Shutting the connection down cancels the stream
+            if e.code() != grpc.StatusCode.CANCELLED:
+                printGrpcError(e)
+
+    def ack(self, name, digest_list):
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.digest_ack.digest_id = digest_list.digest_id
+        request.digest_ack.list_id = digest_list.list_id
+        self.connections[name].requests_stream.put(request)
+
+    def _dispatch(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, received, message = item
+            kind = message.WhichOneof('update')
+            for handler in self.handlers.get(kind, []):
+                try:
+                    handler(name, getattr(message, kind))
+                except Exception:
+                    traceback.print_exc()
+            if kind == 'digest':
+                self.ack(name, message.digest)
+            self.dispatched += 1
+            self.max_latency = max(self.max_latency, time() - received)
+            sys.stdout.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._dispatch, name='dispatch')
+        self.thread.daemon = True
+        self.thread.start()
+        for name, sw in sorted(self.connections.iteritems()):
+            reader = threading.Thread(target=self._read, args=(name, sw),
+                                      name='stream-%s' % name)
+            reader.daemon = True
+            reader.start()
+            self.readers.append(reader)
+
+    def stop(self):
+        """
+        Stops the dispatcher once the queued messages are handled. The readers
+        end when the connections are shut down.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+
+
+class PathChangeLog(object):
+    """
+    Handler of the path change digests of the ToRs, counting the flowlets
+    moved from each path to each other.
+    """
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.moves = {}  # (switch name, old path id, new path id) -> count
+
+    def __call__(self, name, digest_list):
+        for sw_id, flowlet, flowlet_sig, old_path_id, new_path_id in decodeDigest(digest_list):
+            key = (name, old_path_id, new_path_id)
+            self.moves[key] = self.moves.get(key, 0) + 1
+            if self.verbose:
+                print "%s: flowlet %d (signature %04x) moved from path %d to %d" % (
+                    name, flowlet, flowlet_sig, old_path_id, new_path_id)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python2
+import argparse
+import os
+import sys
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from fabric import FabricInventory, PROGRAMS
+from metrics import (MetricsExporter, EXPORTED_REGISTERS, RPC_LATENCY,
+                     DEFAULT_PORT as DEFAULT_METRICS_PORT)
+from p4build import loadP4InfoHelper
+from p4runtime_lib.error_utils import printGrpcError
+from p4runtime_lib.switch import ShutdownAllSwitchConnections
+
+# Registers sampled on every switch that has them
+REGISTERS = ['utilization_reg', 'byte_cnt_reg', 'last_time_cnt_reg']
+
+DEFAULT_INTERVAL = 0.2
+DEFAULT_CAPACITY = 4096
+
+
+class RingBuffer(object):
+    """
+    Fixed-size time series of (timestamp, value) samples kept in two flat
+    double arrays. Once full, the oldest samples are overwritten.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def last(self):
+        if self.count == 0:
+            return None
+        i = (self.head - 1) % self.capacity
+        return self.timestamps[i], self.values[i]
+
+    def _order(self, data):
+        start = (self.head - self.count) % self.capacity
+        if start + self.count <= self.capacity:
+            return data[start:start + self.count]
+        return data[start:] + data[:self.head]
+
+    def samples(self):
+        """
+        :return: (timestamps, values) arrays, oldest sample first
+        """
+        return self._order(self.timestamps), self._order(self.values)
+
+    def toNumpy(self):
+        """
+        :return: a (count, 2) float64 NumPy array of timestamps and values,
+                 oldest sample first
+        """
+        import numpy
+        timestamps, values = self.samples()
+        return numpy.column_stack((numpy.frombuffer(timestamps, dtype=numpy.float64),
+                                   numpy.frombuffer(values, dtype=numpy.float64)))
+
+
+def decodeP4Data(data):
+    if not data.bitstring:
+        return 0
+    return int(data.bitstring.encode('hex'), 16)
+
+
+def registerIds(p4info_helper, names):
+    """
+    Resolves register names to ids. A name matches a register of the same
+    full name, or any control's register of that short name.
+
+    :return: dict of name -> register id, for the names found in the p4info
+    """
+    ids = {}
+    for register in p4info_helper.p4info.registers:
+        full_name = register.preamble.name
+        for name in names:
+            if full_name == name or full_name.endswith('.' + name):
+                ids[name] = register.preamble.id
+    return ids
+
+
+def readRegisters(sw, register_ids):
+    """
+    Reads all the indices of the registers with one wildcard entity per
+    register, all in a single ReadRequest.
+
+    :param sw: the switch connection
+    :param register_ids: dict of name -> register id
+    :return: dict of (name, index) -> value
+    """
+    names = dict((register_id, name) for name, register_id in register_ids.iteritems())
+    request = p4runtime_pb2.ReadRequest()
+    request.device_id = sw.device_id
+    for register_id in register_ids.itervalues():
+        request.entities.add().register_entry.register_id = register_id
+
+    values = {}
+    start = time()
+    for response in sw.client_stub.Read(request):
+        for entity in response.entities:
+            register = entity.register_entry
+            values[(names[register.register_id], register.index.index)] = \
+                decodeP4Data(register.data)
+    RPC_LATENCY.observe(time() - start, sw.name, 'Read')
+    return values
+
+
+class TelemetryPoller(object):
+    """
+    Samples the registers of every switch in parallel at a fixed interval and
+    keeps each (switch, register, index) series in a RingBuffer.
+    """
+
+    def __init__(self, switches, registers=REGISTERS, interval=DEFAULT_INTERVAL,
+                 capacity=DEFAULT_CAPACITY):
+        """
+        :param switches: list of (switch connection, P4Info helper)
+        :param registers: register names to sample
+        :param interval: seconds between two polls
+        :param capacity: number of samples kept per series
+        """
+        self.interval = interval
+        self.capacity = capacity
+        self.switches = []
+        for sw, p4info_helper in switches:
+            register_ids = registerIds(p4info_helper, registers)
+            if register_ids:
+                self.switches.append((sw, register_ids))
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.switches), 1))
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def buffer(self, switch_name, register, index):
+        key = (switch_name, register, index)
+        ring = self.buffers.get(key)
+        if ring is None:
+            with self.lock:
+                ring = self.buffers.setdefault(key, RingBuffer(self.capacity))
+        return ring
+
+    def _pollSwitch(self, sw, register_ids):
+        values = readRegisters(sw, register_ids)
+        now = time()
+        for (register, index), value in values.iteritems():
+            self.buffer(sw.name, register, index).append(now, value)
+
+    def pollOnce(self):
+        futures = [self.executor.submit(self._pollSwitch, sw, register_ids)
+                   for sw, register_ids in self.switches]
+        for future in futures:
+            future.result()
+
+    def _run(self):
+        next_poll = time()
+        while not self.stopped.is_set():
+            try:
+                self.pollOnce()
+            except grpc.RpcError as e:
+                printGrpcError(e)
+            # Keep a fixed rate; if a poll overran, start the next one now
+            next_poll = max(next_poll + self.interval, time())
+            self.stopped.wait(next_poll - time())
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='telemetry')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def lastSamples(self):
+        """
+        :return: list of (switch name, register, index, timestamp, value),
+                 the last sample of every series
+        """
+        with self.lock:
+            buffers = self.buffers.items()
+        return [key + ring.last() for key, ring in buffers if len(ring)]
+
+    def seed(self, samples):
+        """
+        Starts the series of the polled switches and registers with earlier
+        samples, e.g. those a snapshot kept from the previous run.
+
+        :param samples: list of (switch name, register, index, timestamp, value)
+        """
+        polled = dict((sw.name, register_ids) for sw, register_ids in self.switches)
+        for switch_name, register, index, timestamp, value in samples:
+            if register in polled.get(switch_name, ()):
+                self.buffer(switch_name, register, index).append(timestamp, value)
+
+    def latest(self, register):
+        """
+        :return: dict of (switch name, index) -> last sampled value
+        """
+        latest = {}
+        for (switch_name, name, index), ring in self.buffers.items():
+            if name == register and len(ring):
+                latest[(switch_name, index)] = ring.last()[1]
+        return latest
+
+
+def main(topology_file, interval, report_interval, metrics_port=None):
+    fabric = FabricInventory(topology_file)
+    p4info_helpers = {}
+    for role in fabric.roles():
+        p4info_helpers[role] = loadP4InfoHelper(PROGRAMS[role]['p4info'])
+
+    registers = REGISTERS
+    if metrics_port is not None:
+        registers = sorted(set(REGISTERS + EXPORTED_REGISTERS))
+
+    poller = None
+    exporter = None
+    try:
+        connections = fabric.connect()
+        poller = TelemetryPoller([(connections[sw.name], p4info_helpers[sw.role]) for sw in fabric],
+                                 registers=registers, interval=interval)
+        poller.start()
+        if metrics_port is not None:
+            exporter = MetricsExporter(poller, port=metrics_port)
+            exporter.start()
+            print "Serving metrics on port %d" % metrics_port
+        while True:
+            sleep(report_interval)
+            print '\n----- Path utilization -----'
+            for (switch_name, index), value in sorted(poller.latest('utilization_reg').items()):
+                print "%s utilization_reg %d: %d" % (switch_name, index, value)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print " Shutting down."
+    except grpc.RpcError as e:
+        printGrpcError(e)
+
+    if exporter is not None:
+        exporter.stop()
+    if poller is not None:
+        poller.stop()
+    ShutdownAllSwitchConnections()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WECMP register telemetry poller')
+    parser.add_argument('--topology', help='topology file describing the fabric',
+                        type=str, action="store", required=False,
+                        default='topology.json')
+    parser.add_argument('--interval', help='seconds between two register polls',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_INTERVAL)
+    parser.add_argument('--report-interval', help='seconds between two printed reports',
+                        type=float, action="store", required=False,
+                        default=2)
+    parser.add_argument('--metrics-port', help='serve Prometheus metrics on this port',
+                        type=int, action="store", required=False,
+                        nargs='?', const=DEFAULT_METRICS_PORT)
+    args = parser.parse_args()
+    main(args.topology, args.interval, args.report_interval, args.metrics_port)
@@ -0,0 +1,88 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import grpc
+from google.protobuf import text_format
+from google.rpc import code_pb2
+from p4.v1 import p4runtime_pb2
+
+import p4runtime_lib.bmv2
+import p4runtime_lib.helper
+from p4runtime_lib.switch import ShutdownAllSwitchConnections
+from benchmark import benchmarkEntries, benchmarkP4Info
+from fakeswitch import FakeP4RuntimeServer
+from provision import buildTableEntry, setForwardingPipelineConfig, writeUpdates
+
+
+class WriteUpdatesTest(unittest.TestCase):
+    """
+    writeUpdates against a FakeP4RuntimeServer failing a share of the
+    updates as UNAVAILABLE.
+    """
+
+    def setUp(self):
+        random.seed(1)
+        self.work_dir = tempfile.mkdtemp()
+        p4info_path = os.path.join(self.work_dir, 'p4info.txt')
+        with open(p4info_path, 'w') as p4info_file:
+            p4info_file.write(text_format.MessageToString(benchmarkP4Info()))
+        bmv2_file_path = os.path.join(self.work_dir, 'bmv2.json')
+        with open(bmv2_file_path, 'w') as bmv2_file:
+            bmv2_file.write('{}')
+        self.p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_path)
+
+        self.server = FakeP4RuntimeServer(port=0).start()
+        self.sw = p4runtime_lib.bmv2.Bmv2SwitchConnection(
+            name='s1', address='127.0.0.1:%d' % self.server.port, device_id=0)
+        self.sw.MasterArbitrationUpdate()
+        setForwardingPipelineConfig(self.sw, self.p4info_helper.p4info, bmv2_file_path)
+        self.table_id = self.p4info_helper.get_tables_id('MyIngress.ipv4_lpm')
+        self.updates = [(p4runtime_pb2.Update.INSERT, buildTableEntry(self.p4info_helper, flow))
+                        for flow in benchmarkEntries(0, 64)
+                        if flow['table'] == 'MyIngress.ipv4_lpm' and 'match' in flow]
+
+    def tearDown(self):
+        ShutdownAllSwitchConnections()
+        self.server.stop()
+        shutil.rmtree(self.work_dir)
+
+    def installed(self):
+        device = self.server.servicer.device(0)
+        with device.lock:
+            return len(device.tables.get(self.table_id, {}))
+
+    def testBusyUpdatesAreRetried(self):
+        self.server.servicer.busy_rate = 0.5
+        failures = []
+        batches = writeUpdates(self.sw, self.updates, batch_size=16, retries=20,
+                               failures=failures)
+        self.assertEqual(failures, [])
+        self.assertEqual(self.installed(), len(self.updates))
+        self.assertGreater(batches, 4)
+
+    def testRetriesRunOut(self):
+        self.server.servicer.busy_rate = 1.0
+        failures = []
+        batches = writeUpdates(self.sw, self.updates[:8], batch_size=8, retries=2,
+                               failures=failures)
+        self.assertEqual(batches, 3)
+        self.assertEqual(len(failures), 8)
+        self.assertTrue(all(failure.code == code_pb2.UNAVAILABLE for failure in failures))
+        self.assertEqual(self.installed(), 0)
+
+    def testExistingEntriesFail(self):
+        writeUpdates(self.sw, self.updates[:8])
+        failures = []
+        writeUpdates(self.sw, self.updates, batch_size=16, failures=failures)
+        self.assertEqual(len(failures), 8)
+        self.assertTrue(all(failure.code == code_pb2.ALREADY_EXISTS for failure in failures))
+        self.assertEqual(self.installed(), len(self.updates))
+        with self.assertRaises(grpc.RpcError):
+            writeUpdates(self.sw, self.updates[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
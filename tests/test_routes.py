@@ -0,0 +1,47 @@
+import random
+import unittest
+
+from routes import aggregatePrefixes, ipToInt
+
+
+def lookup(prefixes, ip):
+    for network, length, action in prefixes:
+        mask = (0xffffffff << (32 - length)) & 0xffffffff
+        if ip & mask == network:
+            return action
+    return None
+
+
+class AggregatePrefixesTest(unittest.TestCase):
+
+    def testSubnetWithException(self):
+        routes = dict((ipToInt('10.0.1.%d' % host), 'a') for host in range(1, 5))
+        routes[ipToInt('10.0.1.5')] = 'b'
+        self.assertEqual(aggregatePrefixes(routes, [(ipToInt('10.0.1.0'), 24)]),
+                         [(ipToInt('10.0.1.5'), 32, 'b'), (ipToInt('10.0.1.0'), 24, 'a')])
+
+    def testSiblingsMerge(self):
+        routes = dict((ipToInt('10.0.0.%d' % host), 'a') for host in range(4))
+        self.assertEqual(aggregatePrefixes(routes), [(ipToInt('10.0.0.0'), 30, 'a')])
+
+    def testSubnetOfDistinctHostsStaysSplit(self):
+        routes = {ipToInt('10.0.2.1'): 'a', ipToInt('10.0.2.2'): 'b'}
+        self.assertEqual(sorted(aggregatePrefixes(routes, [(ipToInt('10.0.2.0'), 24)])),
+                         [(ipToInt('10.0.2.1'), 32, 'a'), (ipToInt('10.0.2.2'), 32, 'b')])
+
+    def testEveryHostForwardedAsBefore(self):
+        rng = random.Random(1)
+        subnets = [(ipToInt('10.%d.%d.0' % (pod, rack)), 24)
+                   for pod in range(4) for rack in range(8)]
+        routes = {}
+        for network, _ in subnets:
+            for host in rng.sample(range(1, 255), 20):
+                routes[network + host] = rng.choice(['p1', 'p1', 'p1', 'p2', 'p3'])
+        prefixes = aggregatePrefixes(routes, subnets)
+        self.assertLess(len(prefixes), len(routes))
+        for ip, action in routes.iteritems():
+            self.assertEqual(lookup(prefixes, ip), action)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+import numpy
+
+from wrr import bucketAssignment, bucketSequence, WEIGHT_BUCKETS
+
+
+class BucketAssignmentTest(unittest.TestCase):
+
+    def counts(self, weights, buckets=WEIGHT_BUCKETS):
+        paths = bucketAssignment(numpy.array(weights, dtype=float), buckets)
+        self.assertEqual(len(paths), buckets)
+        return list(numpy.bincount(paths, minlength=len(weights)))
+
+    def testProportionalShares(self):
+        self.assertEqual(self.counts([1, 1, 2]), [64, 64, 128])
+        self.assertEqual(self.counts([3, 1], buckets=8), [6, 2])
+
+    def testLargestRemainders(self):
+        # 256 / 3 leaves one bucket over, given to the largest remainder
+        self.assertEqual(self.counts([1, 1, 1]), [86, 85, 85])
+        self.assertEqual(self.counts([0.5, 1.0, 1.5], buckets=10), [2, 3, 5])
+
+    def testZeroWeightGetsNoBucket(self):
+        self.assertEqual(self.counts([0, 1, 3], buckets=8), [0, 2, 6])
+
+    def testNoCapacityFallsBackToEqualShares(self):
+        self.assertEqual(self.counts([0, 0, 0, 0]), [64, 64, 64, 64])
+
+    def testSequenceKeepsTheCounts(self):
+        weights = numpy.array([5.0, 2.0, 1.0])
+        sequence = bucketSequence(weights, buckets=16)
+        self.assertEqual(sorted(sequence), list(bucketAssignment(weights, buckets=16)))
+        # every half of the sequence holds each path about as often
+        for half in (sequence[:8], sequence[8:]):
+            self.assertEqual(list(numpy.bincount(half, minlength=3)), [5, 2, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
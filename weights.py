@@ -0,0 +1,315 @@
+#!/usr/bin/env python2
+import sys
+import threading
+from time import time
+
+import grpc
+import numpy
+from p4.v1 import p4runtime_pb2
+
+from p4runtime_lib.error_utils import printGrpcError
+from provision import writeUpdates
+from wrr import WEIGHT_BUCKETS, bucketAssignment, bucketSequence
+
+# Defines passed to p4c to build the ToR program in controller weights mode
+CONTROLLER_WEIGHTS_FLAGS = ['-DCONTROLLER_WEIGHTS']
+
+# Same, with the new flowlets taking the buckets in turn from a double
+# buffered path_weight_exact instead of at random
+ROUND_ROBIN_WEIGHTS_FLAGS = CONTROLLER_WEIGHTS_FLAGS + ['-DWEIGHTED_ROUND_ROBIN']
+
+DEFAULT_INTERVAL = 0.5
+
+
+def _value(data):
+    # a P4Runtime bytestring as an integer
+    return int(data.encode('hex'), 16) if data else 0
+
+
+def linkRates(poller, links):
+    """
+    Estimates the rate of each link from the last two byte_cnt_reg samples
+    of its egress port. The data plane resets a port's byte count when a
+    WECMP packet comes in on it, which also moves last_time_cnt_reg; after
+    a reset the new count is taken as the whole delta.
+
+    :param poller: the TelemetryPoller sampling the switches
+    :param links: list of (switch name, port)
+    :return: NumPy array of rates in bits/s, 0 where there are not yet
+             two samples
+    """
+    n = len(links)
+    prev_bytes = numpy.zeros(n)
+    cur_bytes = numpy.zeros(n)
+    prev_time = numpy.zeros(n)
+    cur_time = numpy.zeros(n)
+    reset = numpy.zeros(n, dtype=bool)
+    for i, (switch, port) in enumerate(links):
+        byte_ring = poller.buffers.get((switch, 'byte_cnt_reg', port))
+        if byte_ring is None or len(byte_ring) < 2:
+            continue
+        timestamps, values = byte_ring.samples()
+        prev_time[i], cur_time[i] = timestamps[-2:]
+        prev_bytes[i], cur_bytes[i] = values[-2:]
+        time_ring = poller.buffers.get((switch, 'last_time_cnt_reg', port))
+        if time_ring is not None and len(time_ring) >= 2:
+            last_times = time_ring.samples()[1]
+            reset[i] = last_times[-1] != last_times[-2]
+
+    delta = numpy.where(reset | (cur_bytes < prev_bytes), cur_bytes, cur_bytes - prev_bytes)
+    elapsed = cur_time - prev_time
+    rates = numpy.zeros(n)
+    valid = elapsed > 0
+    rates[valid] = delta[valid] * 8 / elapsed[valid]
+    return rates
+
+
+class PathWeights(object):
+    """
+    Computes the weight of every path of every ToR in one vectorized pass.
+
+    A ToR's path id covers the paths to all other ToRs, so a path is as
+    loaded as its busiest link towards any destination. Its weight is the
+    spare capacity of that link, between 0 and 1.
+    """
+
+    def __init__(self, fabric):
+        self.fabric = fabric
+        self.rows = []  # (tor name, path id) of each row of the incidence matrix
+        link_index = {}
+        path_links = []
+        for tor in fabric.tors():
+            tor_paths = {}
+            for dst in fabric.tors():
+                if dst.name == tor.name:
+                    continue
+                for path_id, hops in enumerate(fabric.spinePaths(tor.name, dst.name)):
+                    tor_paths.setdefault(path_id, set()).update(hops)
+            for path_id in sorted(tor_paths):
+                self.rows.append((tor.name, path_id))
+                path_links.append([link_index.setdefault(hop, len(link_index))
+                                   for hop in tor_paths[path_id]])
+
+        self.links = sorted(link_index, key=link_index.get)
+        self.capacity = numpy.array([fabric.linkCapacity(*link) for link in self.links])
+        self.incidence = numpy.zeros((len(self.rows), len(self.links)))
+        for row, links in enumerate(path_links):
+            self.incidence[row, links] = 1
+
+    def compute(self, rates):
+        """
+        :param rates: NumPy array of link rates in bits/s, in self.links order
+        :return: dict of tor name -> NumPy array of weights indexed by path id
+        """
+        utilization = numpy.clip(rates / self.capacity, 0, 1)
+        path_utilization = (self.incidence * utilization).max(axis=1)
+        path_weights = 1 - path_utilization
+
+        weights = {}
+        for (tor, path_id), weight in zip(self.rows, path_weights):
+            weights.setdefault(tor, {})[path_id] = weight
+        return dict((tor, numpy.array([by_path[p] for p in sorted(by_path)]))
+                    for tor, by_path in weights.iteritems())
+
+
+class WeightController(object):
+    """
+    Periodically recomputes the path weights from the polled counters and
+    rewrites the buckets of path_weight_exact that changed on each ToR.
+
+    In round-robin mode (ROUND_ROBIN_WEIGHTS_FLAGS), the buckets hold the
+    bucketSequence of the weights and path_weight_exact has two banks: the
+    bank not in use is rewritten, then weight_bank_select is flipped to it
+    with a single write, so a ToR never mixes two sets of weights.
+
+    Before its first push to a ToR, and again after a write to it failed,
+    the controller reads the buckets and the bank in use from the ToR, so a
+    restart or a takeover continues from what the switch holds.
+    """
+
+    def __init__(self, fabric, poller, connections, p4info_helpers,
+                 interval=DEFAULT_INTERVAL, buckets=WEIGHT_BUCKETS, round_robin=False,
+                 is_primary=None):
+        """
+        :param fabric: the FabricInventory
+        :param poller: a running TelemetryPoller sampling byte_cnt_reg and
+                       last_time_cnt_reg
+        :param connections: dict of switch name -> switch connection
+        :param p4info_helpers: dict of role -> P4Info helper
+        :param interval: seconds between two weight updates
+        :param buckets: number of entries of path_weight_exact
+        :param round_robin: the ToRs were built with ROUND_ROBIN_WEIGHTS_FLAGS
+        :param is_primary: function of a switch name returning True if the
+                           controller may write to it, e.g. HaController.isPrimary;
+                           None to write to every ToR
+        """
+        self.fabric = fabric
+        self.poller = poller
+        self.connections = connections
+        self.p4info_helper = p4info_helpers['tor']
+        self.interval = interval
+        self.buckets = buckets
+        self.round_robin = round_robin
+        self.is_primary = is_primary
+        self.path_weights = PathWeights(fabric)
+        # tor name, or (tor name, bank) -> path of every bucket on the switch, -1
+        # for the buckets it does not have
+        self.installed = {}
+        self.banks = {}  # tor name -> bank of path_weight_exact in use
+        self.seeded = set()  # tor names whose buckets and bank were read
+        # a HealthMonitor taking the dead paths out of the weights, see health.py
+        self.health = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _bucketEntry(self, bucket, path_id, bank=None):
+        match_fields = {"meta.weight_bucket": bucket}
+        if bank is not None:
+            match_fields["meta.weight_bank"] = bank
+        return self.p4info_helper.buildTableEntry(
+            table_name="MyIngress.path_weight_exact",
+            match_fields=match_fields,
+            action_name="MyIngress.set_path",
+            action_params={"path_id": path_id})
+
+    def _bucketUpdates(self, key, assignment, bank=None):
+        # only the buckets whose path changed since the last write of key,
+        # inserted if the switch does not have them yet
+        previous = self.installed.get(key)
+        if previous is None:
+            previous = numpy.full(self.buckets, -1)
+        return [(p4runtime_pb2.Update.INSERT if previous[b] < 0 else p4runtime_pb2.Update.MODIFY,
+                 self._bucketEntry(int(b), int(assignment[b]), bank))
+                for b in numpy.nonzero(assignment != previous)[0]]
+
+    def _seed(self, tor):
+        # reads the buckets of path_weight_exact and the bank in use from the ToR
+        helper = self.p4info_helper
+        table_id = helper.get_tables_id("MyIngress.path_weight_exact")
+        bucket_field = helper.get_match_field("MyIngress.path_weight_exact",
+                                              name="meta.weight_bucket").id
+        request = p4runtime_pb2.ReadRequest()
+        request.device_id = self.connections[tor].device_id
+        request.entities.add().table_entry.table_id = table_id
+        if self.round_robin:
+            select = request.entities.add().table_entry
+            select.table_id = helper.get_tables_id("MyIngress.weight_bank_select")
+            select.is_default_action = True
+
+        installed = {}
+        bank_in_use = 0
+        for response in self.connections[tor].client_stub.Read(request):
+            for entity in response.entities:
+                table_entry = entity.table_entry
+                params = table_entry.action.action.params
+                if table_entry.table_id != table_id:
+                    bank_in_use = _value(params[0].value) if params else 0
+                    continue
+                bucket, bank = None, None
+                for field_match in table_entry.match:
+                    if field_match.field_id == bucket_field:
+                        bucket = _value(field_match.exact.value)
+                    else:
+                        bank = _value(field_match.exact.value)
+                if bucket is None or bucket >= self.buckets or not params:
+                    continue
+                key = tor if bank is None else (tor, bank)
+                installed.setdefault(key, numpy.full(self.buckets, -1))[bucket] = \
+                    _value(params[0].value)
+        for key in [key for key in self.installed
+                    if key == tor or (isinstance(key, tuple) and key[0] == tor)]:
+            del self.installed[key]
+        self.installed.update(installed)
+        self.banks[tor] = bank_in_use
+        self.seeded.add(tor)
+
+    def forget(self, tor):
+        """
+        Drops what is known of the buckets of the ToR, e.g. once another
+        controller wrote them; they are read again before the next push.
+        """
+        with self.lock:
+            self.seeded.discard(tor)
+
+    def _write(self, tor, updates):
+        try:
+            writeUpdates(self.connections[tor], updates, batch_size=max(len(updates), 1))
+        except grpc.RpcError:
+            # some of the updates may have gone through
+            self.seeded.discard(tor)
+            raise
+
+    def pushWeights(self, tor, weights):
+        """
+        Writes the bucket assignment of the weights to the ToR, sending only
+        the buckets whose path changed, in a single batch.
+
+        :return: the number of buckets written
+        """
+        if tor not in self.seeded:
+            self._seed(tor)
+        if self.round_robin:
+            return self.pushSequence(tor, weights)
+        assignment = bucketAssignment(weights, self.buckets)
+        updates = self._bucketUpdates(tor, assignment)
+        self._write(tor, updates)
+        self.installed[tor] = assignment
+        return len(updates)
+
+    def pushSequence(self, tor, weights):
+        """
+        Writes the round-robin sequence of the weights to the bank of
+        path_weight_exact the ToR does not use, then switches the ToR to it.
+
+        :return: the number of buckets written
+        """
+        sequence = bucketSequence(weights, self.buckets)
+        active = self.banks.get(tor, 0)
+        current = self.installed.get((tor, active))
+        if current is not None and (current == sequence).all():
+            return 0
+        bank = 1 - active
+        updates = self._bucketUpdates((tor, bank), sequence, bank)
+        self._write(tor, updates)
+        self.installed[(tor, bank)] = sequence
+        flip = self.p4info_helper.buildTableEntry(
+            table_name="MyIngress.weight_bank_select",
+            default_action=True,
+            action_name="MyIngress.set_weight_bank",
+            action_params={"bank": bank})
+        self._write(tor, [(p4runtime_pb2.Update.MODIFY, flip)])
+        self.banks[tor] = bank
+        return len(updates)
+
+    def update(self):
+        # also called by the health monitor when a path dies or comes back
+        with self.lock:
+            rates = linkRates(self.poller, self.path_weights.links)
+            for tor, weights in self.path_weights.compute(rates).iteritems():
+                if self.is_primary is not None and not self.is_primary(tor):
+                    continue
+                if self.health is not None:
+                    weights = self.health.scale(tor, weights)
+                self.pushWeights(tor, weights)
+
+    def _run(self):
+        next_update = time()
+        while not self.stopped.is_set():
+            try:
+                self.update()
+            except grpc.RpcError as e:
+                printGrpcError(e)
+            sys.stdout.flush()
+            next_update = max(next_update + self.interval, time())
+            self.stopped.wait(next_update - time())
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='weights')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python2
+import numpy
+
+# Must match WEIGHT_BUCKETS in load_balance.p4, a power of 2 so the
+# round-robin position of the ToRs can wrap with a mask
+WEIGHT_BUCKETS = 256
+
+
+def bucketAssignment(weights, buckets=WEIGHT_BUCKETS):
+    """
+    Shares the buckets among the paths in proportion to their weights, using
+    the largest remainder method so the counts add up exactly. A fabric with
+    no spare capacity anywhere falls back to equal shares.
+
+    :param weights: NumPy array of path weights
+    :return: NumPy array of length buckets giving the path id of each bucket
+    """
+    total = weights.sum()
+    if total <= 0:
+        weights = numpy.ones(len(weights))
+        total = weights.sum()
+    shares = weights * buckets / total
+    counts = numpy.floor(shares).astype(int)
+    remainder = buckets - counts.sum()
+    if remainder > 0:
+        counts[numpy.argsort(counts - shares)[:remainder]] += 1
+    return numpy.repeat(numpy.arange(len(weights)), counts)
+
+
+def bucketSequence(weights, buckets=WEIGHT_BUCKETS):
+    """
+    The buckets of bucketAssignment in weighted round-robin order: the
+    buckets of every path are spread evenly over the sequence, so any run of
+    consecutive buckets holds each path about as often as its weight says.
+
+    :param weights: NumPy array of path weights
+    :return: NumPy array of length buckets giving the path id of each bucket
+    """
+    counts = numpy.bincount(bucketAssignment(weights, buckets), minlength=len(weights))
+    paths = numpy.repeat(numpy.arange(len(weights)), counts)
+    # the k-th of the n buckets of a path sits at (k + 1/2) / n of the sequence
+    offsets = numpy.arange(buckets) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    positions = (offsets + 0.5) / counts[paths]
+    return paths[numpy.argsort(positions, kind='mergesort')]